@@ -1,13 +1,18 @@
 """
 This module is called from main when it encounters
-a doc/docx file to be processed. It loads libre office
+doc/docx files to be processed. It loads libre office
 in efs from its attached layer and converts doc/docx
 into pdf and uploads in s3.
+LibreOffice is kept running as a listener across warm
+invocations and an event may carry a batch of files.
 """
 
 import os
-from io import BytesIO
+from io import BufferedReader, RawIOBase
+import fcntl
 import tarfile
+import tempfile
+import time
 import boto3
 import subprocess
 import brotli
@@ -15,42 +20,355 @@ import logging
 import sys
 import traceback
 import json
+import concurrent.futures
+from shutil import rmtree
 
-libre_office_install_dir = os.environ["lambda_write_path"] + "/instdir"
+libre_office_archive = os.environ.get("libre_office_archive", "/opt/lo.tar.br")
+# Directory shared by the containers (EFS) the install is published to.
+libre_office_shared_path = os.environ.get(
+    "libre_office_shared_path", os.environ["lambda_write_path"]
+)
+# The profile is written to by the running instance, so it stays local.
+libre_office_profile = os.path.join(tempfile.gettempdir(), "lo_profile")
+libre_office_port = int(os.environ.get("libre_office_port", "2002"))
+
+SOFFICE_OPTIONS = [
+    "--headless",
+    "--invisible",
+    "--nodefault",
+    "--nofirststartwizard",
+    "--nolockcheck",
+    "--nologo",
+    "--norestore",
+    f"-env:UserInstallation=file://{libre_office_profile}",
+]
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 
+class BrotliReader(RawIOBase):
+    """
+    Decompresses a brotli file as it is read, so that the tar stream
+    is extracted without holding the archive in memory.
+    """
+
+    def __init__(self, path, chunk_size):
+        self.file = open(path, "rb")
+        decompressor = brotli.Decompressor()
+        # brotlipy names it decompress, the brotli package process.
+        self.decompress = getattr(decompressor, "decompress", None)
+        if self.decompress is None:
+            self.decompress = decompressor.process
+        self.chunk_size = chunk_size
+        self.buffer = b""
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.offset >= len(self.buffer):
+            chunk = self.file.read(self.chunk_size)
+            if not chunk:
+                return 0
+            self.buffer = self.decompress(chunk)
+            self.offset = 0
+        size = min(len(b), len(self.buffer) - self.offset)
+        b[:size] = self.buffer[self.offset : self.offset + size]
+        self.offset += size
+        return size
+
+    def close(self):
+        self.file.close()
+        super().close()
+
+
+def get_libre_office_version():
+    """
+    Returns libre_office_version, or an id of the layer archive so that
+    a new layer is extracted into a new directory.
+    """
+    if version := os.environ.get("libre_office_version"):
+        return version
+    archive_stat = os.stat(libre_office_archive)
+    return f"{archive_stat.st_size}-{int(archive_stat.st_mtime)}"
+
+
+def get_temp_prefix(install_root):
+    return f".{os.path.basename(install_root)}.extract-"
+
+
+def remove_stale_extractions(install_root):
+    """
+    Removes the temporary directories left by extractions of install_root
+    that did not finish, called while holding the lock of install_root.
+    """
+    prefix = get_temp_prefix(install_root)
+    for name in os.listdir(libre_office_shared_path):
+        if name.startswith(prefix):
+            logger.info(f"Removing the partial extraction {name}")
+            rmtree(os.path.join(libre_office_shared_path, name), ignore_errors=True)
+
+
+def extract_libre_office(install_root):
+    """
+    Streams the layer archive into a temporary directory next to
+    install_root and renames it into place, so that other containers
+    never see a partial install.
+    """
+    chunk_size = int(os.environ.get("libre_office_extract_chunk_mb", "4")) << 20
+    temp_dir = tempfile.mkdtemp(
+        dir=libre_office_shared_path, prefix=get_temp_prefix(install_root)
+    )
+    os.chmod(temp_dir, 0o755)
+    try:
+        with BrotliReader(libre_office_archive, chunk_size) as raw, BufferedReader(
+            raw, buffer_size=chunk_size
+        ) as stream, tarfile.open(fileobj=stream, mode="r|") as tar:
+            tar.extractall(temp_dir)
+        os.rename(temp_dir, install_root)
+    except Exception as e:
+        rmtree(temp_dir, ignore_errors=True)
+        # Another container published the same version first.
+        if not (isinstance(e, OSError) and os.path.isdir(install_root)):
+            raise
+
+
 def load_libre_office():
-    if os.path.exists(libre_office_install_dir) and os.path.isdir(
-        libre_office_install_dir
-    ):
+    """
+    Returns the path of soffice.bin. The first container to need a
+    LibreOffice version extracts it into the shared directory while
+    holding a lock, the others wait and reuse it. Extractions cut short
+    by a container that died are removed by the next one.
+    """
+    start = time.perf_counter()
+    install_root = os.path.join(
+        libre_office_shared_path, f"libreoffice-{get_libre_office_version()}"
+    )
+    soffice_path = f"{install_root}/instdir/program/soffice.bin"
+    if os.path.isfile(soffice_path):
         logger.info("We have a cached copy of LibreOffice, skipping extraction")
     else:
-        logger.info(
-            "No cached copy of LibreOffice, extracting tar stream from Brotli file."
+        os.makedirs(libre_office_shared_path, exist_ok=True)
+        with open(f"{install_root}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.isfile(soffice_path):
+                    logger.info("LibreOffice was extracted by another container")
+                else:
+                    logger.info(
+                        "No cached copy of LibreOffice, "
+                        "extracting tar stream from Brotli file."
+                    )
+                    remove_stale_extractions(install_root)
+                    if os.path.isdir(install_root):
+                        logger.info(f"Removing the incomplete {install_root}")
+                        rmtree(install_root)
+                    extract_libre_office(install_root)
+                    logger.info(
+                        f"Done caching LibreOffice in "
+                        f"{time.perf_counter() - start:.2f}s"
+                    )
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    logger.info(f"LibreOffice available after {time.perf_counter() - start:.2f}s")
+    return soffice_path
+
+
+def log_exception():
+    exception_type, exception_value, exception_traceback = sys.exc_info()
+    traceback_string = traceback.format_exception(
+        exception_type, exception_value, exception_traceback
+    )
+    err_msg = json.dumps(
+        {
+            "errorType": exception_type.__name__,
+            "errorMessage": str(exception_value),
+            "stackTrace": traceback_string,
+        }
+    )
+    logger.error(err_msg)
+
+
+def import_uno(program_dir):
+    """
+    Returns the uno module shipped with LibreOffice, or None when it
+    cannot be loaded by this python.
+    """
+    os.environ.setdefault(
+        "URE_BOOTSTRAP", f"vnd.sun.star.pathname:{program_dir}/fundamentalrc"
+    )
+    if program_dir not in sys.path:
+        sys.path.append(program_dir)
+    try:
+        import uno
+
+        return uno
+    except ImportError as _:
+        logger.info("uno is not available, converting with soffice batches")
+        return None
+
+
+class LibreOfficeServer:
+    """
+    Keeps a headless LibreOffice listening on a local socket across warm
+    invocations and converts documents over UNO, restarting the listener
+    when it dies. A document taking longer than libre_office_convert_timeout
+    seconds stops the listener, which is started again for the next
+    document, and is converted by a soffice launch of its own instead.
+    Without the uno module each batch of documents is converted by a
+    single soffice launch.
+    """
+
+    def __init__(self, soffice_path):
+        self.soffice_path = soffice_path
+        self.uno = import_uno(os.path.dirname(soffice_path))
+        self.startup_timeout = int(os.environ.get("libre_office_startup_timeout", "60"))
+        self.convert_timeout = int(
+            os.environ.get("libre_office_convert_timeout", "120")
+        )
+        self.process = None
+        self.desktop = None
+
+    def start(self):
+        self.stop()
+        logger.info(f"Starting LibreOffice listener on port {libre_office_port}")
+        start = time.perf_counter()
+        connection = (
+            f"socket,host=127.0.0.1,port={libre_office_port};"
+            "urp;StarOffice.ComponentContext"
+        )
+        self.process = subprocess.Popen(
+            [self.soffice_path, *SOFFICE_OPTIONS, f"--accept={connection}"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        local_context = self.uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context
+        )
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            try:
+                context = resolver.resolve(f"uno:{connection}")
+                break
+            except Exception as _:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError("LibreOffice listener did not start")
+                time.sleep(0.25)
+        self.desktop = context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop", context
+        )
+        logger.info(f"LibreOffice listener ready in {time.perf_counter() - start:.2f}s")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.process = None
+        self.desktop = None
+
+    def property_value(self, name, value):
+        prop = self.uno.createUnoStruct("com.sun.star.beans.PropertyValue")
+        prop.Name = name
+        prop.Value = value
+        return prop
+
+    def convert_document(self, word_file_path, pdf_file_path):
+        if self.process is None or self.process.poll() is not None:
+            self.start()
+        os.makedirs(os.path.dirname(pdf_file_path), exist_ok=True)
+        document = self.desktop.loadComponentFromURL(
+            self.uno.systemPathToFileUrl(word_file_path),
+            "_blank",
+            0,
+            (self.property_value("Hidden", True),),
         )
-        buffer = BytesIO()
-        with open("/opt/lo.tar.br", "rb") as brotli_file:
-            d = brotli.Decompressor()
-            while True:
-                chunk = brotli_file.read(1024)
-                buffer.write(d.decompress(chunk))
-                if len(chunk) < 1024:
+        try:
+            document.storeToURL(
+                self.uno.systemPathToFileUrl(pdf_file_path),
+                (self.property_value("FilterName", "writer_pdf_Export"),),
+            )
+        finally:
+            document.close(True)
+
+    def convert_document_with_timeout(self, word_file_path, pdf_file_path):
+        """
+        Converts over UNO, stopping the listener when the conversion takes
+        longer than convert_timeout, which fails the hung UNO calls.
+        """
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(self.convert_document, word_file_path, pdf_file_path)
+        executor.shutdown(wait=False)
+        try:
+            future.result(timeout=self.convert_timeout)
+        except concurrent.futures.TimeoutError as _:
+            logger.info(
+                f"Conversion of {word_file_path} exceeded "
+                f"{self.convert_timeout}s, stopping LibreOffice"
+            )
+            self.stop()
+            raise
+
+    def convert(self, documents):
+        """
+        Parameters
+        ----------
+        documents: list of (word file path, pdf file path)
+        Returns the success flag of each document
+        -------
+        """
+        if self.uno is None:
+            return convert_word_to_pdf(self.soffice_path, documents)
+
+        flags = []
+        for word_file_path, pdf_file_path in documents:
+            for attempt in (1, 2):
+                try:
+                    start = time.perf_counter()
+                    self.convert_document_with_timeout(word_file_path, pdf_file_path)
+                    logger.info(
+                        f"Converted {word_file_path} in "
+                        f"{time.perf_counter() - start:.2f}s"
+                    )
+                    flags.append(True)
+                    break
+                except concurrent.futures.TimeoutError as _:
+                    # The listener is stopped, so soffice has the profile.
+                    flags.extend(
+                        convert_word_to_pdf(
+                            self.soffice_path, [(word_file_path, pdf_file_path)]
+                        )
+                    )
                     break
-            buffer.seek(0)
+                except Exception as _:
+                    log_exception()
+                    # A crashed listener is restarted for the retry.
+                    self.stop()
+                    if attempt == 2:
+                        flags.append(False)
+        return flags
 
-        logger.info("Extracting tar stream to tmp for caching.")
-        with tarfile.open(fileobj=buffer) as tar:
-            tar.extractall(os.environ["lambda_write_path"])
-        logger.info("Done caching LibreOffice!")
 
-    return f"{libre_office_install_dir}/program/soffice.bin"
+libre_office_server = None
 
 
-def download_from_s3(bucket, key, download_path):
-    s3 = boto3.client("s3")
+def get_libre_office_server():
+    """
+    Returns the LibreOffice server of the container, created on first use.
+    """
+    global libre_office_server
+
+    if libre_office_server is None:
+        libre_office_server = LibreOfficeServer(load_libre_office())
+    return libre_office_server
+
+
+def download_from_s3(bucket, key, download_path, s3=None):
+    s3 = s3 or boto3.client("s3")
     if not os.path.exists(os.path.dirname(download_path)):
         os.makedirs(os.path.dirname(download_path), exist_ok=True)
     s3.download_file(bucket, key, download_path)
@@ -61,78 +379,155 @@ def upload_to_s3(file_path, bucket, key):
     s3.upload_file(file_path, bucket, key)
 
 
-def convert_word_to_pdf(soffice_path, word_file_path, output_dir):
-    conv_cmd = f"{soffice_path} --headless --norestore --invisible --nodefault \
-    --nofirststartwizard --nolockcheck --nologo \
-    --convert-to pdf:writer_pdf_Export --outdir {output_dir} {word_file_path}"
-    response = subprocess.run(
-        conv_cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    if response.returncode != 0:
-        response = subprocess.run(
-            conv_cmd.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE
+def convert_word_to_pdf(soffice_path, documents):
+    """
+    Converts a batch of documents with a single soffice launch,
+    retrying the documents that failed once. A launch is killed after
+    libre_office_convert_timeout seconds per document.
+    Parameters
+    ----------
+    soffice_path: path of soffice.bin
+    documents: list of (word file path, pdf file path)
+    Returns the success flag of each document
+    -------
+    """
+    staging_dir = tempfile.mkdtemp(dir=os.environ["lambda_write_path"])
+    # Links with unique names keep documents with the same base name apart.
+    staged_files = []
+    for index, (word_file_path, _) in enumerate(documents):
+        staged_files.append(
+            os.path.join(staging_dir, f"{index}_{os.path.basename(word_file_path)}")
         )
-        if response.returncode != 0:
-            return False
-    return True
+        os.symlink(word_file_path, staged_files[-1])
+
+    timeout = int(os.environ.get("libre_office_convert_timeout", "120"))
+    pending = list(range(len(documents)))
+    for _ in range(2):
+        if not pending:
+            break
+        try:
+            subprocess.run(
+                [
+                    soffice_path,
+                    *SOFFICE_OPTIONS,
+                    "--convert-to",
+                    "pdf:writer_pdf_Export",
+                    "--outdir",
+                    staging_dir,
+                    *[staged_files[index] for index in pending],
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=timeout * len(pending),
+            )
+        except subprocess.TimeoutExpired as _:
+            logger.info(f"soffice exceeded {timeout}s per document, killed")
+        failed = []
+        for index in pending:
+            staged_name, _ = os.path.splitext(staged_files[index])
+            if os.path.exists(staged_pdf := f"{staged_name}.pdf"):
+                pdf_file_path = documents[index][1]
+                os.makedirs(os.path.dirname(pdf_file_path), exist_ok=True)
+                os.replace(staged_pdf, pdf_file_path)
+            else:
+                failed.append(index)
+        pending = failed
+
+    rmtree(staging_dir, ignore_errors=True)
+    return [index not in pending for index in range(len(documents))]
 
 
 def lambda_handler(event, context):
+    """
+    Converts the s3_input_file of the event into s3_output_file, or every
+    {"s3_input_file", "s3_output_file"} of the "files" list of the event.
+    """
     bucket_name = os.environ["main_s3_bucket"]
     lambda_write_path = os.environ["lambda_write_path"]
-    s3_input_file = event["s3_input_file"]
-    key_prefix, base_name = os.path.split(s3_input_file)
-    filename, _ = os.path.splitext(base_name)
-    download_path = f"{lambda_write_path}/{s3_input_file}"
-    s3_output_file = event["s3_output_file"]
-    output_dir = f"{lambda_write_path}/{s3_output_file}"
-
-    logger.info(
-        f"key_prefix- {key_prefix},\
-        base_name - {base_name},\
-        filename - {filename},\
-        _ - {_},\
-        download_path - {download_path},\
-        s3_output_file - {s3_output_file},\
-        output_dir - {output_dir}"
-    )
+    if "files" in event:
+        files = event["files"]
+    else:
+        files = [
+            {
+                "s3_input_file": event["s3_input_file"],
+                "s3_output_file": event["s3_output_file"],
+            }
+        ]
 
-    download_from_s3(bucket_name, s3_input_file, download_path)
-    soffice_path = load_libre_office()
-    converted = convert_word_to_pdf(soffice_path, download_path, output_dir)
+    session = boto3.Session()
+    s3_client = session.client(service_name="s3")
 
-    if converted:
-        logger.info(f"Converted to: {s3_output_file}")
+    documents = []
+    for file in files:
+        s3_input_file = file["s3_input_file"]
+        s3_output_file = file["s3_output_file"]
+        key_prefix, base_name = os.path.split(s3_input_file)
+        filename, _ = os.path.splitext(base_name)
+        download_path = f"{lambda_write_path}/{s3_input_file}"
+        output_dir = f"{lambda_write_path}/{s3_output_file}"
+        logger.info(
+            f"key_prefix - {key_prefix}, base_name - {base_name}, "
+            f"download_path - {download_path}, "
+            f"s3_output_file - {s3_output_file}, output_dir - {output_dir}"
+        )
+        documents.append((download_path, f"{output_dir}/{filename}.pdf"))
+
+    def download(file, download_path):
         try:
-            session = boto3.Session()
-            s3_client = session.client(service_name="s3")
-            with open(f"{output_dir}/{filename}.pdf", "rb") as data:
-                s3_client.upload_fileobj(
-                    data,
-                    bucket_name,
-                    s3_output_file,
-                )
-            uploaded = True
-        except Exception as _:
-            (
-                exception_type,
-                exception_value,
-                exception_traceback,
-            ) = sys.exc_info()
-            traceback_string = traceback.format_exception(
-                exception_type, exception_value, exception_traceback
+            download_from_s3(
+                bucket_name, file["s3_input_file"], download_path, s3_client
             )
-            err_msg = json.dumps(
-                {
-                    "errorType": exception_type.__name__,
-                    "errorMessage": str(exception_value),
-                    "stackTrace": traceback_string,
-                }
+            return True
+        except Exception as _:
+            log_exception()
+            return False
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(8, len(files)))
+    ) as executor:
+        downloaded = list(
+            executor.map(
+                download, files, [download_path for download_path, _ in documents]
             )
-            logger.error(err_msg)
-            logger.info("PDF not uploaded")
-            uploaded = False
-    else:
-        logger.info("PDF not created")
+        )
+
+    downloaded_documents = [
+        document for document, ok in zip(documents, downloaded) if ok
+    ]
+    converted_flags = iter(
+        get_libre_office_server().convert(downloaded_documents)
+        if downloaded_documents
+        else []
+    )
+    flags = [ok and next(converted_flags) for ok in downloaded]
+
+    results = []
+    for file, (download_path, pdf_file_path), converted in zip(files, documents, flags):
+        uploaded = False
+        if converted:
+            logger.info(f"Converted to: {file['s3_output_file']}")
+            try:
+                with open(pdf_file_path, "rb") as data:
+                    s3_client.upload_fileobj(
+                        data,
+                        bucket_name,
+                        file["s3_output_file"],
+                    )
+                uploaded = True
+            except Exception as _:
+                log_exception()
+                logger.info("PDF not uploaded")
+        else:
+            logger.info(f"PDF not created for: {file['s3_input_file']}")
+
+        for local_file in (download_path, pdf_file_path):
+            if os.path.exists(local_file):
+                os.remove(local_file)
+        results.append({**file, "response": uploaded})
 
-    return {"response": uploaded}
+    if "files" in event:
+        return {
+            "response": all(result["response"] for result in results),
+            "files": results,
+        }
+    return {"response": results[0]["response"]}
@@ -2,40 +2,598 @@
 This module is triggered based on files placed in trigger S3 bucket.
 The trigger files corresponds to each folder in
 main s3 where the documents are placed.
-The files in the folder are converted in a loop and stored in doc_pdf.
+The files in the folder are converted in a loop (or concurrently when
+conversion_workers is set) and stored in doc_pdf.
 A Success file is created in Merge Trigger Once the process is done.
 """
 
+import codecs
 import concurrent.futures
+import csv
+import email
+import hashlib
+import importlib
 import json
 import logging
+import mimetypes
+import multiprocessing
+import multiprocessing.connection
 import os
+import pickle
+import queue
+import re
+import resource
+import shlex
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 import traceback
-from itertools import islice
-from shutil import copyfile, rmtree
+import uuid
+import zipfile
+import zlib
+from collections import OrderedDict, deque
+from email import policy
+from html.parser import HTMLParser
+from io import BytesIO
+from itertools import islice, takewhile
+from shutil import copyfile, rmtree, which
 
 import boto3
-import extract_msg
-import pandas as pd
-import pdfkit
-import pytesseract
-from PIL import Image, ImageSequence
-from PyPDF2 import PdfFileMerger
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 from botocore.exceptions import ClientError
-from fpdf import FPDF
-from reportlab.graphics import renderPM
-from svglib.svglib import svg2rlg
 import signal
 
+
+class LazyImport:
+    """
+    Stands in for a module, or for a name imported from a module, and
+    imports it on first use. An invocation only loads the dependencies
+    of the converters it runs, which keeps cold starts short.
+    """
+
+    def __init__(self, module_name, attribute=None):
+        self._module_name = module_name
+        self._attribute = attribute
+        self._target = None
+
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module_name)
+            if self._attribute is not None:
+                target = getattr(target, self._attribute)
+            self._target = target
+        return self._target
+
+    def __getattr__(self, name):
+        if name in ("_module_name", "_attribute", "_target"):
+            raise AttributeError(name)
+        return getattr(self._load(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+
+charset_normalizer = LazyImport("charset_normalizer")
+extract_msg = LazyImport("extract_msg")
+img2pdf = LazyImport("img2pdf")
+np = LazyImport("numpy")
+openpyxl = LazyImport("openpyxl")
+pd = LazyImport("pandas")
+pdfkit = LazyImport("pdfkit")
+pytesseract = LazyImport("pytesseract")
+Image = LazyImport("PIL.Image")
+ImageSequence = LazyImport("PIL.ImageSequence")
+TiffImagePlugin = LazyImport("PIL.TiffImagePlugin")
+PdfFileMerger = LazyImport("PyPDF2", "PdfFileMerger")
+PdfFileReader = LazyImport("PyPDF2", "PdfFileReader")
+PdfFileWriter = LazyImport("PyPDF2", "PdfFileWriter")
+FPDF = LazyImport("fpdf", "FPDF")
+renderPDF = LazyImport("reportlab.graphics.renderPDF")
+renderPM = LazyImport("reportlab.graphics.renderPM")
+svg2rlg = LazyImport("svglib.svglib", "svg2rlg")
+
 FILE_PATTERN_TO_INCLUDE = "_unredacted_original"
 
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif")
+
+# OCR modes selectable per case with the "ocr" key of the control file.
+# "inline" OCRs images while converting, "deferred" embeds the image
+# losslessly and leaves a job for ocr_lambda_handler, "none" skips OCR.
+OCR_MODES = ("inline", "deferred", "none")
+
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-unprocess_file = None
-unprocess_bucket = None
+# Files whose conversion has not finished yet, mapped to their bucket.
+# The timeout handler marks all of them as unprocessed.
+in_flight_files = {}
+in_flight_lock = threading.Lock()
+
+# Bump the version of a converter whenever its output changes so that
+# stale entries in the conversion cache are no longer matched.
+# "tesseract" versions the OCR results in the page OCR cache.
+CONVERTER_VERSIONS = {
+    "pdf": "1",
+    "image": "1",
+    "image_lossless": "1",
+    "tiff": "1",
+    "bmp": "1",
+    "svg": "2",
+    "mif": "2",
+    "mht": "1",
+    "eml": "2",
+    "csv": "2",
+    "excel": "2",
+    "html": "1",
+    "msg": "2",
+    "doc": "1",
+    "text": "2",
+    "tesseract": "1",
+}
+
+# Number of leading bytes read to identify the format of a file.
+SNIFF_BYTES = 8192
+OLE2_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+
+# A4 in points.
+PDF_PAGE_WIDTH = 595.28
+PDF_PAGE_HEIGHT = 841.89
+
+conversion_cache_stats = {"hits": 0, "misses": 0}
+stats_lock = threading.Lock()
+
+# time.monotonic() by which the invocation has to wrap up, set per
+# invocation so that sandboxed conversions never outlive it.
+invocation_deadline = None
+
+
+def log_exception():
+    """
+    Logs the exception currently being handled in the lambda error format.
+    """
+    exception_type, exception_value, exception_traceback = sys.exc_info()
+    traceback_string = traceback.format_exception(
+        exception_type, exception_value, exception_traceback
+    )
+    err_msg = json.dumps(
+        {
+            "errorType": exception_type.__name__,
+            "errorMessage": str(exception_value),
+            "stackTrace": traceback_string,
+        }
+    )
+    logger.error(err_msg)
+
+
+class OcrEngine:
+    """
+    Runs tesseract on a worker pool sized to the available cores.
+    Each tesseract process is limited to ocr_threads_per_worker OpenMP
+    threads through its environment, so that workers x threads never
+    exceeds the cores.
+    """
+
+    def __init__(self, workers=None, threads_per_worker=None):
+        cores = len(os.sched_getaffinity(0))
+        self.threads_per_worker = threads_per_worker or int(
+            os.environ.get("ocr_threads_per_worker", "1")
+        )
+        self.workers = workers or int(
+            os.environ.get("ocr_workers", str(max(1, cores // self.threads_per_worker)))
+        )
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="ocr"
+        )
+        self.lock = threading.Lock()
+        self.queued = 0
+        self.pages = 0
+        self.page_latencies = []
+        logger.info(
+            f"OCR engine: {self.workers} workers with "
+            f"{self.threads_per_worker} threads each on {cores} cores."
+        )
+
+    @property
+    def queue_depth(self):
+        """
+        Number of OCR jobs submitted but not started yet.
+        """
+        return self.queued
+
+    def _run(self, function, pages, args, kwargs):
+        with self.lock:
+            self.queued -= 1
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.pages += pages
+                self.page_latencies.extend([elapsed / pages] * pages)
+
+    def submit(self, function, *args, pages=1, **kwargs):
+        """
+        Queues function(*args, **kwargs) on the OCR workers.
+        pages is the number of pages the call OCRs and is used
+        for the per page latency.
+        Returns a Future of the result.
+        """
+        with self.lock:
+            self.queued += 1
+        return self.executor.submit(self._run, function, pages, args, kwargs)
+
+    def tesseract(self, input_filename, output_filename_base, extension, config=""):
+        """
+        Runs tesseract like pytesseract does, with its OpenMP threads
+        limited in the environment of the tesseract process only.
+        """
+        result = subprocess.run(
+            [
+                pytesseract.pytesseract.tesseract_cmd,
+                input_filename,
+                output_filename_base,
+                *shlex.split(config),
+                extension,
+            ],
+            env=dict(os.environ, OMP_THREAD_LIMIT=str(self.threads_per_worker)),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        if result.returncode:
+            raise pytesseract.TesseractError(
+                result.returncode, result.stderr.decode(errors="replace").strip()
+            )
+
+    def image_to_pdf(self, file_path, extension="pdf", config=""):
+        """
+        OCRs a single image into a pdf, reusing the result
+        of identical pages from the page OCR cache.
+        """
+        page_cache = get_page_ocr_cache()
+        if page_cache is not None:
+            with Image.open(file_path) as image:
+                key = page_cache.page_key(
+                    image, sorted(dict(extension=extension, config=config).items())
+                )
+            pdf = page_cache.get(key)
+            if pdf is not None:
+                return pdf
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            output_filename_base = os.path.join(temp_dir, "ocr")
+            self.submit(
+                self.tesseract, file_path, output_filename_base, extension, config
+            ).result()
+            with open(f"{output_filename_base}.{extension}", "rb") as f:
+                pdf = f.read()
+        if page_cache is not None:
+            page_cache.put(key, pdf)
+        return pdf
+
+    def run_tesseract(self, input_filename, output_filename_base, pages):
+        return self.submit(
+            self.tesseract, input_filename, output_filename_base, "pdf", pages=pages
+        ).result()
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.page_latencies)
+            stats = {"queue_depth": self.queued, "pages": self.pages}
+        if latencies:
+            stats["avg_page_seconds"] = round(sum(latencies) / len(latencies), 3)
+            stats["p95_page_seconds"] = round(
+                latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3
+            )
+        return stats
+
+    def reset_stats(self):
+        with self.lock:
+            self.pages = 0
+            self.page_latencies = []
+
+
+ocr_engine = None
+ocr_engine_lock = threading.Lock()
+
+
+def get_ocr_engine():
+    """
+    Returns the OCR engine of the container, created on first use.
+    """
+    global ocr_engine
+
+    with ocr_engine_lock:
+        if ocr_engine is None:
+            ocr_engine = OcrEngine()
+    return ocr_engine
+
+
+class HtmlRenderer:
+    """
+    Renders html and text files to pdf with wkhtmltopdf while keeping one
+    Xvfb display alive for the life of the container, instead of the
+    xvfb-run wrapper starting an X server for every document.
+    Documents queued together are rendered by a single wkhtmltopdf process
+    that reads one command line per document from stdin.
+    """
+
+    def __init__(self, binary=None, display=None, processes=None, batch_size=None):
+        self.binary = binary or os.environ.get(
+            "html_renderer_binary", "/usr/bin/wkhtmltopdf"
+        )
+        # "xvfb" starts a shared display, "none" is for a wkhtmltopdf
+        # build that renders headless without an X server.
+        self.display_mode = display or os.environ.get("html_renderer_display", "xvfb")
+        self.processes = processes or int(
+            os.environ.get("html_renderer_processes", "2")
+        )
+        self.batch_size = batch_size or int(
+            os.environ.get("html_renderer_batch_size", "8")
+        )
+        self.batch_wait = (
+            int(os.environ.get("html_renderer_batch_wait_ms", "50")) / 1000
+        )
+        self.timeout = int(os.environ.get("html_renderer_timeout", "120"))
+        self.jobs = queue.Queue()
+        self.slots = threading.Semaphore(self.processes)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.processes, thread_name_prefix="render"
+        )
+        self.lock = threading.Lock()
+        self.xvfb = None
+        self.environment = None
+        self.xvfb_starts = 0
+        self.reset_stats()
+        self.dispatcher = threading.Thread(
+            target=self._dispatch, name="render-dispatch", daemon=True
+        )
+        self.dispatcher.start()
+        logger.info(
+            f"HTML renderer: {self.processes} processes, batches of up to "
+            f"{self.batch_size}, display {self.display_mode}."
+        )
+
+    @property
+    def available(self):
+        """
+        False when wkhtmltopdf or Xvfb is not installed, in which case
+        documents are rendered with pdfkit.
+        """
+        return os.path.exists(self.binary) and (
+            self.display_mode == "none" or which("Xvfb") is not None
+        )
+
+    def _start_display(self):
+        display = 99
+        while os.path.exists(f"/tmp/.X{display}-lock"):
+            display += 1
+        self.xvfb = subprocess.Popen(
+            [
+                "Xvfb",
+                f":{display}",
+                "-screen",
+                "0",
+                "1024x768x24",
+                "-nolisten",
+                "tcp",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+        deadline = time.monotonic() + 10
+        while not os.path.exists(f"/tmp/.X11-unix/X{display}"):
+            if self.xvfb.poll() is not None or time.monotonic() > deadline:
+                self.xvfb.kill()
+                self.xvfb = None
+                raise OSError(f"Xvfb could not start on display :{display}")
+            time.sleep(0.05)
+        self.xvfb_starts += 1
+        self.environment = dict(os.environ, DISPLAY=f":{display}")
+        logger.info(f"Started Xvfb on display :{display}")
+
+    def _get_environment(self):
+        if self.display_mode == "none":
+            return None
+        with self.lock:
+            if self.xvfb is None or self.xvfb.poll() is not None:
+                self._start_display()
+            return self.environment
+
+    @staticmethod
+    def _command_line(input_file, output_file, options):
+        args = ["--quiet"]
+        for key, value in (options or {}).items():
+            if key == "quiet":
+                continue
+            args.append(f"--{key}")
+            if value:
+                args.append(str(value))
+        args.extend([input_file, output_file])
+        return " ".join(
+            '"' + arg.replace("\\", "\\\\").replace('"', '\\"') + '"' for arg in args
+        )
+
+    def _dispatch(self):
+        while True:
+            batch = [self.jobs.get()]
+            self.slots.acquire()
+            # Documents queued while waiting for a free process join the
+            # batch, then the batch waits briefly for more documents.
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(
+                        self.jobs.get(timeout=max(0, deadline - time.monotonic()))
+                    )
+                except queue.Empty:
+                    break
+            self.executor.submit(self._render_batch, batch)
+
+    @staticmethod
+    def _rendered(batch, done):
+        """
+        Returns the number of documents of the batch wkhtmltopdf is done
+        with, as it renders them in order.
+        """
+        for index in range(len(batch) - 1, done - 1, -1):
+            if os.path.exists(batch[index][1]):
+                return index + 1
+        return done
+
+    def _run_batch(self, batch):
+        """
+        Renders the batch with one wkhtmltopdf process, giving every document
+        html_renderer_timeout seconds from the end of the previous one.
+        Returns the index of the document that ran over (None when the
+        process finished) and the end of the stderr of the process.
+        """
+        commands = "".join(
+            self._command_line(input_file, output_file, options) + "\n"
+            for input_file, output_file, options, _ in batch
+        )
+        timed_out = None
+        with tempfile.TemporaryFile() as stderr_file:
+            process = subprocess.Popen(
+                [self.binary, "--read-args-from-stdin"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.DEVNULL,
+                stderr=stderr_file,
+                env=self._get_environment(),
+            )
+            try:
+                process.stdin.write(commands.encode())
+                process.stdin.close()
+                done = 0
+                deadline = time.monotonic() + self.timeout
+                while process.poll() is None:
+                    rendered = self._rendered(batch, done)
+                    if rendered > done:
+                        done = rendered
+                        deadline = time.monotonic() + self.timeout
+                    elif time.monotonic() > deadline:
+                        timed_out = done
+                        break
+                    time.sleep(0.05)
+            finally:
+                if process.poll() is None:
+                    process.kill()
+                    process.wait()
+            stderr_file.seek(0)
+            stderr = stderr_file.read()[-1000:].decode(errors="replace")
+        return timed_out, stderr
+
+    def _render_batch(self, batch):
+        start = time.perf_counter()
+        failures = 0
+        pending = batch
+        try:
+            while pending:
+                timed_out, stderr = self._run_batch(pending)
+                finished = pending if timed_out is None else pending[:timed_out]
+                for input_file, output_file, _, future in finished:
+                    if os.path.exists(output_file) and os.path.getsize(output_file):
+                        future.set_result(True)
+                    else:
+                        failures += 1
+                        future.set_exception(
+                            OSError(
+                                f"wkhtmltopdf could not render {input_file}: {stderr}"
+                            )
+                        )
+                if timed_out is None:
+                    break
+                # Only the document over its timeout fails, the rest
+                # of the batch is rendered by a new process.
+                input_file, _, _, future = pending[timed_out]
+                failures += 1
+                future.set_exception(
+                    OSError(
+                        f"wkhtmltopdf exceeded its {self.timeout}s timeout "
+                        f"rendering {input_file}"
+                    )
+                )
+                pending = pending[timed_out + 1 :]
+        except Exception as e:
+            for _, _, _, future in pending:
+                if not future.done():
+                    future.set_exception(e)
+                    failures += 1
+        finally:
+            self.slots.release()
+            end = time.perf_counter()
+            with self.lock:
+                self.batches += 1
+                self.documents += len(batch)
+                self.failures += failures
+                self.render_seconds += end - start
+                self.first_start = min(self.first_start or start, start)
+                self.last_end = max(self.last_end or end, end)
+
+    def render(self, input_file, output_file, options=None):
+        """
+        Renders input_file into the pdf output_file with the
+        wkhtmltopdf options, blocking until the pdf is written.
+        Raises OSError when the document cannot be rendered.
+        """
+        if not self.available:
+            pdfkit.from_file(input_file, output_file, options=options)
+            return True
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        future = concurrent.futures.Future()
+        self.jobs.put((input_file, output_file, options, future))
+        return future.result()
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                "documents": self.documents,
+                "failures": self.failures,
+                "batches": self.batches,
+                "xvfb_starts": self.xvfb_starts,
+            }
+            if self.batches:
+                stats["avg_batch_size"] = round(self.documents / self.batches, 2)
+                stats["avg_document_seconds"] = round(
+                    self.render_seconds / self.documents, 3
+                )
+            if self.last_end and self.last_end > self.first_start:
+                stats["documents_per_second"] = round(
+                    self.documents / (self.last_end - self.first_start), 2
+                )
+        return stats
+
+    def reset_stats(self):
+        with self.lock:
+            self.documents = 0
+            self.failures = 0
+            self.batches = 0
+            self.render_seconds = 0.0
+            self.first_start = None
+            self.last_end = None
+
+
+html_renderer = None
+html_renderer_lock = threading.Lock()
+
+
+def get_html_renderer():
+    """
+    Returns the html renderer of the container, created on first use.
+    """
+    global html_renderer
+
+    with html_renderer_lock:
+        if html_renderer is None:
+            html_renderer = HtmlRenderer()
+    return html_renderer
 
 
 def download_file(prefix, destination_pathname, bucket, client):
@@ -65,7 +623,7 @@ def create_pdf(file_path, pdf_file_name):
     """
     try:
         logger.info(f"Creating PDF for: {file_path}")
-        pdf_png = pytesseract.image_to_pdf_or_hocr(file_path)
+        pdf_png = get_ocr_engine().image_to_pdf(file_path)
 
         if not os.path.exists(os.path.dirname(pdf_file_name)):
             os.makedirs(os.path.dirname(pdf_file_name), exist_ok=True)
@@ -76,22 +634,62 @@ def create_pdf(file_path, pdf_file_name):
         return True
 
     except Exception as _:
-        exception_type, exception_value, exception_traceback = sys.exc_info()
-        traceback_string = traceback.format_exception(
-            exception_type, exception_value, exception_traceback
-        )
+        log_exception()
+        return False
 
-        err_msg = json.dumps(
-            {
-                "errorType": exception_type.__name__,
-                "errorMessage": str(exception_value),
-                "stackTrace": traceback_string,
-            }
-        )
-        logger.error(err_msg)
+
+def image_to_pdf_lossless(file_path, pdf_file_name):
+    """
+    Parameters
+    ----------
+    file_path: file path of the image
+    pdf_file_name: name of the output pdf file
+    Wraps the image in a pdf page without re-encoding it and without OCR.
+    Returns True if the pdf file is created
+    -------
+    """
+    try:
+        logger.info(f"Creating PDF without OCR for: {file_path}")
+        if not os.path.exists(os.path.dirname(pdf_file_name)):
+            os.makedirs(os.path.dirname(pdf_file_name), exist_ok=True)
+
+        with open(pdf_file_name, "wb") as f:
+            f.write(img2pdf.convert(file_path, rotation=img2pdf.Rotation.ifvalid))
+
+        return True
+
+    except Exception as _:
+        log_exception()
         return False
 
 
+def add_ocr_text_layer(file_path, pdf_file_name):
+    """
+    Parameters
+    ----------
+    file_path: file path of the image
+    pdf_file_name: single page pdf created by image_to_pdf_lossless
+    Overlays the invisible OCR text of the image on the existing page,
+    keeping the embedded image as it is.
+    """
+    text_pdf = get_ocr_engine().image_to_pdf(
+        file_path, extension="pdf", config="-c textonly_pdf=1"
+    )
+    text_page = PdfFileReader(BytesIO(text_pdf)).getPage(0)
+
+    with open(pdf_file_name, "rb") as f:
+        page = PdfFileReader(BytesIO(f.read())).getPage(0)
+
+    scale_x = float(page.mediaBox.getWidth()) / float(text_page.mediaBox.getWidth())
+    scale_y = float(page.mediaBox.getHeight()) / float(text_page.mediaBox.getHeight())
+    page.mergeTransformedPage(text_page, [scale_x, 0, 0, scale_y, 0, 0])
+
+    writer = PdfFileWriter()
+    writer.addPage(page)
+    with open(pdf_file_name, "wb") as f:
+        writer.write(f)
+
+
 def merge_pdf(pdfs, filename):
     """
     Parameters
@@ -167,243 +765,2154 @@ def update_image_dpi(image_file):
     temp_image.save(image_file, dpi=(300, 300))
 
 
-def process_document_folders(
-    s3_client, s3_input_file, input_file, pdf_file_name, s3_output_file, bucket_name
-):
+def is_ocr_normalize_enabled():
+    return os.environ.get("ocr_normalize", "false") == "true"
+
+
+def get_ocr_target_dpi():
+    return int(os.environ.get("ocr_target_dpi", "300"))
+
+
+# Resolutions outside this range are taken for missing metadata.
+OCR_DPI_RANGE = (50, 1200)
+# TIFF tag of the unit of XResolution and YResolution.
+TIFF_RESOLUTION_UNIT = 296
+
+
+def get_image_dpi(image, target_dpi):
     """
-    This will process all files in the Trigger folder
-    in a loop and put into Main S3.
-    Args:
-        s3_client boto3 object: S3 Session Client Object
-        trigger_folder str: the trigger folder in main S3 for
-        which the process will be executed.
+    Returns the horizontal resolution stored in the image, or target_dpi
+    when it is missing or implausible. Pillow reports (1, 1) for TIFFs
+    without resolution tags, and a TIFF resolution without unit is only
+    an aspect ratio.
+    """
+    dpi = image.info.get("dpi")
+    if not dpi or not dpi[0]:
+        return target_dpi
+    if image.format == "TIFF":
+        # 2 is inch and 3 centimeter, anything else has no absolute unit.
+        if image.tag_v2.get(TIFF_RESOLUTION_UNIT) not in (2, 3):
+            return target_dpi
+    if not OCR_DPI_RANGE[0] <= float(dpi[0]) <= OCR_DPI_RANGE[1]:
+        logger.info(f"Ignoring implausible resolution {dpi[0]} dpi")
+        return target_dpi
+    return float(dpi[0])
+
+
+def resample_for_ocr(image, target_dpi):
     """
-    global unprocess_file
-    global unprocess_bucket
+    Converts the image to grayscale and resamples it to target_dpi
+    based on the resolution stored in the image (assumed to be
+    target_dpi when missing). The page is kept under ocr_max_megapixels.
+    """
+    gray = image.convert("L")
+    x, y = gray.size
+    scale = target_dpi / get_image_dpi(image, target_dpi)
+    max_pixels = float(os.environ.get("ocr_max_megapixels", "60")) * 1e6
+    if x * y * scale * scale > max_pixels:
+        scale = (max_pixels / (x * y)) ** 0.5
+    if abs(scale - 1) > 0.05:
+        gray = gray.resize(
+            (max(1, int(x * scale)), max(1, int(y * scale))), Image.LANCZOS
+        )
+    return gray
 
-    unprocess_file = s3_input_file
-    unprocess_bucket = bucket_name
 
-    Success_Flag = True
+def otsu_thresholds(histograms):
+    """
+    Parameters
+    ----------
+    histograms: array of shape (pages, 256) with the grey level counts
+    Returns
+    -------
+    Otsu threshold of every page
+    """
+    hist = histograms.astype(np.float64)
+    levels = np.arange(256)
+    weight_bg = np.cumsum(hist, axis=1)
+    weight_fg = weight_bg[:, -1:] - weight_bg
+    cum_mean = np.cumsum(hist * levels, axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_bg = cum_mean / weight_bg
+        mean_fg = (cum_mean[:, -1:] - cum_mean) / weight_fg
+        between = weight_bg * weight_fg * (mean_bg - mean_fg) ** 2
+    return np.nan_to_num(between).argmax(axis=1)
+
+
+def crop_box(ink, margin):
+    """
+    Returns the bounding box of the ink pixels grown by margin,
+    or None for a blank page.
+    """
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    if not rows.size:
+        return None
+    height, width = ink.shape
+    return (
+        max(0, cols[0] - margin),
+        max(0, rows[0] - margin),
+        min(width, cols[-1] + 1 + margin),
+        min(height, rows[-1] + 1 + margin),
+    )
 
-    download_file(
-        prefix=s3_input_file,
-        destination_pathname=input_file,
-        bucket=bucket_name,
-        client=s3_client,
+
+def normalize_pages(pages, target_dpi):
+    """
+    Parameters
+    ----------
+    pages: grayscale pages already resampled to target_dpi
+    target_dpi: effective resolution of the pages
+    Binarizes the pages with per page Otsu thresholds and crops the blank
+    margins. Pages of the same size are processed as one array.
+    Returns
+    -------
+    bilevel pages in the same order
+    """
+    margin = target_dpi // 20
+    normalized = [None] * len(pages)
+    by_size = {}
+    for i, page in enumerate(pages):
+        by_size.setdefault(page.size, []).append(i)
+
+    for indexes in by_size.values():
+        batch = np.stack([np.asarray(pages[i], dtype=np.uint8) for i in indexes])
+        histograms = np.stack(
+            [np.bincount(page.ravel(), minlength=256) for page in batch]
+        )
+        ink = batch <= otsu_thresholds(histograms)[:, None, None]
+        for i, page_ink in zip(indexes, ink):
+            page = Image.fromarray(~page_ink)
+            box = crop_box(page_ink, margin)
+            normalized[i] = page.crop(box) if box else page
+    return normalized
+
+
+def prepare_image_for_ocr(image_file):
+    """
+    Parameters
+    ----------
+    image_file: file path of the image
+    Returns
+    -------
+    file path of the image to OCR. With ocr_normalize the image is
+    resampled to ocr_target_dpi, binarized and cropped into a new png,
+    otherwise only the dpi of the image is updated.
+    """
+    if not is_ocr_normalize_enabled():
+        update_image_dpi(image_file)
+        return image_file
+
+    logger.info(f"Normalizing image for OCR: {image_file}")
+    target_dpi = get_ocr_target_dpi()
+    with Image.open(image_file) as image:
+        page = normalize_pages([resample_for_ocr(image, target_dpi)], target_dpi)[0]
+    filename, _ = os.path.splitext(image_file)
+    page.save(
+        normalized_file := "".join([filename, "_ocr.png"]),
+        dpi=(target_dpi, target_dpi),
     )
+    return normalized_file
 
-    converted = False
 
-    try:
-        logger.info(f"Processing:{input_file}")
-        filename, _ = os.path.splitext(input_file)
+def get_converter_name(input_file, ocr_mode="inline"):
+    """
+    Parameters
+    ----------
+    input_file: local path of the input document
+    ocr_mode: OCR mode of the case
+    Returns
+    -------
+    name of the converter chosen from the extension of the file,
+    available before the file is downloaded
+    """
+    converter = converter_registry.for_extension(input_file, ocr_mode)
+    return converter.name if converter is not None else "unknown"
 
-        if input_file.endswith(".pdf"):
-            copyfile(input_file, pdf_file_name)
-            converted = True
 
-        elif input_file.endswith(".mif"):
-            copyfile(input_file, temp_mif_file := "".join([filename, ".txt"]))
-            pdfkit.from_file(
-                temp_mif_file,
-                pdf_file_name,
-                options={"quiet": ""},
-            )
-            converted = True
+class EfsConversionCache:
+    """
+    Conversion cache kept as flat files in a directory on EFS.
+    Entries are evicted least recently used first.
+    """
 
-        elif input_file.endswith(".txt"):
-            pdf_txt = get_pdf_object(11)
-            with open(input_file, "rb") as f:
-                lines = f.readlines()
-            for line in lines:
-                pdf_txt.write(5, str(line))
-            pdf_txt.output(pdf_file_name)
-            converted = True
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
 
-        elif input_file.lower().endswith("".join([".png", FILE_PATTERN_TO_INCLUDE])):
-            copyfile(
-                input_file,
-                temp_unredacted_file := "".join(
-                    [filename, FILE_PATTERN_TO_INCLUDE, ".png"]
-                ),
-            )
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".pdf")
 
-            update_image_dpi(temp_unredacted_file)
-            converted = create_pdf(temp_unredacted_file, pdf_file_name)
+    def _temp_path(self, key):
+        return "".join(
+            [self._path(key), ".", str(os.getpid()), "_", str(threading.get_ident())]
+        )
 
-        elif input_file.lower().endswith("".join([".jpeg", FILE_PATTERN_TO_INCLUDE])):
-            copyfile(
-                input_file,
-                temp_unredacted_file := "".join(
-                    [filename, FILE_PATTERN_TO_INCLUDE, ".jpeg"]
-                ),
-            )
+    def publish(self, key, s3_client, bucket, s3_output_file):
+        """
+        Uploads the cached pdf to s3_output_file.
+        Returns True on a cache hit.
+        """
+        cached_file = self._path(key)
+        if not os.path.isfile(cached_file):
+            return False
+        os.utime(cached_file)
+        s3_client.upload_file(cached_file, bucket, s3_output_file)
+        return True
 
-            update_image_dpi(temp_unredacted_file)
-            converted = create_pdf(temp_unredacted_file, pdf_file_name)
+    def put(self, key, pdf_file_name):
+        temp_file = self._temp_path(key)
+        copyfile(pdf_file_name, temp_file)
+        os.replace(temp_file, self._path(key))
 
-        elif input_file.lower().endswith("".join([".jpg", FILE_PATTERN_TO_INCLUDE])):
-            copyfile(
-                input_file,
-                temp_unredacted_file := "".join(
-                    [filename, FILE_PATTERN_TO_INCLUDE, ".jpg"]
-                ),
-            )
+    def put_from_s3(self, key, s3_client, bucket, s3_key):
+        temp_file = self._temp_path(key)
+        s3_client.download_file(bucket, s3_key, temp_file)
+        os.replace(temp_file, self._path(key))
+
+    def get_bytes(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        os.utime(self._path(key))
+        return data
+
+    def put_bytes(self, key, data):
+        temp_file = self._temp_path(key)
+        with open(temp_file, "wb") as f:
+            f.write(data)
+        os.replace(temp_file, self._path(key))
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.is_file() and entry.name.endswith(".pdf"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total_size -= size
+            except FileNotFoundError:
+                pass
 
-            update_image_dpi(temp_unredacted_file)
-            converted = create_pdf(temp_unredacted_file, pdf_file_name)
 
-        elif input_file.lower().endswith((".png", ".jpg", ".jpeg", ".gif")):
-            update_image_dpi(input_file)
-            converted = create_pdf(input_file, pdf_file_name)
+class S3ConversionCache:
+    """
+    Conversion cache kept under a prefix in S3.
+    Hits are published with a server side copy.
+    Entries are evicted oldest first, at most once every
+    conversion_cache_evict_interval seconds as listing the prefix
+    gets slow once the cache is large.
+    """
 
-        elif input_file.lower().endswith((".tif", ".TIF", ".tiff")):
-            converted = tiff_to_pdf(input_file, pdf_file_name)
+    def __init__(self, s3_client, bucket, prefix, max_bytes):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/") + "/"
+        self.max_bytes = max_bytes
+        self.evict_interval = int(
+            os.environ.get("conversion_cache_evict_interval", "3600")
+        )
+        self.next_evict = 0
 
-        elif input_file.endswith((".bmp")):
-            update_image_dpi(input_file)
-            Image.open(input_file).save(pdf_file_name)
-            converted = True
+    def _key(self, key):
+        return "".join([self.prefix, key, ".pdf"])
 
-        elif input_file.endswith(".svg"):
-            update_image_dpi(input_file)
-            drawing = svg2rlg(input_file, resolve_entities=True)
-            renderPM.drawToFile(
-                drawing, temp_file := "".join([filename, ".png"]), fmt="PNG"
+    def publish(self, key, s3_client, bucket, s3_output_file):
+        """
+        Copies the cached pdf to s3_output_file.
+        Returns True on a cache hit.
+        """
+        try:
+            s3_client.copy_object(
+                Bucket=bucket,
+                Key=s3_output_file,
+                CopySource={"Bucket": self.bucket, "Key": self._key(key)},
             )
-            converted = create_pdf(temp_file, pdf_file_name)
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return False
+            raise
+        return True
 
-        elif input_file.endswith(
-            (".html", ".htm", ".xml", ".mht", ".mhtml", ".csv", ".eml")
-        ):
-            if input_file.endswith("mht"):
-                copyfile(input_file, temp_file := "".join([filename, ".html"]))
-                pdfkit.from_file(
-                    temp_file,
-                    pdf_file_name,
-                    options={
-                        "enable-local-file-access": "",
-                        "load-error-handling": "ignore",
-                    },
-                )
-                converted = True
+    def put(self, key, pdf_file_name):
+        self.s3_client.upload_file(pdf_file_name, self.bucket, self._key(key))
 
-            elif input_file.endswith(".csv"):
-                df = pd.read_csv(input_file)
-                df.to_html(temp_file := "".join([filename, ".html"]))
-                pdfkit.from_file(
-                    temp_file,
-                    pdf_file_name,
-                    options={"enable-local-file-access": "", "quiet": ""},
-                )
-                converted = True
+    def put_from_s3(self, key, s3_client, bucket, s3_key):
+        s3_client.copy_object(
+            Bucket=self.bucket,
+            Key=self._key(key),
+            CopySource={"Bucket": bucket, "Key": s3_key},
+        )
 
-            elif input_file.endswith((".xls", ".xlsx")):
-                temp_pdfs = []
-                xls = pd.ExcelFile(input_file)
-                for sheet_name in xls.sheet_names:
-                    df = pd.read_excel(input_file, sheet_name=sheet_name)
-                    df.to_html(
-                        temp_file := "".join([filename, "_", str(sheet_name), ".html"])
-                    )
-                    pdfkit.from_file(
-                        temp_file,
-                        temp_pdf := "".join([filename, "_", str(sheet_name), ".pdf"]),
-                        options={"enable-local-file-access": "", "quiet": ""},
-                    )
-                    temp_pdfs.append(temp_pdf)
-                merge_pdf(temp_pdfs, pdf_file_name)
-                converted = True
+    def get_bytes(self, key):
+        try:
+            result = self.s3_client.get_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        return result["Body"].read()
+
+    def put_bytes(self, key, data):
+        self.s3_client.put_object(Body=data, Bucket=self.bucket, Key=self._key(key))
+
+    def is_evict_due(self):
+        """
+        The time of the last eviction of any container is the
+        LastModified of the marker object under the prefix.
+        """
+        if time.monotonic() < self.next_evict:
+            return False
+        self.next_evict = time.monotonic() + self.evict_interval
+
+        marker = "".join([self.prefix, "last_evicted"])
+        try:
+            head = self.s3_client.head_object(Bucket=self.bucket, Key=marker)
+            age = time.time() - head["LastModified"].timestamp()
+            if age < self.evict_interval:
+                self.next_evict = time.monotonic() + self.evict_interval - age
+                return False
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                raise
+        self.s3_client.put_object(Body=b"", Bucket=self.bucket, Key=marker)
+        return True
 
-            elif input_file.endswith((".eml")):
-                copyfile(input_file, temp_file := "".join([filename, ".txt"]))
-                with open(temp_file, "rb") as myfile:
-                    head = list(islice(myfile, 1000))
-                with open(temp_file, mode="wb") as f2:
-                    for item in head:
-                        if item.strip() == "Content-Disposition: attachment;":
-                            break
-                        f2.write(item)
-                pdfkit.from_file(
-                    temp_file,
-                    pdf_file_name,
-                )
-                converted = True
-            else:
-                try:
-                    pdfkit.from_file(
-                        input_file,
-                        pdf_file_name,
-                        options={"enable-local-file-access": "", "quiet": ""},
-                    )
-                    converted = True
-                except Exception as _:
-                    logger.info(f"Trying again: {filename}")
-                    copyfile(input_file, temp_file := "".join([filename, ".txt"]))
-                    pdfkit.from_file(
-                        temp_file,
-                        pdf_file_name,
-                        options={"quiet": ""},
-                    )
+    def evict(self):
+        if not self.is_evict_due():
+            return
+
+        entries = []
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for item in page.get("Contents", []):
+                if item["Key"].endswith(".pdf"):
+                    entries.append((item["LastModified"], item["Size"], item["Key"]))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+            total_size -= size
+
+
+conversion_cache = None
 
-        elif input_file.endswith(".msg"):
-            msg_properties = []
-            msg = extract_msg.Message(input_file)
-            try:
-                msg_properties.extend(
-                    [
-                        msg.date,
-                        "",
-                        "".join(filter(None, ["To:", msg.to])),
-                        "",
-                        msg.subject,
-                        "".join(filter(None, ["", msg.Body])),
-                        "".join(filter(None, ["From:", msg.sender])),
-                    ]
-                )
 
+def get_conversion_cache(s3_client, bucket_name):
+    """
+    Builds the conversion cache configured through the environment.
+    conversion_cache_path selects an EFS directory and
+    conversion_cache_s3_prefix an S3 prefix in conversion_cache_bucket.
+    Returns None when no cache is configured.
+    """
+    global conversion_cache
+
+    if conversion_cache is not None:
+        return conversion_cache
+
+    max_bytes = int(os.environ.get("conversion_cache_max_mb", "10240")) * 1024 * 1024
+    if os.environ.get("conversion_cache_path"):
+        conversion_cache = EfsConversionCache(
+            os.environ["conversion_cache_path"], max_bytes
+        )
+    elif os.environ.get("conversion_cache_s3_prefix"):
+        conversion_cache = S3ConversionCache(
+            s3_client,
+            os.environ.get("conversion_cache_bucket", bucket_name),
+            os.environ["conversion_cache_s3_prefix"],
+            max_bytes,
+        )
+    return conversion_cache
+
+
+class PageOcrCache:
+    """
+    Cache of single page OCR pdfs keyed on a hash of the decoded pixels.
+    A local LRU serves repeated pages within the container and the optional
+    shared store (an EFS directory or S3 prefix) serves them across
+    invocations.
+    """
+
+    def __init__(self, max_local_bytes, shared_store=None):
+        self.max_local_bytes = max_local_bytes
+        self.shared_store = shared_store
+        self.entries = OrderedDict()
+        self.local_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"local_hits": 0, "shared_hits": 0, "misses": 0}
+
+    @staticmethod
+    def page_key(image, options=None):
+        digest = hashlib.sha256(
+            ":".join(
+                [
+                    image.mode,
+                    str(image.size),
+                    CONVERTER_VERSIONS["tesseract"],
+                    str(options),
+                ]
+            ).encode()
+        )
+        digest.update(image.tobytes())
+        return digest.hexdigest()
+
+    def _put_local(self, key, pdf):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = pdf
+            self.local_bytes += len(pdf)
+            while self.local_bytes > self.max_local_bytes and self.entries:
+                _, evicted = self.entries.popitem(last=False)
+                self.local_bytes -= len(evicted)
+
+    def get(self, key):
+        with self.lock:
+            pdf = self.entries.get(key)
+            if pdf is not None:
+                self.entries.move_to_end(key)
+                self.stats["local_hits"] += 1
+                return pdf
+
+        if self.shared_store is not None:
+            try:
+                pdf = self.shared_store.get_bytes(key)
             except Exception as _:
-                msg_properties.extend(
-                    [
-                        msg.date,
-                        "",
-                        "".join(filter(None, ["To:", msg.to])),
-                        "",
-                        msg.subject,
-                        "".join(filter(None, ["From:", msg.sender])),
-                    ]
-                )
+                log_exception()
+                pdf = None
+            if pdf is not None:
+                self._put_local(key, pdf)
+                with self.lock:
+                    self.stats["shared_hits"] += 1
+                return pdf
+
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, key, pdf):
+        self._put_local(key, pdf)
+        if self.shared_store is not None:
+            try:
+                self.shared_store.put_bytes(key, pdf)
+            except Exception as _:
+                log_exception()
 
-            pdf_email = get_pdf_object(12)
+    def hit_rate(self):
+        with self.lock:
+            stats = dict(self.stats)
+        lookups = sum(stats.values())
+        hits = stats["local_hits"] + stats["shared_hits"]
+        stats["hit_rate"] = round(hits / lookups, 3) if lookups else 0.0
+        return stats
 
-            for i in msg_properties:
-                pdf_email.write(5, str(i))
-                pdf_email.ln()
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {"local_hits": 0, "shared_hits": 0, "misses": 0}
 
-            pdf_email.output(pdf_file_name)
-            converted = True
 
-        elif input_file.endswith((".doc", ".docx")):
-            lambda_client = boto3.client("lambda")
-            payload = json.dumps(
-                {"s3_input_file": s3_input_file, "s3_output_file": s3_output_file}
+page_ocr_cache = None
+page_ocr_cache_lock = threading.Lock()
+
+
+def get_page_ocr_cache():
+    """
+    Builds the page OCR cache configured through the environment.
+    ocr_page_cache=true enables the local LRU of ocr_page_cache_local_mb,
+    ocr_page_cache_path (EFS directory) or ocr_page_cache_s3_prefix in
+    ocr_page_cache_bucket add the shared tier.
+    Returns None when the page cache is disabled.
+    """
+    global page_ocr_cache
+
+    if os.environ.get("ocr_page_cache", "false") != "true":
+        return None
+
+    with page_ocr_cache_lock:
+        if page_ocr_cache is None:
+            max_bytes = (
+                int(os.environ.get("ocr_page_cache_max_mb", "10240")) * 1024 * 1024
             )
-            logger.info("Invoking Doc Processing Lambda")
-            response = lambda_client.invoke(
-                FunctionName=os.environ["doc_to_pdf_arn"],
-                InvocationType="RequestResponse",
-                Payload=payload,
+            shared_store = None
+            if os.environ.get("ocr_page_cache_path"):
+                shared_store = EfsConversionCache(
+                    os.environ["ocr_page_cache_path"], max_bytes
+                )
+            elif os.environ.get("ocr_page_cache_s3_prefix"):
+                shared_store = S3ConversionCache(
+                    boto3.Session().client(service_name="s3"),
+                    os.environ.get(
+                        "ocr_page_cache_bucket", os.environ["main_s3_bucket"]
+                    ),
+                    os.environ["ocr_page_cache_s3_prefix"],
+                    max_bytes,
+                )
+            page_ocr_cache = PageOcrCache(
+                int(os.environ.get("ocr_page_cache_local_mb", "64")) * 1024 * 1024,
+                shared_store,
             )
+    return page_ocr_cache
 
-            if json.loads(response["Payload"].read())["response"]:
-                logger.info(f"{input_file} Processed")
 
-    except Exception as e:
-
-        if "Done" not in str(e):
-            if input_file.endswith("mht"):
-                converted = True
+def get_conversion_settings(ocr_mode):
+    """
+    Returns the settings that change the output of a conversion,
+    as strings to fold into the conversion cache key.
+    """
+    return [
+        ocr_mode,
+        str(is_ocr_normalize_enabled()),
+        str(get_ocr_target_dpi()),
+    ]
+
+
+def get_conversion_cache_key(
+    s3_client,
+    bucket_name,
+    s3_input_file,
+    input_file,
+    ocr_mode="inline",
+    converter=None,
+):
+    """
+    Parameters
+    ----------
+    s3_client: S3 Session Client Object
+    bucket_name: bucket of the input document
+    s3_input_file: key of the input document
+    input_file: local path of the input document
+    ocr_mode: OCR mode of the case
+    converter: name of the converter selected for the downloaded file,
+    defaults to the one chosen from the extension
+    Returns
+    -------
+    cache key built from the content hash of the input, the converter used
+    and the settings of the conversion
+
+    The content hash is the SHA-256 checksum S3 keeps for objects uploaded
+    with one. Other objects fall back to their ETag, the MD5 of the content
+    for single part uploads. The ETag of multipart or SSE-KMS uploads is not
+    an MD5 of the content, so equal inputs may get different keys and miss
+    the cache, but different inputs never share one.
+    """
+    head = s3_client.head_object(
+        Bucket=bucket_name, Key=s3_input_file, ChecksumMode="ENABLED"
+    )
+    content_hash = head.get("ChecksumSHA256") or head["ETag"].strip('"')
+    if converter is None:
+        converter = get_converter_name(input_file, ocr_mode)
+    return hashlib.sha256(
+        ":".join(
+            [
+                content_hash,
+                str(head["ContentLength"]),
+                converter,
+                CONVERTER_VERSIONS.get(converter, "1"),
+            ]
+            + get_conversion_settings(ocr_mode)
+        ).encode()
+    ).hexdigest()
+
+
+def create_unprocessed_file(bucket_name, s3_input_file):
+    """
+    Parameters
+    ----------
+    bucket_name: bucket of the input document
+    s3_input_file: key of the document that could not be converted
+    """
+    session = boto3.Session()
+    s3_client = session.client(service_name="s3")
+    s3_client.put_object(
+        Body="",
+        Bucket=bucket_name,
+        Key=s3_input_file.replace(
+            s3_input_file.split("/")[1], "doc_pdf/unprocessed_files"
+        ),
+    )
+
+
+def lookup_conversion_cache(
+    s3_client,
+    s3_input_file,
+    input_file,
+    s3_output_file,
+    bucket_name,
+    ocr_mode,
+    converter=None,
+):
+    """
+    Parameters
+    ----------
+    s3_client: S3 Session Client Object
+    s3_input_file: key of the input document
+    input_file: local path of the input document
+    s3_output_file: key of the converted pdf
+    bucket_name: bucket of the documents
+    ocr_mode: OCR mode of the case
+    converter: name of the converter selected for the downloaded file
+    Returns
+    -------
+    whether the cached pdf was published and the cache key to store
+    the converted pdf under (None when caching is disabled)
+    """
+    try:
+        cache = get_conversion_cache(s3_client, bucket_name)
+        if cache is None:
+            return False, None
+        cache_key = get_conversion_cache_key(
+            s3_client, bucket_name, s3_input_file, input_file, ocr_mode, converter
+        )
+        if cache.publish(cache_key, s3_client, bucket_name, s3_output_file):
+            with stats_lock:
+                conversion_cache_stats["hits"] += 1
+            logger.info(f"Conversion cache hit for: {s3_input_file}")
+            return True, cache_key
+        with stats_lock:
+            conversion_cache_stats["misses"] += 1
+        return False, cache_key
+    except Exception as _:
+        log_exception()
+        return False, None
+
+
+def is_valid_pdf_object(s3_client, bucket_name, s3_key):
+    """
+    Checks the header and trailer of a pdf in S3 with two ranged reads
+    instead of downloading the whole object.
+    """
+    header = s3_client.get_object(Bucket=bucket_name, Key=s3_key, Range="bytes=0-1023")
+    trailer = s3_client.get_object(Bucket=bucket_name, Key=s3_key, Range="bytes=-1024")
+    return b"%PDF-" in header["Body"].read() and b"%%EOF" in trailer["Body"].read()
+
+
+def copy_pdf_passthrough(s3_client, s3_input_file, s3_output_file, bucket_name):
+    """
+    Publishes a pdf input with a server side copy. Objects above
+    multipart_copy_threshold_mb are copied in parts.
+    Returns the success flag of the input, or None when it failed the
+    pdf_passthrough_validate check and has to be converted instead,
+    as its content may be of another type than its extension.
+    """
+    try:
+        if os.environ.get("pdf_passthrough_validate", "false") == "true":
+            if not is_valid_pdf_object(s3_client, bucket_name, s3_input_file):
+                logger.info(f"Invalid PDF: {s3_input_file}. Converting it.")
+                return None
+
+        threshold = int(os.environ.get("multipart_copy_threshold_mb", "100"))
+        s3_client.copy(
+            {"Bucket": bucket_name, "Key": s3_input_file},
+            bucket_name,
+            s3_output_file,
+            Config=TransferConfig(
+                multipart_threshold=threshold * 1024 * 1024,
+                multipart_chunksize=threshold * 1024 * 1024,
+            ),
+        )
+        logger.info(f"Copied: {s3_input_file} to {s3_output_file}")
+        return True
+
+    except Exception as _:
+        log_exception()
+        logger.info("Creating Unprocessed File.")
+        create_unprocessed_file(bucket_name, s3_input_file)
+        return False
+
+
+def publish_without_conversion(
+    s3_client, s3_input_file, input_file, s3_output_file, bucket_name, ocr_mode
+):
+    """
+    Publishes the pdf for an input without downloading it, with a server side
+    copy for pdf inputs or from the conversion cache for the others.
+    Returns
+    -------
+    success flag of the input when it was published (None otherwise) and the
+    cache key to store the converted pdf under
+    """
+    if (
+        input_file.endswith(".pdf")
+        and os.environ.get("pdf_passthrough", "true") == "true"
+    ):
+        published = copy_pdf_passthrough(
+            s3_client, s3_input_file, s3_output_file, bucket_name
+        )
+        if published is not None:
+            return published, None
+
+    cache_hit, cache_key = lookup_conversion_cache(
+        s3_client, s3_input_file, input_file, s3_output_file, bucket_name, ocr_mode
+    )
+    if cache_hit and not defer_ocr_of_cache_hit(
+        s3_client,
+        s3_input_file,
+        s3_output_file,
+        bucket_name,
+        ocr_mode,
+        converter_registry.for_extension(input_file, ocr_mode),
+    ):
+        cache_hit = False
+    return (True if cache_hit else None), cache_key
+
+
+def publish_from_sniffed_cache(
+    s3_client,
+    s3_input_file,
+    input_file,
+    s3_output_file,
+    bucket_name,
+    ocr_mode,
+    cache_key,
+):
+    """
+    Looks the downloaded input up in the conversion cache again when its
+    content selects another converter than its extension did, as the
+    cache key names the converter the pdf is created with.
+    Returns
+    -------
+    the same as publish_without_conversion
+    """
+    if cache_key is None:
+        return None, None
+    converter = converter_registry.select(input_file, ocr_mode)
+    if converter is None or converter.name == get_converter_name(input_file, ocr_mode):
+        return None, cache_key
+
+    cache_hit, cache_key = lookup_conversion_cache(
+        s3_client,
+        s3_input_file,
+        input_file,
+        s3_output_file,
+        bucket_name,
+        ocr_mode,
+        converter.name,
+    )
+    if cache_hit and not defer_ocr_of_cache_hit(
+        s3_client, s3_input_file, s3_output_file, bucket_name, ocr_mode, converter
+    ):
+        cache_hit = False
+    return (True if cache_hit else None), cache_key
+
+
+def defer_ocr_of_cache_hit(
+    s3_client, s3_input_file, s3_output_file, bucket_name, ocr_mode, converter
+):
+    """
+    The cached pdf of a converter that defers OCR has no text layer,
+    so a hit leaves the same OCR job as the conversion would have.
+    Returns False when the job could not be created, the input is then
+    converted as on a cache miss.
+    """
+    if converter is None or not converter.defers_ocr or ocr_mode != "deferred":
+        return True
+    try:
+        create_ocr_job(s3_client, bucket_name, s3_input_file, s3_output_file)
+        return True
+    except Exception as _:
+        log_exception()
+        return False
+
+
+def get_ocr_job_key(s3_output_file):
+    return "".join(
+        [s3_output_file.replace("/doc_pdf/", "/doc_pdf/ocr_pending/", 1), ".json"]
+    )
+
+
+def create_ocr_job(s3_client, bucket_name, s3_input_file, s3_output_file):
+    """
+    Leaves a job for ocr_lambda_handler to add the text layer
+    to a pdf created without OCR.
+    """
+    s3_client.put_object(
+        Body=json.dumps(
+            {"s3_input_file": s3_input_file, "s3_output_file": s3_output_file}
+        ),
+        Bucket=bucket_name,
+        Key=get_ocr_job_key(s3_output_file),
+    )
+    logger.info(f"OCR deferred for: {s3_output_file}")
+
+
+def process_document_folders(
+    s3_client,
+    s3_input_file,
+    input_file,
+    pdf_file_name,
+    s3_output_file,
+    bucket_name,
+    ocr_mode="inline",
+):
+    """
+    This will process all files in the Trigger folder
+    in a loop and put into Main S3.
+    Args:
+        s3_client boto3 object: S3 Session Client Object
+        trigger_folder str: the trigger folder in main S3 for
+        which the process will be executed.
+        ocr_mode str: OCR mode of the case, one of OCR_MODES
+    """
+    published, cache_key = publish_without_conversion(
+        s3_client, s3_input_file, input_file, s3_output_file, bucket_name, ocr_mode
+    )
+    if published is not None:
+        return published
+
+    download_file(
+        prefix=s3_input_file,
+        destination_pathname=input_file,
+        bucket=bucket_name,
+        client=s3_client,
+    )
+    published, cache_key = publish_from_sniffed_cache(
+        s3_client,
+        s3_input_file,
+        input_file,
+        s3_output_file,
+        bucket_name,
+        ocr_mode,
+        cache_key,
+    )
+    if published is not None:
+        return published
+
+    converted, Success_Flag = convert_document_with_limits(
+        s3_client,
+        s3_input_file,
+        input_file,
+        pdf_file_name,
+        s3_output_file,
+        bucket_name,
+        cache_key,
+        ocr_mode,
+    )
+
+    return (
+        upload_converted_file(
+            s3_client,
+            s3_input_file,
+            input_file,
+            pdf_file_name,
+            s3_output_file,
+            bucket_name,
+            cache_key,
+            converted,
+        )
+        and Success_Flag
+    )
+
+
+def format_cell(value):
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ""
+    # The core pdf fonts only cover latin-1.
+    return str(value).encode("latin-1", "replace").decode("latin-1")
+
+
+class TablePdfWriter:
+    """
+    Writes the rows of a table to pdf as they are read, repeating the
+    header row on every landscape page. A new part file is started every
+    table_pages_per_part pages and the parts are merged on close, so that
+    memory does not grow with the number of rows.
+    """
+
+    def __init__(self, pdf_file_name, header, sample_rows, font_size=7):
+        self.pdf_file_name = pdf_file_name
+        self.pages_per_part = int(os.environ.get("table_pages_per_part", "200"))
+        self.font_size = font_size
+        self.line_height = font_size * 0.3528 * 1.4
+        self.margin = 10
+        self.parts = []
+        self.pdf = None
+        self.pages_in_part = 0
+
+        columns = max([len(header)] + [len(row) for row in sample_rows])
+        self.header = [format_cell(value) for value in header] + [""] * (
+            columns - len(header)
+        )
+        self.widths, self.max_chars = self._column_widths(sample_rows, columns)
+        self._new_part()
+
+    def _column_widths(self, sample_rows, columns):
+        page_width = 297 - 2 * self.margin
+        lengths = [max(4, min(40, len(value))) for value in self.header]
+        for row in sample_rows:
+            for column, value in enumerate(row):
+                lengths[column] = max(lengths[column], min(40, len(format_cell(value))))
+        total = sum(lengths) or 1
+        widths = [page_width * length / total for length in lengths]
+        # Approximate average width of an Arial character in mm.
+        char_width = self.font_size * 0.3528 * 0.55
+        return widths, [max(1, int(width / char_width)) for width in widths]
+
+    def _new_part(self):
+        self.pdf = FPDF(orientation="L", format="A4")
+        self.pdf.set_auto_page_break(False)
+        self.pdf.set_margins(self.margin, self.margin)
+        self.pages_in_part = 0
+
+    def _flush_part(self):
+        part = f"{self.pdf_file_name}.part{len(self.parts)}.pdf"
+        self.pdf.output(part)
+        self.parts.append(part)
+
+    def _add_page(self):
+        if self.pages_in_part == self.pages_per_part:
+            self._flush_part()
+            self._new_part()
+        self.pdf.add_page()
+        self.pages_in_part += 1
+        self.pdf.set_font("Arial", style="B", size=self.font_size)
+        for width, max_chars, value in zip(self.widths, self.max_chars, self.header):
+            self.pdf.cell(width, self.line_height, value[:max_chars], border="B")
+        self.pdf.ln()
+        self.pdf.set_font("Arial", size=self.font_size)
+
+    def write_rows(self, rows):
+        bottom = self.pdf.h - self.margin - self.line_height
+        for row in rows:
+            if self.pages_in_part == 0 or self.pdf.get_y() > bottom:
+                self._add_page()
+            for width, max_chars, value in zip(self.widths, self.max_chars, row):
+                self.pdf.cell(width, self.line_height, format_cell(value)[:max_chars])
+            self.pdf.ln()
+
+    def close(self):
+        if self.pages_in_part == 0:
+            self._add_page()
+        self._flush_part()
+        if len(self.parts) == 1:
+            os.replace(self.parts[0], self.pdf_file_name)
+        else:
+            merge_pdf(self.parts, self.pdf_file_name)
+        return True
+
+
+def csv_rows(input_file, encoding):
+    """
+    Yields the non blank rows of a csv file as lists of strings,
+    however many fields each row has.
+    """
+    # Fields are not limited in size, as with the pandas reader.
+    csv.field_size_limit(sys.maxsize)
+    with open(input_file, encoding=encoding, errors="replace", newline="") as f:
+        for row in csv.reader(f):
+            if row:
+                yield row
+
+
+def csv_to_pdf(input_file, pdf_file_name):
+    """
+    Parameters
+    ----------
+    input_file: csv file, streamed twice: once for the widest row so that
+    ragged rows keep all their fields, once to write the rows
+    pdf_file_name: the pdf file to be written
+    Returns True if the pdf file is created
+    -------
+    """
+    encoding = detect_text_encoding(input_file)
+    columns = max((len(row) for row in csv_rows(input_file, encoding)), default=0)
+    rows = csv_rows(input_file, encoding)
+    header = next(rows, [])
+    sample_rows = list(islice(rows, 100))
+    writer = TablePdfWriter(
+        pdf_file_name, header + [""] * (columns - len(header)), sample_rows
+    )
+    writer.write_rows(sample_rows)
+    writer.write_rows(rows)
+    return writer.close()
+
+
+def excel_sheet_rows(input_file, sheet_name):
+    """
+    Yields the rows of a sheet as tuples. xlsx workbooks are streamed
+    with openpyxl in read-only mode, older formats are read with pandas.
+    """
+    if zipfile.is_zipfile(input_file):
+        workbook = openpyxl.load_workbook(input_file, read_only=True, data_only=True)
+        try:
+            yield from workbook[sheet_name].iter_rows(values_only=True)
+        finally:
+            workbook.close()
+    else:
+        df = pd.read_excel(input_file, sheet_name=sheet_name, header=None, dtype=str)
+        yield from df.itertuples(index=False, name=None)
+
+
+def excel_sheet_names(input_file):
+    if zipfile.is_zipfile(input_file):
+        workbook = openpyxl.load_workbook(input_file, read_only=True)
+        try:
+            return workbook.sheetnames
+        finally:
+            workbook.close()
+    return pd.ExcelFile(input_file).sheet_names
+
+
+def excel_sheet_to_pdf(input_file, sheet_name, pdf_file_name):
+    """
+    Parameters
+    ----------
+    input_file: the workbook
+    sheet_name: the sheet to be rendered, its first row is the header
+    pdf_file_name: the pdf file to be written
+    Returns the pdf file name
+    -------
+    """
+    rows = excel_sheet_rows(input_file, sheet_name)
+    header = next(rows, ())
+    sample_rows = list(islice(rows, 100))
+    writer = TablePdfWriter(pdf_file_name, header, sample_rows)
+    writer.write_rows(sample_rows)
+    writer.write_rows(rows)
+    writer.close()
+    return pdf_file_name
+
+
+def get_render_executor(tasks, workers_variable):
+    """
+    Returns the executor rendering the parts of a document, a process
+    pool sized by the workers_variable environment variable with a
+    thread pool fallback where the platform cannot create one.
+    """
+    workers = min(
+        tasks,
+        int(os.environ.get(workers_variable, str(len(os.sched_getaffinity(0))))),
+    )
+    try:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    except OSError as _:
+        logger.info("Process pool not available. Rendering in threads.")
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+
+def excel_to_pdf(input_file, pdf_file_name):
+    """
+    Renders every sheet of the workbook into its own pdf concurrently
+    and merges them in sheet order.
+    Returns True if the pdf file is created
+    """
+    sheet_names = excel_sheet_names(input_file)
+    if len(sheet_names) == 1:
+        excel_sheet_to_pdf(input_file, sheet_names[0], pdf_file_name)
+        return True
+
+    filename, _ = os.path.splitext(input_file)
+    temp_pdfs = [
+        "".join([filename, "_sheet", str(index), ".pdf"])
+        for index in range(len(sheet_names))
+    ]
+    with get_render_executor(len(sheet_names), "table_sheet_workers") as executor:
+        list(
+            executor.map(
+                excel_sheet_to_pdf,
+                [input_file] * len(sheet_names),
+                sheet_names,
+                temp_pdfs,
+            )
+        )
+    merge_pdf(temp_pdfs, pdf_file_name)
+    return True
+
+
+class StreamingPdfWriter:
+    """
+    Writes a pdf page by page straight to disk, the text drawn in the
+    built-in Courier font. Only the object offsets are kept in memory,
+    so that documents of any length are written in bounded memory.
+    """
+
+    # Object numbers of the catalog, the page tree and the font.
+    CATALOG, PAGES, FONT = 1, 2, 3
+
+    def __init__(self, pdf_file_name):
+        self.file = open(pdf_file_name, "wb")
+        self.file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = self.FONT + 1
+        self._write_object(
+            self.FONT,
+            b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier"
+            b" /Encoding /WinAnsiEncoding >>",
+        )
+
+    def _write_object(self, object_id, data):
+        self.offsets[object_id] = self.file.tell()
+        self.file.write(b"%d 0 obj\n%s\nendobj\n" % (object_id, data))
+
+    def _new_object_id(self):
+        self.next_id += 1
+        return self.next_id - 1
+
+    def add_page(self, content):
+        """
+        Appends a page drawn by content, a zlib compressed content stream.
+        """
+        content_id = self._new_object_id()
+        self._write_object(
+            content_id,
+            b"<< /Length %d /Filter /FlateDecode >>\nstream\n%s\nendstream"
+            % (len(content), content),
+        )
+        page_id = self._new_object_id()
+        self._write_object(
+            page_id,
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %.2f %.2f]"
+            b" /Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>"
+            % (self.PAGES, PDF_PAGE_WIDTH, PDF_PAGE_HEIGHT, self.FONT, content_id),
+        )
+        self.page_ids.append(page_id)
+
+    def close(self):
+        if not self.page_ids:
+            self.add_page(zlib.compress(b""))
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self.page_ids)
+        self._write_object(
+            self.PAGES,
+            b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.page_ids)),
+        )
+        self._write_object(
+            self.CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % self.PAGES
+        )
+        xref = self.file.tell()
+        self.file.write(b"xref\n0 %d\n0000000000 65535 f \n" % self.next_id)
+        for object_id in range(1, self.next_id):
+            self.file.write(b"%010d 00000 n \n" % self.offsets[object_id])
+        self.file.write(
+            b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (self.next_id, self.CATALOG, xref)
+        )
+        self.file.close()
+        return True
+
+
+def text_pages(lines, font_size=9):
+    """
+    Lays lines of text out on A4 pages, wrapping them at the page width,
+    and yields the compressed content stream of every page.
+    """
+    margin = 28.35
+    leading = font_size * 1.4
+    # Courier characters are 0.6 em wide.
+    chars_per_line = int((PDF_PAGE_WIDTH - 2 * margin) / (font_size * 0.6))
+    lines_per_page = int((PDF_PAGE_HEIGHT - 2 * margin) / leading)
+    begin = b"BT /F1 %d Tf %.2f TL %.2f %.2f Td\n" % (
+        font_size,
+        leading,
+        margin,
+        PDF_PAGE_HEIGHT - margin - font_size,
+    )
+
+    def content(page):
+        text = "\n".join(
+            "("
+            + line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+            + ") Tj T*"
+            for line in page
+        )
+        return zlib.compress(begin + text.encode("cp1252", "replace") + b"\nET")
+
+    page = []
+    for line in lines:
+        line = line.rstrip("\r\n").expandtabs()
+        for start in range(0, max(1, len(line)), chars_per_line):
+            page.append(line[start : start + chars_per_line])
+            if len(page) == lines_per_page:
+                yield content(page)
+                page = []
+    if page:
+        yield content(page)
+
+
+def detect_text_encoding(input_file):
+    """
+    Returns the encoding of a text file from its byte order mark, or
+    guessed from its first text_encoding_sample_kb kilobytes, utf-8 when
+    it cannot be told.
+    """
+    sample_size = int(os.environ.get("text_encoding_sample_kb", "256")) * 1024
+    with open(input_file, "rb") as f:
+        sample = f.read(sample_size)
+    for bom, encoding in (
+        (codecs.BOM_UTF32_LE, "utf-32"),
+        (codecs.BOM_UTF32_BE, "utf-32"),
+        (codecs.BOM_UTF8, "utf-8-sig"),
+        (codecs.BOM_UTF16_LE, "utf-16"),
+        (codecs.BOM_UTF16_BE, "utf-16"),
+    ):
+        if sample.startswith(bom):
+            return encoding
+    # Cut a truncated sample at the last line end so that no character
+    # is split.
+    if len(sample) == sample_size and (end := sample.rfind(b"\n")) > 0:
+        sample = sample[: end + 1]
+    matches = charset_normalizer.from_bytes(sample) if sample else None
+    best = matches.best() if matches else None
+    if best is None:
+        return "utf-8"
+    # Code pages decoding the sample equally well are only told apart by a
+    # guess at its language, which short samples get wrong. Windows Western
+    # is the most common of them.
+    if best.encoding not in ("ascii", "utf_8"):
+        for match in matches:
+            if match.encoding == "cp1252" and match.chaos <= best.chaos:
+                return "cp1252"
+    return best.encoding
+
+
+def text_chunk_to_pages(input_file, encoding, start, end, pages_file):
+    """
+    Parameters
+    ----------
+    input_file: text file in an ascii compatible encoding
+    encoding: encoding of the file
+    start: offset of the first line of the chunk
+    end: offset of the line following the chunk
+    pages_file: file the length prefixed page contents are written to
+    Returns the pages file name
+    -------
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors="replace")
+    with open(input_file, "rb") as f, open(pages_file, "wb") as pages:
+        f.seek(start)
+        lines = takewhile(
+            lambda line: f.tell() - len(line) < end, iter(f.readline, b"")
+        )
+        for content in text_pages(decoder.decode(line) for line in lines):
+            pages.write(struct.pack("<I", len(content)))
+            pages.write(content)
+    return pages_file
+
+
+def text_chunk_offsets(input_file, size, chunks):
+    """
+    Returns the start offsets of chunks of about equal size,
+    each beginning on a new line.
+    """
+    offsets = [0]
+    with open(input_file, "rb") as f:
+        for chunk in range(1, chunks):
+            f.seek(size * chunk // chunks)
+            f.readline()
+            if offsets[-1] < f.tell() < size:
+                offsets.append(f.tell())
+    return offsets
+
+
+def text_to_pdf(input_file, pdf_file_name):
+    """
+    Renders a text file of any size to pdf.
+    Files larger than text_chunk_mb in an ascii compatible encoding are
+    split on line ends and the chunks are laid out concurrently, each
+    chunk starting on a new page.
+    Returns True if the pdf file is created
+    """
+    encoding = detect_text_encoding(input_file)
+    size = os.path.getsize(input_file)
+    chunk_size = int(os.environ.get("text_chunk_mb", "32")) * 1024 * 1024
+    ascii_compatible = "\n".encode(encoding) == b"\n"
+    logger.info(f"Rendering {input_file} ({size} bytes) as {encoding}")
+
+    writer = StreamingPdfWriter(pdf_file_name)
+    if size <= chunk_size or not ascii_compatible:
+        with open(input_file, encoding=encoding, errors="replace", newline="") as f:
+            for content in text_pages(f):
+                writer.add_page(content)
+        return writer.close()
+
+    offsets = text_chunk_offsets(input_file, size, -(-size // chunk_size))
+    filename, _ = os.path.splitext(input_file)
+    pages_files = [
+        "".join([filename, "_chunk", str(index), ".pages"])
+        for index in range(len(offsets))
+    ]
+    with get_render_executor(len(offsets), "text_render_workers") as executor:
+        for pages_file in executor.map(
+            text_chunk_to_pages,
+            [input_file] * len(offsets),
+            [encoding] * len(offsets),
+            offsets,
+            offsets[1:] + [size],
+            pages_files,
+        ):
+            with open(pages_file, "rb") as pages:
+                while length := pages.read(4):
+                    writer.add_page(pages.read(struct.unpack("<I", length)[0]))
+            os.remove(pages_file)
+    return writer.close()
+
+
+def svg_to_pdf_raster(drawing, filename, pdf_file_name):
+    """
+    Parameters
+    ----------
+    drawing: the svg2rlg drawing
+    filename: input file name without extension, used for the png
+    pdf_file_name: the pdf file to be written
+    Returns True if the pdf file is created
+    -------
+    """
+    renderPM.drawToFile(
+        drawing, temp_file := "".join([filename, ".png"]), fmt="PNG", dpi=300
+    )
+    return create_pdf(temp_file, pdf_file_name)
+
+
+class HtmlTextExtractor(HTMLParser):
+    """
+    Collects the text of an html email body, one line per block element.
+    """
+
+    BLOCK_TAGS = {"br", "p", "div", "tr", "li", "table", "h1", "h2", "h3", "h4"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style"):
+            self.skip += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style"):
+            self.skip = max(0, self.skip - 1)
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(data)
+
+
+def html_to_text(html):
+    extractor = HtmlTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    lines = [" ".join(line.split()) for line in "".join(extractor.parts).splitlines()]
+    # Keep single blank lines between paragraphs only.
+    return "\n".join(
+        line for index, line in enumerate(lines) if line or (index and lines[index - 1])
+    )
+
+
+def read_eml(input_file):
+    """
+    Parameters
+    ----------
+    input_file: MIME email
+    Returns the headers, the body text and the (filename, bytes)
+    of the attachments
+    -------
+    """
+    with open(input_file, "rb") as f:
+        message = email.message_from_binary_file(f, policy=policy.default)
+
+    headers = [
+        (name, str(message[name]))
+        for name in ("From", "To", "Cc", "Date", "Subject")
+        if message[name] is not None
+    ]
+    body = ""
+    if (part := message.get_body(preferencelist=("plain", "html"))) is not None:
+        body = part.get_content()
+        if part.get_content_type() == "text/html":
+            body = html_to_text(body)
+
+    attachments = []
+    for index, part in enumerate(message.iter_attachments()):
+        if part.get_content_maintype() == "message":
+            data = part.get_content().as_bytes()
+            extension = ".eml"
+        else:
+            data = part.get_payload(decode=True) or b""
+            extension = mimetypes.guess_extension(part.get_content_type()) or ""
+        attachments.append(
+            (part.get_filename() or f"attachment{index}{extension}", data)
+        )
+    return headers, body, attachments
+
+
+def read_msg(input_file):
+    """
+    Parameters
+    ----------
+    input_file: Outlook msg file
+    Returns the headers, the body text and the (filename, bytes)
+    of the attachments
+    -------
+    """
+    msg = extract_msg.Message(input_file)
+    try:
+        headers = [
+            (name, str(value))
+            for name, value in (
+                ("From", msg.sender),
+                ("To", msg.to),
+                ("Cc", msg.cc),
+                ("Date", msg.date),
+                ("Subject", msg.subject),
+            )
+            if value
+        ]
+        try:
+            body = msg.body or ""
+        except Exception as _:
+            body = ""
+        if not body and (html_body := msg.htmlBody):
+            body = html_to_text(html_body.decode("utf-8", errors="replace"))
+
+        attachments = []
+        for index, attachment in enumerate(msg.attachments):
+            filename = (
+                getattr(attachment, "longFilename", None)
+                or getattr(attachment, "shortFilename", None)
+                or f"attachment{index}"
+            )
+            data = attachment.data
+            if not isinstance(data, bytes):
+                # Embedded messages are exported as msg files.
+                data = data.exportBytes() if hasattr(data, "exportBytes") else b""
+                filename = "".join([os.path.splitext(filename)[0], ".msg"])
+            attachments.append((filename, data))
+    finally:
+        msg.close()
+    return headers, body, attachments
+
+
+def convert_attachment(job, attachment_file, converter, ocr_mode):
+    """
+    Converts an email attachment with the converter selected for it.
+    Returns the pdf file name, or None when it could not be converted.
+    """
+    if converter is None:
+        logger.info(f"No converter for attachment: {attachment_file}")
+        return None
+    pdf_file_name = "".join([attachment_file, ".pdf"])
+    attachment_job = ConversionJob(
+        job.s3_client,
+        job.s3_input_file,
+        attachment_file,
+        pdf_file_name,
+        None,
+        job.bucket_name,
+        None,
+        ocr_mode,
+    )
+    try:
+        converted = converter_registry.convert(converter, attachment_job)
+    except Exception as _:
+        log_exception()
+        converted = False
+    finally:
+        attachment_job.remove_intermediates()
+    return pdf_file_name if converted else None
+
+
+def convert_remote_attachments(job, attachment_files):
+    """
+    Converts the Word attachments of an email with one doc_to_pdf request,
+    through temporary objects under doc_pdf/attachment_tmp/ of the case.
+    Returns the pdf file name of every attachment, or None for the ones
+    that could not be converted.
+    """
+    prefix = "/".join(
+        [job.s3_input_file.split("/")[0], "doc_pdf", "attachment_tmp", uuid.uuid4().hex]
+    )
+    files = [
+        (
+            "/".join([prefix, os.path.basename(attachment_file)]),
+            "/".join([prefix, os.path.basename(attachment_file) + ".pdf"]),
+        )
+        for attachment_file in attachment_files
+    ]
+    attachment_pdfs = [None] * len(attachment_files)
+    try:
+        for attachment_file, (s3_input_file, _) in zip(attachment_files, files):
+            job.s3_client.upload_file(attachment_file, job.bucket_name, s3_input_file)
+        uploaded = invoke_doc_to_pdf(get_lambda_client(), files)
+        for index, (attachment_file, (_, s3_output_file), converted) in enumerate(
+            zip(attachment_files, files, uploaded)
+        ):
+            if converted:
+                job.s3_client.download_file(
+                    job.bucket_name,
+                    s3_output_file,
+                    attachment_pdf := "".join([attachment_file, ".pdf"]),
+                )
+                attachment_pdfs[index] = attachment_pdf
+    except Exception as _:
+        log_exception()
+    finally:
+        for s3_key in (s3_key for keys in files for s3_key in keys):
+            try:
+                job.s3_client.delete_object(Bucket=job.bucket_name, Key=s3_key)
+            except Exception as _:
+                log_exception()
+    return attachment_pdfs
+
+
+def email_to_pdf(job, headers, body, attachments):
+    """
+    Renders the headers and body of an email followed by its attachments,
+    which are saved next to the input and converted concurrently by their
+    own converters (email_attachment_workers). The attachments of remote
+    converters (Word documents) are sent to doc_to_pdf in one batch.
+    Returns True if the pdf file is created
+    """
+    attachment_dir = job.intermediate("".join([job.filename, "_attachments"]))
+    os.makedirs(attachment_dir, exist_ok=True)
+    attachment_files = []
+    for index, (filename, data) in enumerate(attachments):
+        safe_name = re.sub(r"[^\w.\-]", "_", os.path.basename(filename))
+        attachment_files.append(os.path.join(attachment_dir, f"{index}_{safe_name}"))
+        with open(attachment_files[-1], "wb") as f:
+            f.write(data)
+
+    # Deferred OCR jobs are kept per S3 document, so attachments are
+    # only OCR'd when the case OCRs inline.
+    ocr_mode = "inline" if job.ocr_mode == "inline" else "none"
+    attachment_pdfs = [None] * len(attachment_files)
+    if attachment_files:
+        converters = [
+            converter_registry.select(attachment_file, ocr_mode)
+            for attachment_file in attachment_files
+        ]
+        remote = [
+            index
+            for index, converter in enumerate(converters)
+            if converter is not None and not converter.local
+        ]
+        local = [index for index in range(len(attachment_files)) if index not in remote]
+        workers = int(os.environ.get("email_attachment_workers", "4"))
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(workers, len(attachment_files))
+        ) as executor:
+            remote_pdfs = None
+            if remote:
+                remote_pdfs = executor.submit(
+                    convert_remote_attachments,
+                    job,
+                    [attachment_files[index] for index in remote],
+                )
+            local_pdfs = executor.map(
+                lambda index: convert_attachment(
+                    job, attachment_files[index], converters[index], ocr_mode
+                ),
+                local,
+            )
+            for index, attachment_pdf in zip(local, local_pdfs):
+                attachment_pdfs[index] = attachment_pdf
+            if remote_pdfs is not None:
+                for index, attachment_pdf in zip(remote, remote_pdfs.result()):
+                    attachment_pdfs[index] = attachment_pdf
+
+    lines = [f"{name}: {value}" for name, value in headers] + [""]
+    lines.extend(body.splitlines())
+    if attachments:
+        lines.extend(["", "Attachments:"])
+        for (filename, _), attachment_pdf in zip(attachments, attachment_pdfs):
+            lines.append(
+                f"  {os.path.basename(filename)}"
+                + ("" if attachment_pdf else " (not converted)")
+            )
+
+    body_pdf = job.intermediate("".join([job.filename, "_body.pdf"]))
+    writer = StreamingPdfWriter(body_pdf)
+    for content in text_pages(lines):
+        writer.add_page(content)
+    writer.close()
+
+    pdfs = [body_pdf] + [pdf for pdf in attachment_pdfs if pdf]
+    if len(pdfs) == 1:
+        os.replace(body_pdf, job.pdf_file_name)
+    else:
+        merge_pdf(pdfs, job.pdf_file_name)
+    return True
+
+
+class ConversionJob:
+    """
+    Everything a converter needs to know about the document it converts.
+    """
+
+    def __init__(
+        self,
+        s3_client,
+        s3_input_file,
+        input_file,
+        pdf_file_name,
+        s3_output_file,
+        bucket_name,
+        cache_key,
+        ocr_mode,
+    ):
+        self.s3_client = s3_client
+        self.s3_input_file = s3_input_file
+        self.input_file = input_file
+        self.pdf_file_name = pdf_file_name
+        self.s3_output_file = s3_output_file
+        self.bucket_name = bucket_name
+        self.cache_key = cache_key
+        self.ocr_mode = ocr_mode
+        self.filename, _ = os.path.splitext(input_file)
+        self.intermediates = []
+
+    def intermediate(self, path):
+        """
+        Registers a file or folder the converter creates on the way
+        to the pdf, removed by remove_intermediates.
+        Returns the path.
+        """
+        self.intermediates.append(path)
+        return path
+
+    def remove_intermediates(self):
+        for path in self.intermediates:
+            if os.path.isdir(path):
+                rmtree(path, ignore_errors=True)
+            elif os.path.isfile(path) and path != self.pdf_file_name:
+                os.remove(path)
+        self.intermediates = []
+
+
+class Converter:
+    """
+    Base class of the converters of the ConverterRegistry.
+
+    name: converter name, also the key of its CONVERTER_VERSIONS entry
+    extensions: suffixes of the files the converter is chosen for when
+    the content does not identify the file
+    ocr_modes: OCR modes of the case the converter is used in
+    signature: True when sniff checks a binary signature rather than
+    recognising loose text
+    bound: "cpu" or "io", selects the worker pool the file is converted in
+    cost: expected relative cost of a file, costlier files are started first
+    local: False when the converter works on the S3 object rather than
+    the downloaded file, email attachments are then uploaded for it
+    defers_ocr: True when the pdf is created without text layer in the
+    "deferred" ocr mode and left for ocr_lambda_handler
+    """
+
+    name = None
+    extensions = ()
+    ocr_modes = OCR_MODES
+    signature = False
+    bound = "cpu"
+    cost = 1
+    local = True
+    defers_ocr = False
+
+    def matches_extension(self, input_file):
+        return input_file.lower().endswith(self.extensions)
+
+    def sniff(self, header):
+        """
+        Returns True when the first bytes of the file identify
+        a file this converter handles.
+        """
+        return False
+
+    def convert(self, job):
+        """
+        Converts job.input_file into job.pdf_file_name.
+        Returns True if the pdf file is created
+        """
+        raise NotImplementedError
+
+
+def is_text(header):
+    return b"\x00" not in header
+
+
+class PdfConverter(Converter):
+    name = "pdf"
+    extensions = (".pdf",)
+    signature = True
+    bound = "io"
+
+    def sniff(self, header):
+        return header.startswith(b"%PDF-")
+
+    def convert(self, job):
+        copyfile(job.input_file, job.pdf_file_name)
+        return True
+
+
+class ImageConverter(Converter):
+    name = "image"
+    extensions = IMAGE_EXTENSIONS + tuple(
+        "".join([extension, FILE_PATTERN_TO_INCLUDE]) for extension in IMAGE_EXTENSIONS
+    )
+    ocr_modes = ("inline",)
+    signature = True
+    cost = 5
+
+    def sniff(self, header):
+        return header.startswith(
+            (b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff", b"GIF87a", b"GIF89a")
+        )
+
+    def convert(self, job):
+        image_file = job.input_file
+        if not image_file.lower().endswith(IMAGE_EXTENSIONS):
+            # The image is saved again by prepare_image_for_ocr,
+            # which needs the extension to pick the format.
+            with Image.open(image_file) as image:
+                extension = "".join([".", image.format.lower()])
+            copyfile(
+                image_file,
+                image_file := job.intermediate("".join([image_file, extension])),
+            )
+        ocr_file = prepare_image_for_ocr(image_file)
+        if ocr_file != image_file:
+            job.intermediate(ocr_file)
+        return create_pdf(ocr_file, job.pdf_file_name)
+
+
+class LosslessImageConverter(ImageConverter):
+    name = "image_lossless"
+    ocr_modes = ("deferred", "none")
+    bound = "io"
+    cost = 1
+    defers_ocr = True
+
+    def convert(self, job):
+        converted = image_to_pdf_lossless(job.input_file, job.pdf_file_name)
+        if converted and job.ocr_mode == "deferred":
+            create_ocr_job(
+                job.s3_client, job.bucket_name, job.s3_input_file, job.s3_output_file
+            )
+        return converted
+
+
+class TiffConverter(Converter):
+    name = "tiff"
+    extensions = (".tif", ".tiff")
+    signature = True
+    cost = 20
+
+    def sniff(self, header):
+        return header.startswith((b"II*\x00", b"MM\x00*"))
+
+    def convert(self, job):
+        return tiff_to_pdf(job.input_file, job.pdf_file_name)
+
+
+class BmpConverter(Converter):
+    name = "bmp"
+    extensions = (".bmp",)
+    signature = True
+
+    def sniff(self, header):
+        return header.startswith(b"BM") and header[6:10] == b"\x00\x00\x00\x00"
+
+    def convert(self, job):
+        update_image_dpi(job.input_file)
+        Image.open(job.input_file).save(job.pdf_file_name, format="PDF")
+        return True
+
+
+class SvgConverter(Converter):
+    name = "svg"
+    extensions = (".svg",)
+    cost = 2
+
+    def sniff(self, header):
+        return is_text(header) and b"<svg" in header.lower()
+
+    def convert(self, job):
+        try:
+            drawing = svg2rlg(job.input_file, resolve_entities=True)
+        except Exception as _:
+            log_exception()
+            drawing = None
+        if drawing is None:
+            logger.info(f"Could not parse {job.input_file}, rendering with wkhtmltopdf")
+            return get_html_renderer().render(
+                job.input_file,
+                job.pdf_file_name,
+                options={"enable-local-file-access": ""},
+            )
+
+        try:
+            renderPDF.drawToFile(drawing, job.pdf_file_name)
+            return True
+        except Exception as _:
+            log_exception()
+            logger.info(f"Vector rendering failed, rasterizing {job.input_file}")
+        job.intermediate("".join([job.filename, ".png"]))
+        return svg_to_pdf_raster(drawing, job.filename, job.pdf_file_name)
+
+
+class MifConverter(Converter):
+    name = "mif"
+    extensions = (".mif",)
+    cost = 2
+
+    def sniff(self, header):
+        return header.lstrip().startswith(b"<MIFFile")
+
+    def convert(self, job):
+        return text_to_pdf(job.input_file, job.pdf_file_name)
+
+
+class MhtConverter(Converter):
+    name = "mht"
+    extensions = (".mht", ".mhtml")
+    cost = 2
+    # The pdf is rendered by the shared HtmlRenderer, the worker only waits.
+    bound = "io"
+
+    def sniff(self, header):
+        lower_header = header.lower()
+        return (
+            is_text(header)
+            and b"mime-version:" in lower_header
+            and b"multipart/related" in lower_header
+        )
+
+    def convert(self, job):
+        copyfile(
+            job.input_file,
+            temp_file := job.intermediate("".join([job.filename, ".html"])),
+        )
+        get_html_renderer().render(
+            temp_file,
+            job.pdf_file_name,
+            options={
+                "enable-local-file-access": "",
+                "load-error-handling": "ignore",
+            },
+        )
+        return True
+
+
+class EmlConverter(Converter):
+    name = "eml"
+    extensions = (".eml",)
+    cost = 3
+
+    def sniff(self, header):
+        return is_text(header) and header.lstrip().startswith(
+            (b"Received:", b"Return-Path:", b"Delivered-To:", b"Message-ID:")
+        )
+
+    def convert(self, job):
+        return email_to_pdf(job, *read_eml(job.input_file))
+
+
+class CsvConverter(Converter):
+    name = "csv"
+    extensions = (".csv",)
+    cost = 3
+
+    def convert(self, job):
+        return csv_to_pdf(job.input_file, job.pdf_file_name)
+
+
+class ExcelConverter(Converter):
+    name = "excel"
+    extensions = (".xls", ".xlsx")
+    signature = True
+    cost = 5
+
+    def sniff(self, header):
+        return (header.startswith(b"PK\x03\x04") and b"xl/" in header) or (
+            header.startswith(OLE2_MAGIC) and "Workbook".encode("utf-16-le") in header
+        )
+
+    def convert(self, job):
+        return excel_to_pdf(job.input_file, job.pdf_file_name)
+
+
+class HtmlConverter(Converter):
+    name = "html"
+    extensions = (".html", ".htm", ".xml")
+    cost = 2
+    bound = "io"
+
+    def sniff(self, header):
+        lower_header = header.lstrip().lower()
+        return is_text(header) and lower_header.startswith(
+            (b"<!doctype html", b"<html", b"<?xml")
+        )
+
+    def convert(self, job):
+        try:
+            get_html_renderer().render(
+                job.input_file,
+                job.pdf_file_name,
+                options={"enable-local-file-access": "", "quiet": ""},
+            )
+            return True
+        except Exception as _:
+            logger.info(f"Trying again: {job.filename}")
+            copyfile(
+                job.input_file,
+                temp_file := job.intermediate("".join([job.filename, ".txt"])),
+            )
+            get_html_renderer().render(
+                temp_file,
+                job.pdf_file_name,
+                options={"quiet": ""},
+            )
+            return True
+
+
+class MsgConverter(Converter):
+    name = "msg"
+    extensions = (".msg",)
+    signature = True
+    cost = 3
+
+    def sniff(self, header):
+        return header.startswith(OLE2_MAGIC) and (
+            "__substg1.0_".encode("utf-16-le") in header
+        )
+
+    def convert(self, job):
+        return email_to_pdf(job, *read_msg(job.input_file))
+
+
+class DocConverter(Converter):
+    name = "doc"
+    extensions = (".doc", ".docx")
+    signature = True
+    bound = "io"
+    cost = 10
+    local = False
+
+    def sniff(self, header):
+        return (header.startswith(b"PK\x03\x04") and b"word/" in header) or (
+            header.startswith(OLE2_MAGIC)
+            and "WordDocument".encode("utf-16-le") in header
+        )
+
+    def convert(self, job):
+        # Word documents are normally sent in batches by convert_doc_items,
+        # this handles the ones only recognised after the download.
+        [uploaded] = invoke_doc_to_pdf(
+            get_lambda_client(), [(job.s3_input_file, job.s3_output_file)]
+        )
+        if not uploaded:
+            return False
+        logger.info(f"{job.input_file} Processed")
+        # The pdf is fetched back so that it is published and cached like
+        # the output of the other converters.
+        job.s3_client.download_file(
+            job.bucket_name, job.s3_output_file, job.pdf_file_name
+        )
+        return True
+
+
+class TextConverter(Converter):
+    name = "text"
+    extensions = (".txt",)
+
+    def sniff(self, header):
+        return is_text(header)
+
+    def convert(self, job):
+        return text_to_pdf(job.input_file, job.pdf_file_name)
+
+
+TIMING_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, float("inf"))
+
+
+class ConverterRegistry:
+    """
+    Selects the converter of a file from its first bytes, falling back
+    to the file extension when the content does not identify the file,
+    and records a timing histogram per converter.
+    """
+
+    def __init__(self, converters):
+        # Converters are sniffed in order, so formats with a precise
+        # signature come before the ones recognised from loose text.
+        self.converters = converters
+        self.lock = threading.Lock()
+        self.timings = {}
+
+    def for_extension(self, input_file, ocr_mode="inline"):
+        for converter in self.converters:
+            if ocr_mode in converter.ocr_modes and converter.matches_extension(
+                input_file
+            ):
+                return converter
+        return None
+
+    def select(self, input_file, ocr_mode="inline"):
+        """
+        Returns the converter for the downloaded input_file,
+        or None when no converter handles it.
+        """
+        with open(input_file, "rb") as f:
+            header = f.read(SNIFF_BYTES)
+
+        by_extension = self.for_extension(input_file, ocr_mode)
+        if by_extension is not None and by_extension.sniff(header):
+            return by_extension
+
+        converters = [
+            converter
+            for converter in self.converters
+            if ocr_mode in converter.ocr_modes and converter.sniff(header)
+        ]
+        by_signature = [converter for converter in converters if converter.signature]
+        if by_signature:
+            converter = by_signature[0]
+        elif (
+            by_extension is not None and not by_extension.signature and is_text(header)
+        ):
+            return by_extension
+        elif converters:
+            converter = converters[0]
+        else:
+            return by_extension
+
+        if by_extension is not None:
+            logger.info(
+                f"{input_file} is handled by the {converter.name} "
+                f"converter instead of {by_extension.name}."
+            )
+        return converter
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.timings.setdefault(
+                name, {"count": 0, "seconds": 0.0, "buckets": [0] * len(TIMING_BUCKETS)}
+            )
+            histogram["count"] += 1
+            histogram["seconds"] += seconds
+            for i, bucket in enumerate(TIMING_BUCKETS):
+                if seconds <= bucket:
+                    histogram["buckets"][i] += 1
+                    break
+
+    def merge(self, timings):
+        """
+        Adds the timings recorded by another process.
+        """
+        with self.lock:
+            for name, other in timings.items():
+                histogram = self.timings.setdefault(
+                    name,
+                    {"count": 0, "seconds": 0.0, "buckets": [0] * len(TIMING_BUCKETS)},
+                )
+                histogram["count"] += other["count"]
+                histogram["seconds"] += other["seconds"]
+                histogram["buckets"] = [
+                    count + other_count
+                    for count, other_count in zip(
+                        histogram["buckets"], other["buckets"]
+                    )
+                ]
+
+    def convert(self, converter, job):
+        start = time.perf_counter()
+        try:
+            return converter.convert(job)
+        finally:
+            self.record(converter.name, time.perf_counter() - start)
+
+    def log_timings(self):
+        with self.lock:
+            timings, self.timings = self.timings, {}
+        for name, histogram in sorted(timings.items()):
+            buckets = {
+                f"<={bucket}s": count
+                for bucket, count in zip(TIMING_BUCKETS, histogram["buckets"])
+                if count
+            }
+            logger.info(
+                f"Converter {name}: {histogram['count']} files in "
+                f"{round(histogram['seconds'], 2)}s {buckets}"
+            )
+
+
+converter_registry = ConverterRegistry(
+    [
+        PdfConverter(),
+        ImageConverter(),
+        LosslessImageConverter(),
+        TiffConverter(),
+        BmpConverter(),
+        DocConverter(),
+        ExcelConverter(),
+        MsgConverter(),
+        SvgConverter(),
+        MifConverter(),
+        MhtConverter(),
+        HtmlConverter(),
+        EmlConverter(),
+        CsvConverter(),
+        TextConverter(),
+    ]
+)
+
+
+def convert_document(
+    s3_client,
+    s3_input_file,
+    input_file,
+    pdf_file_name,
+    s3_output_file,
+    bucket_name,
+    cache_key,
+    ocr_mode="inline",
+):
+    """
+    Converts the downloaded input_file into pdf_file_name.
+    Returns
+    -------
+    whether the pdf was created and False when an unprocessed
+    file had to be created for the input
+    """
+    Success_Flag = True
+    converted = False
+    converter = None
+    job = ConversionJob(
+        s3_client,
+        s3_input_file,
+        input_file,
+        pdf_file_name,
+        s3_output_file,
+        bucket_name,
+        cache_key,
+        ocr_mode,
+    )
+
+    try:
+        logger.info(f"Processing:{input_file}")
+        converter = converter_registry.select(input_file, ocr_mode)
+        if converter is None:
+            logger.info(f"No converter for: {input_file}")
+        else:
+            converted = converter_registry.convert(converter, job)
+
+    except Exception as e:
+
+        if "Done" not in str(e):
+            if converter is not None and converter.name == "mht":
+                converted = True
             else:
                 (
                     exception_type,
@@ -423,38 +2932,296 @@ def process_document_folders(
                 logger.error(err_msg)
                 logger.info("Creating Unprocessed File.")
 
-                session = boto3.Session()
-                s3_client = session.client(service_name="s3")
-                s3_client.put_object(
-                    Body="",
-                    Bucket=unprocess_bucket,
-                    Key=unprocess_file.replace(
-                        unprocess_file.split("/")[1], "doc_pdf/unprocessed_files"
-                    ),
-                )
+                create_unprocessed_file(bucket_name, s3_input_file)
                 Success_Flag = False
         else:
             converted = True
+
+    finally:
+        job.remove_intermediates()
+
+    return converted, Success_Flag
+
+
+def is_sandbox_enabled():
+    return os.environ.get("conversion_sandbox", "false") == "true"
+
+
+# Services of the parent process sandboxes may call, with the function
+# returning the service and the methods served.
+SANDBOX_SERVICES = {
+    "ocr_engine": (get_ocr_engine, ("image_to_pdf", "run_tesseract")),
+    "html_renderer": (get_html_renderer, ("render",)),
+    "page_ocr_cache": (get_page_ocr_cache, ("get", "put")),
+}
+
+
+class SandboxServiceClient:
+    """
+    Forwards calls of a sandboxed conversion process to the services of
+    the parent (see SANDBOX_SERVICES), so that the sandboxes share its
+    OCR workers, page OCR cache and Xvfb display instead of each starting
+    their own. Calls from several threads are in flight at once.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.send_lock = threading.Lock()
+        self.calls = {}
+        self.calls_lock = threading.Lock()
+        self.call_ids = iter(range(sys.maxsize))
+        threading.Thread(
+            target=self._receive, name="sandbox-services", daemon=True
+        ).start()
+
+    def _receive(self):
+        while True:
+            try:
+                call_id, error, result = self.connection.recv()
+            except (EOFError, OSError) as _:
+                with self.calls_lock:
+                    calls, self.calls = self.calls, {}
+                for future in calls.values():
+                    future.set_exception(OSError("The parent process is gone"))
+                return
+            with self.calls_lock:
+                future = self.calls.pop(call_id)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def call(self, service, method, *args, **kwargs):
+        future = concurrent.futures.Future()
+        with self.calls_lock:
+            call_id = next(self.call_ids)
+            self.calls[call_id] = future
+        with self.send_lock:
+            self.connection.send((call_id, service, method, args, kwargs))
+        return future.result()
+
+
+class SandboxService:
+    """
+    Stands in for a service of the parent in a sandboxed process.
+    """
+
+    def __init__(self, client, service):
+        self.client = client
+        self.service = service
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            return self.client.call(self.service, method, *args, **kwargs)
+
+        return call
+
+
+class SandboxPageOcrCache(SandboxService):
+    page_key = staticmethod(PageOcrCache.page_key)
+
+
+def serve_sandbox_call(connection, send_lock, request):
+    """
+    Runs a call of a sandboxed process on the service of this process
+    and sends back the result or the exception raised.
+    """
+    call_id, service, method, args, kwargs = request
+    result, error = None, None
+    try:
+        get_service, methods = SANDBOX_SERVICES[service]
+        if method not in methods:
+            raise ValueError(f"{service}.{method} is not served to sandboxes")
+        result = getattr(get_service(), method)(*args, **kwargs)
+    except Exception as e:
+        error = e
+    try:
+        with send_lock:
+            try:
+                connection.send((call_id, error, result))
+            except (pickle.PicklingError, TypeError, AttributeError) as _:
+                connection.send((call_id, OSError(repr(error or result)), None))
+    except (OSError, ValueError) as _:
+        # The sandbox was killed while the call ran.
+        pass
+
+
+def get_sandbox_limits():
+    """
+    Returns the (conversion_memory_mb, conversion_cpu_seconds) limits of
+    sandboxed conversions, 0 for no limit. The address space of a process
+    is well above its resident memory, so the memory limit is off unless set.
+    """
+    return (
+        int(os.environ.get("conversion_memory_mb", "0")),
+        int(os.environ.get("conversion_cpu_seconds", "0")),
+    )
+
+
+def sandbox_worker(connection, services, limits, args):
+    """
+    Entry point of the sandboxed conversion processes. Runs in its own
+    process group so that the tools it starts are killed along with it.
+    OCR and html rendering are done by the parent through services.
+    """
+    global html_renderer, ocr_engine, page_ocr_cache
+
+    os.setsid()
+    memory_mb, cpu_seconds = limits
+    if memory_mb:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_mb << 20, memory_mb << 20))
+    if cpu_seconds:
+        # SIGXCPU at the soft limit, SIGKILL at the hard one.
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 5))
+    if not logger.handlers:
+        logging.basicConfig(level=logging.INFO)
+
+    client = SandboxServiceClient(services)
+    ocr_engine = SandboxService(client, "ocr_engine")
+    html_renderer = SandboxService(client, "html_renderer")
+    page_ocr_cache = SandboxPageOcrCache(client, "page_ocr_cache")
+
+    conversion_cache_stats.update(hits=0, misses=0)
+    converter_registry.timings = {}
+    session = boto3.Session()
+    s3_client = session.client(service_name="s3")
+    result = convert_document(s3_client, *args)
+    connection.send((result, dict(conversion_cache_stats), converter_registry.timings))
+    connection.close()
+
+
+def convert_document_with_limits(
+    s3_client,
+    s3_input_file,
+    input_file,
+    pdf_file_name,
+    s3_output_file,
+    bucket_name,
+    cache_key,
+    ocr_mode="inline",
+):
+    """
+    Converts like convert_document. With conversion_sandbox=true the
+    conversion runs in its own process, limited to conversion_cpu_seconds
+    of CPU, conversion_timeout seconds of wall clock (never past the end of
+    the invocation) and, when set, conversion_memory_mb of address space.
+    A conversion over its limits is killed and reported as not converted,
+    while the rest of the folder carries on.
+    """
+    args = (
+        s3_input_file,
+        input_file,
+        pdf_file_name,
+        s3_output_file,
+        bucket_name,
+        cache_key,
+        ocr_mode,
+    )
+    if not is_sandbox_enabled():
+        return convert_document(s3_client, *args)
+
+    timeout = int(os.environ.get("conversion_timeout", "300"))
+    if invocation_deadline is not None:
+        timeout = min(timeout, invocation_deadline - time.monotonic())
+    deadline = time.monotonic() + max(1, timeout)
+    limits = get_sandbox_limits()
+
+    # spawn rather than fork, the parent runs other conversions in threads.
+    context = multiprocessing.get_context(
+        os.environ.get("conversion_sandbox_start_method", "spawn")
+    )
+    receiver, sender = context.Pipe(duplex=False)
+    services, sandbox_services = context.Pipe()
+    # Not a daemon, so that the conversion may start process pools of its
+    # own. The finally below kills it with its process group.
+    process = context.Process(
+        target=sandbox_worker, args=(sender, sandbox_services, limits, args)
+    )
+    process.start()
+    sender.close()
+    sandbox_services.close()
+    send_lock = threading.Lock()
+    connections = [receiver, services]
+    try:
+        while True:
+            ready = multiprocessing.connection.wait(
+                connections, max(0, deadline - time.monotonic())
+            )
+            if not ready:
+                reason = f"exceeded its {max(1, timeout):.0f}s deadline"
+                break
+            if services in ready:
+                try:
+                    request = services.recv()
+                except EOFError as _:
+                    connections.remove(services)
+                else:
+                    threading.Thread(
+                        target=serve_sandbox_call,
+                        args=(services, send_lock, request),
+                        daemon=True,
+                    ).start()
+            if receiver in ready:
+                result, worker_stats, worker_timings = receiver.recv()
+                with stats_lock:
+                    for name, count in worker_stats.items():
+                        conversion_cache_stats[name] += count
+                converter_registry.merge(worker_timings)
+                process.join()
+                return result
+    except EOFError as _:
+        process.join()
+        reason = f"died with exit code {process.exitcode}"
+    finally:
+        receiver.close()
+        with send_lock:
+            services.close()
+        if process.is_alive():
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError as _:
+                process.kill()
+            process.join()
+
+    logger.info(f"Conversion of {input_file} {reason}, killed.")
+    return False, True
+
+
+def upload_converted_file(
+    s3_client,
+    s3_input_file,
+    input_file,
+    pdf_file_name,
+    s3_output_file,
+    bucket_name,
+    cache_key,
+    converted,
+):
+    """
+    Uploads the converted pdf to s3_output_file, or creates the
+    unprocessed file for the input when no pdf was created.
+    Returns the success flag of the input.
+    """
+    Success_Flag = True
+
     try:
         if converted:
             logger.info(f"Created: {pdf_file_name}")
 
             with open(pdf_file_name, "rb") as data:
                 s3_client.upload_fileobj(data, bucket_name, s3_output_file)
+
+            if cache_key is not None:
+                try:
+                    conversion_cache.put(cache_key, pdf_file_name)
+                except Exception as _:
+                    log_exception()
         else:
             logger.info(
                 f"PDF not created for: {input_file}. Creating Unprocessed File."
             )
-
-            session = boto3.Session()
-            s3_client = session.client(service_name="s3")
-            s3_client.put_object(
-                Body="",
-                Bucket=unprocess_bucket,
-                Key=unprocess_file.replace(
-                    unprocess_file.split("/")[1], "doc_pdf/unprocessed_files"
-                ),
-            )
+
+            create_unprocessed_file(bucket_name, s3_input_file)
             Success_Flag = False
 
     except Exception as _:
@@ -477,15 +3244,7 @@ def process_document_folders(
 
         logger.info("Creating Unprocessed File.")
 
-        session = boto3.Session()
-        s3_client = session.client(service_name="s3")
-        s3_client.put_object(
-            Body="",
-            Bucket=unprocess_bucket,
-            Key=unprocess_file.replace(
-                unprocess_file.split("/")[1], "doc_pdf/unprocessed_files"
-            ),
-        )
+        create_unprocessed_file(bucket_name, s3_input_file)
         Success_Flag = False
 
     return Success_Flag
@@ -520,7 +3279,7 @@ def list_dir(prefix, bucket, client):
                 if next_token != "":
                     kwargs.update({"ContinuationToken": next_token})
                 results = client.list_objects_v2(**kwargs)
-                contents = results.get("Contents")
+                contents = results.get("Contents", [])
                 for i in contents:
                     k = i.get("Key")
                     if k[-1] != "/":
@@ -652,6 +3411,84 @@ def create_merge_trigger_file(s3_client, bucket, file):
         logger.info(f"Creating Merge Trigger File ERROR for: {file}")
 
 
+def trigger_merge(s3_client, merge_trigger_bucket, control_file_path):
+    """
+    Creates the merge trigger file of the control file unless it exists.
+    """
+    try:
+        s3_client.head_object(Bucket=merge_trigger_bucket, Key=control_file_path)
+    except ClientError as _:
+        create_merge_trigger_file(s3_client, merge_trigger_bucket, control_file_path)
+
+
+def get_merge_hold_key(control_file_path):
+    return control_file_path.replace("/control_files/", "/ocr_merge_held/", 1)
+
+
+def hold_merge_for_ocr(s3_client, bucket_name, control_file_path, merge_trigger_bucket):
+    """
+    The deferred OCR jobs rewrite the converted pdfs, so the merge of a
+    control file waits for the jobs of its documents. The merge trigger
+    is then left in a hold file for release_held_merges.
+    Returns True when the merge is held.
+    """
+    result = s3_client.get_object(Bucket=bucket_name, Key=control_file_path)
+    control_file = json.loads(result["Body"].read().decode())
+    if control_file.get("ocr") != "deferred":
+        return False
+    ocr_job_keys = [
+        get_ocr_job_key(item[output])
+        for item in control_file["files"]
+        for output in ("source", "current")
+        if item.get(output)
+    ]
+    s3_folder = control_file_path.split("/")[0]
+    pending = set(list_dir(f"{s3_folder}/doc_pdf/ocr_pending/", bucket_name, s3_client))
+    ocr_job_keys = [key for key in ocr_job_keys if key in pending]
+    if not ocr_job_keys:
+        return False
+
+    logger.info(f"Merge of {control_file_path} held for {len(ocr_job_keys)} OCR jobs")
+    s3_client.put_object(
+        Body=json.dumps(
+            {
+                "merge_trigger_bucket": merge_trigger_bucket,
+                "control_file_path": control_file_path,
+                "ocr_job_keys": ocr_job_keys,
+            }
+        ),
+        Bucket=bucket_name,
+        Key=get_merge_hold_key(control_file_path),
+    )
+    # The last job may have finished before the hold file was written.
+    release_held_merges(s3_client, bucket_name, s3_folder)
+    return True
+
+
+def release_held_merges(s3_client, bucket_name, s3_folder):
+    """
+    Triggers the held merges of the case whose OCR jobs are all done.
+    """
+    hold_keys = list_dir(f"{s3_folder}/doc_pdf/ocr_merge_held/", bucket_name, s3_client)
+    if not hold_keys:
+        return
+    pending = set(list_dir(f"{s3_folder}/doc_pdf/ocr_pending/", bucket_name, s3_client))
+    for hold_key in hold_keys:
+        try:
+            result = s3_client.get_object(Bucket=bucket_name, Key=hold_key)
+        except ClientError as _:
+            # Released concurrently.
+            continue
+        hold = json.loads(result["Body"].read().decode())
+        if any(key in pending for key in hold["ocr_job_keys"]):
+            continue
+        logger.info(f"OCR done, releasing merge of {hold['control_file_path']}")
+        s3_client.delete_object(Bucket=bucket_name, Key=hold_key)
+        trigger_merge(
+            s3_client, hold["merge_trigger_bucket"], hold["control_file_path"]
+        )
+
+
 def remove_files_from_metadata_bucket(
     s3_client, metadata_s3_bucket, meta_data_object_folder
 ):
@@ -683,21 +3520,106 @@ def remove_files_from_metadata_bucket(
             logger.info(f"ERROR for: {meta_data_object_folder, item}")
 
 
-def process_tiff(args):
-    file_path, i, page = args
-    tmp_image_path = os.path.join(
-        file_path.replace(file_path.split("/")[-1], ""), "temp_image_" + str(i) + ".png"
-    )
+class OcrTiffWriter:
+    """
+    Appends pages to the tiff given to tesseract. Pages found in the page
+    OCR cache, or already appended, are not appended again.
+    page_sources holds for every page either its cached pdf or the index
+    of its page in the tesseract output.
+    """
 
-    logger.info(f"temp image path: {tmp_image_path}")
-    x, y = page.size
-    logger.info(f"x, y: {x, y}")
-    page = page.resize((int(x - x * 0.25), int(y - y * 0.25)), Image.ANTIALIAS)
-    page.save(tmp_image_path)
-    tmp_pdf_file_name = tmp_image_path.replace(".png", ".pdf")
-    _ = create_pdf(tmp_image_path, tmp_pdf_file_name)
-    logger.info(f"Created tmp pdf: {tmp_pdf_file_name}")
-    return tmp_pdf_file_name
+    def __init__(self, tiff_writer, page_cache):
+        self.tiff_writer = tiff_writer
+        self.page_cache = page_cache
+        self.page_sources = []
+        self.keys = []
+        self.appended = {}
+
+    def append(self, page, **save_options):
+        key = None
+        if self.page_cache is not None:
+            key = self.page_cache.page_key(page, save_options.get("compression"))
+            if key in self.appended:
+                self.page_sources.append(self.appended[key])
+                return
+            pdf = self.page_cache.get(key)
+            if pdf is not None:
+                self.page_sources.append(pdf)
+                return
+            self.appended[key] = len(self.keys)
+
+        self.page_sources.append(len(self.keys))
+        self.keys.append(key)
+        page.save(self.tiff_writer, format="TIFF", **save_options)
+        self.tiff_writer.newFrame()
+
+
+def write_normalized_ocr_tiff(image, ocr_tiff_writer):
+    """
+    Normalizes the tiff pages in batches of ocr_normalize_batch pages
+    and appends them to ocr_tiff_writer as group 4 compressed bilevel pages.
+    """
+    target_dpi = get_ocr_target_dpi()
+    batch_size = int(os.environ.get("ocr_normalize_batch", "8"))
+    batch = []
+    frames = ImageSequence.Iterator(image)
+    while True:
+        page = next(frames, None)
+        if page is not None:
+            batch.append(resample_for_ocr(page, target_dpi))
+        if batch and (page is None or len(batch) == batch_size):
+            for normalized_page in normalize_pages(batch, target_dpi):
+                ocr_tiff_writer.append(
+                    normalized_page,
+                    compression="group4",
+                    dpi=(target_dpi, target_dpi),
+                )
+            batch = []
+        if page is None:
+            return
+
+
+def write_ocr_tiff(file_path, ocr_tiff_file):
+    """
+    Parameters
+    ----------
+    file_path: file path of the multi-page tiff
+    ocr_tiff_file: multi-page tiff written for tesseract
+    Streams the pages one at a time: each page is converted to RGB,
+    scaled down and appended before the next one is decoded.
+    With ocr_normalize the pages are normalized in small batches instead.
+    Returns the OcrTiffWriter that wrote the pages
+    -------
+    """
+    with Image.open(file_path) as image, TiffImagePlugin.AppendingTiffWriter(
+        ocr_tiff_file, True
+    ) as tiff_writer:
+        ocr_tiff_writer = OcrTiffWriter(tiff_writer, get_page_ocr_cache())
+        if is_ocr_normalize_enabled():
+            write_normalized_ocr_tiff(image, ocr_tiff_writer)
+            return ocr_tiff_writer
+
+        for page in ImageSequence.Iterator(image):
+            page = page.convert("RGB")
+            x, y = page.size
+            page = page.resize((int(x - x * 0.25), int(y - y * 0.25)), Image.LANCZOS)
+            ocr_tiff_writer.append(page, compression="tiff_lzw")
+    return ocr_tiff_writer
+
+
+def split_pdf_pages(pdf_file_name):
+    """
+    Returns every page of the pdf as a single page pdf.
+    """
+    reader = PdfFileReader(pdf_file_name)
+    pages = []
+    for page in reader.pages:
+        writer = PdfFileWriter()
+        writer.addPage(page)
+        page_pdf = BytesIO()
+        writer.write(page_pdf)
+        pages.append(page_pdf.getvalue())
+    return pages
 
 
 def tiff_to_pdf(file_path, pdf_file_name):
@@ -707,45 +3629,53 @@ def tiff_to_pdf(file_path, pdf_file_name):
     file_path: file path of the image
     pdf_file_name: name of the output pdf file
 
+    The pages are OCRed by a single tesseract process,
+    which writes one pdf for the whole tiff.
     Returns True if the pdf file is created
     -------
     """
     try:
-        image = Image.open(file_path)
-        pdfs = []
-        args = []
-        for i, page in enumerate(ImageSequence.Iterator(image)):
-            stuffs = []
-            stuffs.extend([file_path, i, page.convert("RGB")])
-            args.append(stuffs)
-
-        with concurrent.futures.ThreadPoolExecutor() as executer:
-            results = executer.map(process_tiff, args)
-            for res in results:
-                pdfs.append(res)
-
-        if len(pdfs) == 1:
-            copyfile(pdfs[0], pdf_file_name)
+        filename, _ = os.path.splitext(file_path)
+        ocr_tiff_file = "".join([filename, "_ocr.tiff"])
+        ocr_tiff_writer = write_ocr_tiff(file_path, ocr_tiff_file)
+        page_sources = ocr_tiff_writer.page_sources
+        ocr_pages = len(ocr_tiff_writer.keys)
+        logger.info(
+            f"Creating PDF for {len(page_sources)} pages of: {file_path}, "
+            f"{ocr_pages} pages to OCR"
+        )
+
+        if not os.path.exists(os.path.dirname(pdf_file_name)):
+            os.makedirs(os.path.dirname(pdf_file_name), exist_ok=True)
+
+        ocr_pdf_file = "".join([filename, "_ocr.pdf"])
+        ocr_pdf_pages = []
+        if ocr_pages:
+            get_ocr_engine().run_tesseract(
+                ocr_tiff_file, ocr_pdf_file[: -len(".pdf")], ocr_pages
+            )
+            if ocr_tiff_writer.page_cache is not None:
+                ocr_pdf_pages = split_pdf_pages(ocr_pdf_file)
+                for key, page_pdf in zip(ocr_tiff_writer.keys, ocr_pdf_pages):
+                    ocr_tiff_writer.page_cache.put(key, page_pdf)
+        os.remove(ocr_tiff_file)
+
+        if page_sources == list(range(ocr_pages)):
+            os.replace(ocr_pdf_file, pdf_file_name)
         else:
-            merge_pdf(pdfs, pdf_file_name)
+            writer = PdfFileWriter()
+            for source in page_sources:
+                page_pdf = ocr_pdf_pages[source] if isinstance(source, int) else source
+                writer.addPage(PdfFileReader(BytesIO(page_pdf)).getPage(0))
+            with open(pdf_file_name, "wb") as f:
+                writer.write(f)
+            if os.path.exists(ocr_pdf_file):
+                os.remove(ocr_pdf_file)
 
         return True
 
     except Exception as _:
-        exception_type, exception_value, exception_traceback = sys.exc_info()
-        traceback_string = traceback.format_exception(
-            exception_type, exception_value, exception_traceback
-        )
-
-        err_msg = json.dumps(
-            {
-                "errorType": exception_type.__name__,
-                "errorMessage": str(exception_value),
-                "stackTrace": traceback_string,
-            }
-        )
-        logger.error(err_msg)
-
+        log_exception()
         return False
 
 
@@ -754,7 +3684,12 @@ def read_control_file(
 ):
     result = client.get_object(Bucket=bucket, Key=control_file_path)
     text = result["Body"].read().decode()
-    file_list = json.loads(text)["files"]
+    control_file = json.loads(text)
+    file_list = control_file["files"]
+    ocr_mode = control_file.get("ocr", "inline")
+    if ocr_mode not in OCR_MODES:
+        logger.info(f"Unknown ocr mode: {ocr_mode}. Using inline OCR.")
+        ocr_mode = "inline"
 
     control_file_data = []
     for item in file_list:
@@ -771,6 +3706,7 @@ def read_control_file(
                 lambda_write_path, item["source"]
             )
             source_temp_item["s3_output"] = item["source"]
+            source_temp_item["ocr"] = ocr_mode
             control_file_data.append(source_temp_item)
 
         if folder_path in item["current_img"]:
@@ -783,35 +3719,567 @@ def read_control_file(
                 lambda_write_path, item["current"]
             )
             current_temp_item["s3_output"] = item["current"]
+            current_temp_item["ocr"] = ocr_mode
             control_file_data.append(current_temp_item)
 
     return control_file_data
 
 
-def timeout_handler(_signal, _frame):
-    global unprocess_bucket
-    global unprocess_file
+def get_conversion_workers():
+    """
+    Returns the number of files converted concurrently, read from
+    conversion_workers. "auto" uses one worker per available core.
+    """
+    workers = os.environ.get("conversion_workers", "1")
+    if workers == "auto":
+        return len(os.sched_getaffinity(0))
+    return max(1, int(workers))
+
+
+def convert_group(items, s3_client, bucket_name):
+    """
+    Converts control file items that share the same input file one after
+    the other so that they never download into the same path concurrently.
+    Returns the success flags of the items.
+    """
+    return [
+        process_document_folders(
+            s3_client,
+            item["s3_input"],
+            item["efs_input"],
+            item["efs_output"],
+            item["s3_output"],
+            bucket_name,
+            item["ocr"],
+        )
+        for item in items
+    ]
 
-    logger.info("Time exceeded! Creating Unprocessed File.")
 
+def convert_group_in_worker(items, bucket_name):
+    """
+    Entry point of the process pool workers.
+    Returns the success flags of the items, the conversion cache
+    counters and the converter timings collected in the worker.
+    """
+    conversion_cache_stats.update(hits=0, misses=0)
+    converter_registry.timings = {}
     session = boto3.Session()
     s3_client = session.client(service_name="s3")
-    s3_client.put_object(
-        Body="",
-        Bucket=unprocess_bucket,
-        Key=unprocess_file.replace(
-            unprocess_file.split("/")[1], "doc_pdf/unprocessed_files"
+    flags = convert_group(items, s3_client, bucket_name)
+    return flags, dict(conversion_cache_stats), converter_registry.timings
+
+
+def get_cpu_bound_executor(workers):
+    """
+    Returns the executor used for CPU bound converters.
+    conversion_pool=process selects a process pool, which falls back to
+    threads where the platform cannot create one (no /dev/shm on Lambda).
+    The converters mostly run tesseract, wkhtmltopdf or LibreOffice as
+    subprocesses, so threads already keep all cores busy.
+    """
+    if is_sandbox_enabled():
+        # Every conversion already gets its own process.
+        return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    if os.environ.get("conversion_pool", "thread") == "process":
+        try:
+            return concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        except OSError as _:
+            logger.info("Process pool not available. Converting in threads.")
+    return concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+
+def prefetch_group(items, s3_client, bucket_name):
+    """
+    Download stage of the pipeline. Publishes the items sharing an input file
+    that need no conversion and downloads the input when any item still has
+    to be converted.
+    Returns the publish_without_conversion result of every item.
+    """
+    lookups = [
+        publish_without_conversion(
+            s3_client,
+            item["s3_input"],
+            item["efs_input"],
+            item["s3_output"],
+            bucket_name,
+            item["ocr"],
+        )
+        for item in items
+    ]
+    if any(published is None for published, _ in lookups):
+        download_file(
+            prefix=items[0]["s3_input"],
+            destination_pathname=items[0]["efs_input"],
+            bucket=bucket_name,
+            client=s3_client,
+        )
+        lookups = [
+            (
+                (published, cache_key)
+                if published is not None
+                else publish_from_sniffed_cache(
+                    s3_client,
+                    item["s3_input"],
+                    item["efs_input"],
+                    item["s3_output"],
+                    bucket_name,
+                    item["ocr"],
+                    cache_key,
+                )
+            )
+            for item, (published, cache_key) in zip(items, lookups)
+        ]
+    return lookups
+
+
+def upload_and_remove(item, s3_client, bucket_name, cache_key, converted):
+    """
+    Upload stage of the pipeline. Removes the local pdf once it is uploaded.
+    Returns the success flag of the item.
+    """
+    try:
+        return upload_converted_file(
+            s3_client,
+            item["s3_input"],
+            item["efs_input"],
+            item["efs_output"],
+            item["s3_output"],
+            bucket_name,
+            cache_key,
+            converted,
+        )
+    finally:
+        if os.path.isfile(item["efs_output"]):
+            os.remove(item["efs_output"])
+
+
+def get_disk_usage(path):
+    """
+    Returns the bytes taken by the files under path.
+    """
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError as _:
+                pass
+    return total
+
+
+def convert_items_pipelined(items, groups, s3_client, bucket_name, prefetch):
+    """
+    Converts the items one at a time while the next `prefetch` inputs are
+    downloaded and finished pdfs are uploaded in the background.
+    At most pipeline_uploads pdfs wait for upload, inputs are removed once
+    converted and the converters remove their intermediate files, which
+    keeps the space used in lambda_write_path bounded. With pipeline_disk_mb
+    inputs are prefetched one after the other and none while the files under
+    lambda_write_path, intermediates included, take more than that.
+    Returns the success flag of every item in the order of the items.
+    """
+    disk_budget = int(os.environ.get("pipeline_disk_mb", "0")) * 1024 * 1024
+    write_path = os.environ.get("lambda_write_path", "")
+    max_uploads = int(os.environ.get("pipeline_uploads", "2"))
+    upload_slots = threading.BoundedSemaphore(max_uploads)
+    download_executor = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch)
+    upload_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_uploads)
+    logger.info(
+        f"Converting {len(groups)} files with {prefetch} prefetched inputs "
+        f"and {max_uploads} background uploads."
+    )
+
+    all_flags = [False] * len(items)
+    remaining = {}
+    for item in items:
+        remaining[item["s3_input"]] = remaining.get(item["s3_input"], 0) + 1
+
+    def release_in_flight(s3_input_file):
+        with in_flight_lock:
+            remaining[s3_input_file] -= 1
+            if remaining[s3_input_file] == 0:
+                in_flight_files.pop(s3_input_file, None)
+
+    uploads = []
+    uploads_by_output = {}
+    downloads = deque()
+    next_group = 0
+
+    try:
+        while next_group < len(groups) or downloads:
+            while next_group < len(groups) and len(downloads) < prefetch:
+                # The space an input takes is only known once it is in.
+                if (
+                    downloads
+                    and disk_budget
+                    and (
+                        not downloads[-1][1].done()
+                        or get_disk_usage(write_path) > disk_budget
+                    )
+                ):
+                    break
+                group_items = [items[i] for i in groups[next_group]]
+                downloads.append(
+                    (
+                        groups[next_group],
+                        download_executor.submit(
+                            prefetch_group, group_items, s3_client, bucket_name
+                        ),
+                    )
+                )
+                next_group += 1
+
+            group, download = downloads.popleft()
+            s3_input_file = items[group[0]]["s3_input"]
+            try:
+                lookups = download.result()
+            except Exception as _:
+                log_exception()
+                create_unprocessed_file(bucket_name, s3_input_file)
+                for _ in group:
+                    release_in_flight(s3_input_file)
+                continue
+
+            for i, (published, cache_key) in zip(group, lookups):
+                item = items[i]
+                if published is not None:
+                    all_flags[i] = published
+                    release_in_flight(item["s3_input"])
+                    continue
+
+                pending_upload = uploads_by_output.get(item["efs_output"])
+                if pending_upload is not None:
+                    concurrent.futures.wait([pending_upload])
+
+                converted, Success_Flag = convert_document_with_limits(
+                    s3_client,
+                    item["s3_input"],
+                    item["efs_input"],
+                    item["efs_output"],
+                    item["s3_output"],
+                    bucket_name,
+                    cache_key,
+                    item["ocr"],
+                )
+                all_flags[i] = Success_Flag
+
+                upload_slots.acquire()
+                upload = upload_executor.submit(
+                    upload_and_remove,
+                    item,
+                    s3_client,
+                    bucket_name,
+                    cache_key,
+                    converted,
+                )
+                upload.add_done_callback(lambda _: upload_slots.release())
+                upload.add_done_callback(
+                    lambda _, key=item["s3_input"]: release_in_flight(key)
+                )
+                uploads_by_output[item["efs_output"]] = upload
+                uploads.append((i, upload))
+
+            if os.path.isfile(items[group[0]]["efs_input"]):
+                os.remove(items[group[0]]["efs_input"])
+
+        for i, upload in uploads:
+            try:
+                all_flags[i] = upload.result() and all_flags[i]
+            except Exception as _:
+                log_exception()
+                create_unprocessed_file(bucket_name, items[i]["s3_input"])
+                all_flags[i] = False
+    finally:
+        download_executor.shutdown()
+        upload_executor.shutdown()
+
+    return all_flags
+
+
+def get_lambda_client():
+    """
+    Returns a lambda client that waits for long doc_to_pdf batches
+    instead of timing out and retrying them.
+    """
+    return boto3.client(
+        "lambda",
+        config=Config(
+            read_timeout=int(os.environ.get("doc_to_pdf_timeout", "900")),
+            retries={"max_attempts": 0},
+        ),
+    )
+
+
+def invoke_doc_to_pdf(lambda_client, files):
+    """
+    Parameters
+    ----------
+    lambda_client: boto3 lambda client
+    files: (s3_input_file, s3_output_file) of the Word documents
+    Returns
+    -------
+    whether the doc_to_pdf lambda created and uploaded each pdf
+    """
+    payload = json.dumps(
+        {
+            "files": [
+                {"s3_input_file": s3_input_file, "s3_output_file": s3_output_file}
+                for s3_input_file, s3_output_file in files
+            ]
+        }
+    )
+    logger.info(f"Invoking Doc Processing Lambda for {len(files)} documents")
+    response = lambda_client.invoke(
+        FunctionName=os.environ["doc_to_pdf_arn"],
+        InvocationType="RequestResponse",
+        Payload=payload,
+    )
+    result = json.loads(response["Payload"].read())
+    return [file["response"] for file in result["files"]]
+
+
+def is_doc_item(item):
+    converter = converter_registry.for_extension(item["efs_input"], item["ocr"])
+    return converter is not None and converter.name == "doc"
+
+
+def convert_doc_items(items, s3_client, bucket_name):
+    """
+    Converts Word documents with the doc_to_pdf lambda without downloading
+    them, doc_batch_size documents per request and doc_batch_concurrency
+    requests at a time.
+    Returns the success flags of the items.
+    """
+    flags = [False] * len(items)
+    pending = []
+    for i, item in enumerate(items):
+        published, cache_key = publish_without_conversion(
+            s3_client,
+            item["s3_input"],
+            item["efs_input"],
+            item["s3_output"],
+            bucket_name,
+            item["ocr"],
+        )
+        if published is not None:
+            flags[i] = published
+            with in_flight_lock:
+                in_flight_files.pop(item["s3_input"], None)
+        else:
+            pending.append((i, cache_key))
+
+    batch_size = int(os.environ.get("doc_batch_size", "10"))
+    batches = [
+        pending[start : start + batch_size]
+        for start in range(0, len(pending), batch_size)
+    ]
+    if not batches:
+        return flags
+
+    lambda_client = get_lambda_client()
+    concurrency = int(os.environ.get("doc_batch_concurrency", "4"))
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(concurrency, len(batches))
+    ) as executor:
+        futures = {
+            executor.submit(
+                invoke_doc_to_pdf,
+                lambda_client,
+                [(items[i]["s3_input"], items[i]["s3_output"]) for i, _ in batch],
+            ): batch
+            for batch in batches
+        }
+        for future in concurrent.futures.as_completed(futures):
+            batch = futures[future]
+            try:
+                responses = future.result()
+            except Exception as _:
+                log_exception()
+                responses = [False] * len(batch)
+
+            for (i, cache_key), uploaded in zip(batch, responses):
+                item = items[i]
+                if uploaded:
+                    logger.info(f"{item['efs_input']} Processed")
+                    if cache_key is not None:
+                        try:
+                            conversion_cache.put_from_s3(
+                                cache_key, s3_client, bucket_name, item["s3_output"]
+                            )
+                        except Exception as _:
+                            log_exception()
+                else:
+                    logger.info(
+                        f"PDF not created for: {item['efs_input']}. "
+                        "Creating Unprocessed File."
+                    )
+                    create_unprocessed_file(bucket_name, item["s3_input"])
+                flags[i] = bool(uploaded)
+                with in_flight_lock:
+                    in_flight_files.pop(item["s3_input"], None)
+    return flags
+
+
+def convert_items(items, s3_client, bucket_name):
+    """
+    Parameters
+    ----------
+    items: filtered control file items
+    s3_client: S3 Session Client Object
+    bucket_name: bucket of the documents
+    Returns
+    -------
+    success flag of every item in the order of the items
+    """
+    doc_indexes = [i for i, item in enumerate(items) if is_doc_item(item)]
+    if doc_indexes and os.environ.get("doc_batching", "true") == "true":
+        with in_flight_lock:
+            for i in doc_indexes:
+                in_flight_files[items[i]["s3_input"]] = bucket_name
+        other_indexes = sorted(set(range(len(items))) - set(doc_indexes))
+
+        # The Word documents are converted remotely while the other
+        # files are converted here.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as doc_executor:
+            doc_future = doc_executor.submit(
+                convert_doc_items,
+                [items[i] for i in doc_indexes],
+                s3_client,
+                bucket_name,
+            )
+            other_flags = convert_items(
+                [items[i] for i in other_indexes], s3_client, bucket_name
+            )
+            doc_flags = doc_future.result()
+
+        all_flags = [False] * len(items)
+        for indexes, flags in ((doc_indexes, doc_flags), (other_indexes, other_flags)):
+            for i, flag in zip(indexes, flags):
+                all_flags[i] = flag
+        return all_flags
+
+    groups = {}
+    for i, item in enumerate(items):
+        groups.setdefault(item["efs_input"], []).append(i)
+
+    with in_flight_lock:
+        for item in items:
+            in_flight_files[item["s3_input"]] = bucket_name
+
+    workers = get_conversion_workers()
+    prefetch = int(os.environ.get("pipeline_prefetch", "0"))
+
+    if workers == 1 and prefetch > 0:
+        return convert_items_pipelined(
+            items, list(groups.values()), s3_client, bucket_name, prefetch
+        )
+
+    all_flags = [False] * len(items)
+
+    if workers == 1 or len(groups) == 1:
+        for group in groups.values():
+            flags = convert_group([items[i] for i in group], s3_client, bucket_name)
+            for i, flag in zip(group, flags):
+                all_flags[i] = flag
+            with in_flight_lock:
+                in_flight_files.pop(items[group[0]]["s3_input"], None)
+        return all_flags
+
+    logger.info(f"Converting {len(groups)} files with {workers} workers.")
+    io_executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    cpu_executor = get_cpu_bound_executor(workers)
+    in_process = isinstance(cpu_executor, concurrent.futures.ThreadPoolExecutor)
+
+    converters = {
+        efs_input: converter_registry.for_extension(efs_input, items[group[0]]["ocr"])
+        for efs_input, group in groups.items()
+    }
+    # The costliest files are started first so that they do not end up
+    # running alone at the end of the invocation.
+    ordered_inputs = sorted(
+        groups,
+        key=lambda efs_input: -(
+            converters[efs_input].cost if converters[efs_input] is not None else 1
         ),
     )
 
+    futures = {}
+    for efs_input in ordered_inputs:
+        group = groups[efs_input]
+        group_items = [items[i] for i in group]
+        converter = converters[efs_input]
+        if converter is not None and converter.bound == "io":
+            future = io_executor.submit(
+                convert_group, group_items, s3_client, bucket_name
+            )
+        elif in_process:
+            future = cpu_executor.submit(
+                convert_group, group_items, s3_client, bucket_name
+            )
+        else:
+            future = cpu_executor.submit(
+                convert_group_in_worker, group_items, bucket_name
+            )
+        futures[future] = group
+
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            group = futures[future]
+            s3_input_file = items[group[0]]["s3_input"]
+            try:
+                result = future.result()
+                if isinstance(result, tuple):
+                    flags, worker_stats, worker_timings = result
+                    with stats_lock:
+                        for name, count in worker_stats.items():
+                            conversion_cache_stats[name] += count
+                    converter_registry.merge(worker_timings)
+                else:
+                    flags = result
+            except Exception as _:
+                log_exception()
+                create_unprocessed_file(bucket_name, s3_input_file)
+                flags = [False] * len(group)
+
+            for i, flag in zip(group, flags):
+                all_flags[i] = flag
+            with in_flight_lock:
+                in_flight_files.pop(s3_input_file, None)
+    finally:
+        io_executor.shutdown()
+        cpu_executor.shutdown()
+
+    return all_flags
+
+
+def timeout_handler(_signal, _frame):
+    logger.info("Time exceeded! Creating Unprocessed Files.")
+
+    with in_flight_lock:
+        pending_files = list(in_flight_files.items())
+
+    for s3_input_file, bucket_name in pending_files:
+        create_unprocessed_file(bucket_name, s3_input_file)
+
 
 signal.signal(signal.SIGALRM, timeout_handler)
 
 
 def lambda_handler(event, context):
+    global invocation_deadline
+
     try:
         signal.alarm(int(context.get_remaining_time_in_millis() / 1000) - 15)
+        invocation_deadline = (
+            time.monotonic() + context.get_remaining_time_in_millis() / 1000 - 20
+        )
+        # A failed or timed out invocation of a warm container may have left
+        # files behind, which are not for this invocation to mark unprocessed.
+        with in_flight_lock:
+            in_flight_files.clear()
         logger.info(f"event: {event}")
+        conversion_cache_stats.update(hits=0, misses=0)
         trigger_bucket_name = event["Records"][0]["s3"]["bucket"]["name"]
         folder_path = event["Records"][0]["s3"]["object"]["key"]
         s3_folder = folder_path.split("/")[0]
@@ -837,17 +4305,38 @@ def lambda_handler(event, context):
             lambda_write_path=lambda_write_path,
         )
 
-        all_flags = []
-        for item in filtered_control_file:
-            Success_Flag = process_document_folders(
-                s3_client,
-                item["s3_input"],
-                item["efs_input"],
-                item["efs_output"],
-                item["s3_output"],
-                bucket_name,
+        all_flags = convert_items(filtered_control_file, s3_client, bucket_name)
+
+        converter_registry.log_timings()
+
+        if html_renderer is not None:
+            logger.info(f"HTML renderer stats: {html_renderer.stats()}")
+            html_renderer.reset_stats()
+
+        if ocr_engine is not None:
+            logger.info(f"OCR engine stats: {ocr_engine.stats()}")
+            ocr_engine.reset_stats()
+
+        if page_ocr_cache is not None:
+            logger.info(
+                f"OCR page cache for case {s3_folder}: {page_ocr_cache.hit_rate()}"
+            )
+            page_ocr_cache.reset_stats()
+            if page_ocr_cache.shared_store is not None:
+                try:
+                    page_ocr_cache.shared_store.evict()
+                except Exception as _:
+                    log_exception()
+
+        if conversion_cache is not None:
+            logger.info(
+                f"Conversion cache hits: {conversion_cache_stats['hits']}, "
+                f"misses: {conversion_cache_stats['misses']}"
             )
-            all_flags.append(Success_Flag)
+            try:
+                conversion_cache.evict()
+            except Exception as _:
+                log_exception()
 
         s3_client.delete_object(Bucket=trigger_bucket_name, Key=folder_path)
 
@@ -874,19 +4363,13 @@ def lambda_handler(event, context):
         )
 
         if no_of_success_files == total_no_of_trigger_files:
-            logger.info(
-                f"All files are processed. Creating merge file {control_file_path}"
-            )
-
-            try:
-                s3_client.head_object(
-                    Bucket=merge_trigger_bucket, Key=control_file_path
-                )
-
-            except ClientError as _:
-                create_merge_trigger_file(
-                    s3_client, merge_trigger_bucket, control_file_path
+            if not hold_merge_for_ocr(
+                s3_client, bucket_name, control_file_path, merge_trigger_bucket
+            ):
+                logger.info(
+                    f"All files are processed. Creating merge file {control_file_path}"
                 )
+                trigger_merge(s3_client, merge_trigger_bucket, control_file_path)
 
     except Exception as _:
         exception_type, exception_value, exception_traceback = sys.exc_info()
@@ -905,3 +4388,80 @@ def lambda_handler(event, context):
 
     if os.path.exists(lambda_write_path):
         rmtree(lambda_write_path, ignore_errors=True)
+
+
+def process_ocr_job(s3_client, bucket_name, ocr_job_key, lambda_write_path):
+    """
+    Parameters
+    ----------
+    s3_client: S3 Session Client Object
+    bucket_name: bucket of the documents
+    ocr_job_key: key of the job left by create_ocr_job
+    lambda_write_path: local folder for the downloaded files
+    Returns True once the text layer is added and the job removed
+    -------
+    """
+    try:
+        result = s3_client.get_object(Bucket=bucket_name, Key=ocr_job_key)
+        ocr_job = json.loads(result["Body"].read().decode())
+        input_file = os.path.join(lambda_write_path, ocr_job["s3_input_file"])
+        pdf_file_name = os.path.join(lambda_write_path, ocr_job["s3_output_file"])
+
+        download_file(ocr_job["s3_input_file"], input_file, bucket_name, s3_client)
+        download_file(ocr_job["s3_output_file"], pdf_file_name, bucket_name, s3_client)
+
+        logger.info(f"Adding OCR text layer to: {ocr_job['s3_output_file']}")
+        add_ocr_text_layer(input_file, pdf_file_name)
+        s3_client.upload_file(pdf_file_name, bucket_name, ocr_job["s3_output_file"])
+        s3_client.delete_object(Bucket=bucket_name, Key=ocr_job_key)
+
+        for local_file in (input_file, pdf_file_name):
+            os.remove(local_file)
+        return True
+
+    except Exception as _:
+        log_exception()
+        logger.info(f"OCR job left for retry: {ocr_job_key}")
+        return False
+
+
+def ocr_lambda_handler(event, context):
+    """
+    Enrichment pass for cases converted with the "deferred" ocr mode.
+    Runs for the OCR jobs in the S3 put events of the jobs or, when
+    scheduled with {"prefix": "<case>/doc_pdf/ocr_pending/"}, for all
+    jobs under the prefix while time remains.
+
+    Parameters
+    ----------
+    event: lambda event
+    context: lambda context
+    """
+    logger.info(f"event: {event}")
+    lambda_write_path = os.environ["lambda_write_path"]
+    bucket_name = os.environ["main_s3_bucket"]
+    session = boto3.Session()
+    s3_client = session.client(service_name="s3")
+
+    if "Records" in event:
+        ocr_job_keys = [record["s3"]["object"]["key"] for record in event["Records"]]
+    else:
+        ocr_job_keys = list_dir(event["prefix"], bucket_name, s3_client)
+
+    processed = 0
+    for ocr_job_key in ocr_job_keys:
+        if context.get_remaining_time_in_millis() < 60000:
+            logger.info("Not enough time left. Remaining OCR jobs are kept.")
+            break
+        if process_ocr_job(s3_client, bucket_name, ocr_job_key, lambda_write_path):
+            processed += 1
+
+    logger.info(f"OCR jobs processed: {processed} of {len(ocr_job_keys)}")
+
+    for s3_folder in sorted(
+        {ocr_job_key.split("/")[0] for ocr_job_key in ocr_job_keys}
+    ):
+        try:
+            release_held_merges(s3_client, bucket_name, s3_folder)
+        except Exception as _:
+            log_exception()
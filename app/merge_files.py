@@ -4,13 +4,31 @@ This will generate two pdf documents based on current and source keys in control
 The control file has paths to the converted pdfs that needs to be merged.
 """
 
+import concurrent.futures
+import hashlib
+import io
 import json
+import multiprocessing
+import multiprocessing.connection
 import os
 
-from shutil import copyfile, rmtree
+from shutil import copyfileobj, rmtree
 
 import boto3
-from PyPDF2 import PdfFileMerger, PdfFileReader
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError, ParamValidationError
+from PyPDF2 import PdfFileReader
+from PyPDF2.generic import (
+    ArrayObject,
+    ByteStringObject,
+    DictionaryObject,
+    IndirectObject,
+    NameObject,
+    NullObject,
+    NumberObject,
+    StreamObject,
+    TextStringObject,
+)
 
 import traceback
 
@@ -47,73 +65,901 @@ def init():
     ]
 
 
-def merge_pdf(pdfs, filename, batchsize):
+# Parsed PyPDF2 objects take several times the size of the file on disk.
+PDF_MEMORY_FACTOR = 4
+PAGES_NUMBER = 2
+INHERITABLE_PAGE_ATTRIBUTES = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+
+
+def get_merge_memory_budget():
+    """
+    Returns the bytes a merge may hold in memory, merge_memory_mb or half of
+    the lambda memory.
+    """
+    memory_mb = os.environ.get(
+        "merge_memory_mb",
+        int(os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE", "1024")) // 2,
+    )
+    return int(memory_mb) << 20
+
+
+def object_key(pdf_object):
+    if isinstance(pdf_object, IndirectObject):
+        return pdf_object.idnum, pdf_object.generation
+    return None
+
+
+def has_references(pdf_object):
+    if isinstance(pdf_object, IndirectObject):
+        return True
+    if isinstance(pdf_object, DictionaryObject):
+        return any(map(has_references, dict.values(pdf_object)))
+    if isinstance(pdf_object, ArrayObject):
+        return any(map(has_references, list.__iter__(pdf_object)))
+    return False
+
+
+def stream_digest(pdf_object):
+    """
+    Returns a digest identifying a self-contained stream such as a font or
+    an image, or None for anything else.
+    """
+    if not isinstance(pdf_object, StreamObject):
+        return None
+    entries = [
+        (name, value) for name, value in dict.items(pdf_object) if name != "/Length"
+    ]
+    if has_references(ArrayObject(value for _, value in entries)):
+        return None
+    digest = hashlib.sha1(repr(sorted(entries)).encode())
+    digest.update(pdf_object._data)
+    return digest.digest()
+
+
+class OutputReference(IndirectObject):
+    """
+    A reference written by a StreamingPdfMerger, recording where it was
+    written when the merger builds a fragment.
+    """
+
+    def write_to_stream(self, stream, encryption_key):
+        if self.pdf.references is not None:
+            self.pdf.references.append((stream.tell(), self.idnum))
+        stream.write(b"%d %d R" % (self.idnum, self.generation))
+
+    writeToStream = write_to_stream
+
+
+def destination_name(value):
+    """Returns the name of a named destination, None for anything else"""
+    if isinstance(value, NameObject):
+        return value[1:]
+    if isinstance(value, ByteStringObject):
+        return value.decode("latin-1")
+    if isinstance(value, TextStringObject):
+        return str(value)
+    return None
+
+
+class DestinationName(TextStringObject):
     """
+    The name of a named destination written by a StreamingPdfMerger,
+    recording where it was written when the merger builds a fragment, so
+    that stitch_pdf can rename it.
+    """
+
+    def __new__(cls, name, pdf):
+        destination = super().__new__(cls, name)
+        destination.pdf = pdf
+        return destination
+
+    def write_to_stream(self, stream, encryption_key):
+        start = stream.tell()
+        TextStringObject.write_to_stream(self, stream, encryption_key)
+        if self.pdf.name_references is not None:
+            self.pdf.name_references.append((start, stream.tell() - start, str(self)))
+
+    writeToStream = write_to_stream
+
+
+class StreamingPdfMerger:
+    """
+    Appends the pages of pdf files to one output file. Every object of an
+    input is written out as soon as it is copied and the input is closed
+    before the next one is opened, so only one input is held in memory.
+    Top level bookmarks are kept back and chained together on close.
+    Named destinations are carried over into the name tree of the output,
+    renamed where an earlier input already used the name. Like the
+    PdfFileMerger it replaces, forms and page labels are not.
+
+    A fragment merger writes only the objects and records where every
+    object number was written, so that fragments merged in parallel can be
+    stitched together by stitch_pdf without parsing them again.
+    """
+
+    def __init__(self, filename, fragment=False):
+        self.file = open(filename, "wb")
+        if fragment:
+            self.objects = []
+            self.references = []
+            self.name_references = []
+        else:
+            self.objects = None
+            self.references = None
+            self.name_references = None
+            self.file.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+        # Object 1 is the catalog, 2 the page tree, both written on close.
+        self.offsets = [None, None]
+        self.page_numbers = []
+        self.outlines_number = None
+        self.outline_numbers = []
+        self.outline_items = []
+        # Fonts and images repeated across inputs are written only once.
+        self.stream_numbers = {}
+        # Named destination numbers, and the names of the input being
+        # appended renamed to.
+        self.destinations = {}
+        self.renames = {}
+
+    def reserve(self):
+        self.offsets.append(None)
+        return len(self.offsets)
+
+    def reference(self, number):
+        return OutputReference(number, 0, self)
+
+    def write_header(self, number):
+        self.offsets[number - 1] = self.file.tell()
+        if self.objects is not None:
+            self.objects.append((self.file.tell(), number))
+        self.file.write(b"%d 0 obj\n" % number)
+
+    def write(self, number, pdf_object):
+        self.write_header(number)
+        pdf_object.writeToStream(self.file, None)
+        self.file.write(b"\nendobj\n")
+
+    def copy(self, pdf_object, numbers, pending, skip=()):
+        """
+        Copies a direct object, giving the indirect objects it refers to
+        their number in the output and queueing the unseen ones in pending.
+        """
+        if isinstance(pdf_object, IndirectObject):
+            key = object_key(pdf_object)
+            if key not in numbers:
+                digest = stream_digest(pdf_object.getObject())
+                if digest in self.stream_numbers:
+                    numbers[key] = self.stream_numbers[digest]
+                else:
+                    numbers[key] = self.reserve()
+                    pending.append((numbers[key], pdf_object))
+                    if digest is not None:
+                        self.stream_numbers[digest] = numbers[key]
+            return self.reference(numbers[key])
+
+        if isinstance(pdf_object, DictionaryObject):
+            if isinstance(pdf_object, StreamObject):
+                copied = type(pdf_object)()
+                copied._data = pdf_object._data
+                # The length is rewritten from the data.
+                skip = skip + ("/Length",)
+            else:
+                copied = DictionaryObject()
+            for name, value in dict.items(pdf_object):
+                if name not in skip:
+                    copied[name] = self.copy(value, numbers, pending)
+            self.rename_destination(copied)
+            return copied
+
+        if isinstance(pdf_object, ArrayObject):
+            return ArrayObject(
+                self.copy(value, numbers, pending)
+                for value in list.__iter__(pdf_object)
+            )
+
+        return pdf_object
+
+    def rename_destination(self, dictionary):
+        """Points the named destination of a link, bookmark or action at its name"""
+        for key in ("/Dest", "/D"):
+            if key == "/D" and dict.get(dictionary, "/S") != "/GoTo":
+                continue
+            name = destination_name(dict.get(dictionary, key))
+            if name is not None:
+                dictionary[NameObject(key)] = DestinationName(
+                    self.renames.get(name, name), self
+                )
+
+    def unique_name(self, name):
+        unique, index = name, 1
+        while unique in self.destinations:
+            unique, index = f"{name}-{index}", index + 1
+        return unique
+
+    def named_destinations(self, catalog):
+        """
+        Returns the (name, destination) pairs of the name tree and of the
+        /Dests dictionary of a pdf.
+        """
+        destinations = []
+        names = dict.get(catalog, "/Names")
+        if isinstance(names, IndirectObject):
+            names = names.getObject()
+        stack = []
+        if isinstance(names, DictionaryObject) and "/Dests" in names:
+            stack.append(dict.__getitem__(names, "/Dests"))
+        seen = set()
+        while stack:
+            reference = stack.pop()
+            if object_key(reference) in seen:
+                continue
+            if object_key(reference) is not None:
+                seen.add(object_key(reference))
+            node = reference.getObject()
+            pairs = list(list.__iter__(node.get("/Names", ArrayObject())))
+            destinations.extend(zip(pairs[0::2], pairs[1::2]))
+            stack.extend(list.__iter__(node.get("/Kids", ArrayObject())))
+        if "/Dests" in catalog:
+            destinations.extend(dict.items(catalog["/Dests"]))
+        return [
+            (destination_name(name), value)
+            for name, value in destinations
+            if destination_name(name) is not None
+        ]
+
+    def flush(self, numbers, pending, cache=None):
+        """
+        Writes the queued objects. Streams are dropped from the cache of the
+        reader when one is given, they are read again should they be needed.
+        """
+        while pending:
+            number, reference = pending.pop()
+            pdf_object = reference.getObject()
+            if pdf_object is None:
+                pdf_object = NullObject()
+            self.write(number, self.copy(pdf_object, numbers, pending))
+            if cache is not None and isinstance(pdf_object, StreamObject):
+                cache.pop((reference.generation, reference.idnum), None)
+
+    def pages(self, catalog, numbers):
+        """
+        Yields the pages of the page tree in order with the attributes they
+        inherit. The page tree nodes themselves map onto the output page tree.
+        """
+        stack = [(dict.__getitem__(catalog, "/Pages"), {})]
+        seen = set()
+        while stack:
+            reference, inherited = stack.pop()
+            if object_key(reference) in seen:
+                continue
+            if object_key(reference) is not None:
+                seen.add(object_key(reference))
+            node = reference.getObject()
+            if "/Kids" not in node:
+                yield reference, node, inherited
+                continue
+
+            if object_key(reference) is not None:
+                numbers[object_key(reference)] = PAGES_NUMBER
+            inherited = dict(inherited)
+            for name in INHERITABLE_PAGE_ATTRIBUTES:
+                if name in node:
+                    inherited[name] = dict.__getitem__(node, name)
+            kids = list.__iter__(node["/Kids"])
+            stack.extend((kid, inherited) for kid in reversed(list(kids)))
+
+    def append(self, pdf_file, buffered=True):
+        """
+        Appends the pages and bookmarks of a pdf. A buffered pdf is read into
+        memory at once, otherwise it is parsed from the file and its streams
+        are released page by page.
+        """
+        with open(pdf_file, "rb") as file:
+            stream = io.BytesIO(file.read()) if buffered else file
+            reader = PdfFileReader(stream, strict=False)
+            if reader.isEncrypted:
+                reader.decrypt("")
+            cache = None
+            if not buffered:
+                cache = getattr(reader, "resolved_objects", None)
+                if cache is None:
+                    cache = reader.resolvedObjects
+            catalog_reference = dict.__getitem__(reader.trailer, "/Root")
+            catalog = catalog_reference.getObject()
+            numbers = {object_key(catalog_reference): 1}
+            pending = []
+
+            pages = []
+            for reference, page, inherited in self.pages(catalog, numbers):
+                number = self.reserve()
+                if object_key(reference) is not None:
+                    numbers[object_key(reference)] = number
+                pages.append((number, page, inherited))
+                self.page_numbers.append(number)
+
+            destinations = []
+            self.renames = {}
+            for name, value in self.named_destinations(catalog):
+                if name not in self.renames:
+                    self.renames[name] = self.unique_name(name)
+                    self.destinations[self.renames[name]] = self.reserve()
+                    destinations.append((self.destinations[self.renames[name]], value))
+
+            outline_items = self.outline_references(catalog)
+            for reference in outline_items:
+                numbers[object_key(reference)] = self.reserve()
+            if outline_items:
+                numbers[object_key(dict.__getitem__(catalog, "/Outlines"))] = (
+                    self.get_outlines_number()
+                )
+
+            for number, page, inherited in pages:
+                copied = self.copy(page, numbers, pending, skip=("/Parent",))
+                for name, value in inherited.items():
+                    if name not in copied:
+                        copied[NameObject(name)] = self.copy(value, numbers, pending)
+                copied[NameObject("/Parent")] = self.reference(PAGES_NUMBER)
+                self.write(number, copied)
+                self.flush(numbers, pending, cache)
+
+            for number, value in destinations:
+                if isinstance(value, IndirectObject):
+                    value = value.getObject()
+                self.write(number, self.copy(value, numbers, pending))
+                self.flush(numbers, pending)
+
+            for reference in outline_items:
+                copied = self.copy(
+                    reference.getObject(),
+                    numbers,
+                    pending,
+                    skip=("/Parent", "/Prev", "/Next"),
+                )
+                self.outline_items.append((numbers[object_key(reference)], copied))
+                self.outline_numbers.append(numbers[object_key(reference)])
+                self.flush(numbers, pending)
+
+    def outline_references(self, catalog):
+        """Returns the references to the top level bookmarks of a pdf"""
+        if "/Outlines" not in catalog:
+            return []
+        references = []
+        reference = dict.get(catalog["/Outlines"], "/First")
+        while isinstance(reference, IndirectObject) and reference not in references:
+            references.append(reference)
+            reference = dict.get(reference.getObject(), "/Next")
+        return references
+
+    def get_outlines_number(self):
+        if self.outlines_number is None:
+            self.outlines_number = self.reserve()
+        return self.outlines_number
+
+    def write_outline_items(self):
+        """
+        Writes the held back top level bookmarks of a fragment without their
+        /Parent, /Prev and /Next, recording where stitch_pdf inserts them.
+        """
+        insertions = []
+        for number, item in self.outline_items:
+            self.write_header(number)
+            self.file.write(b"<<\n")
+            for name, value in item.items():
+                name.writeToStream(self.file, None)
+                self.file.write(b" ")
+                value.writeToStream(self.file, None)
+                self.file.write(b"\n")
+            insertions.append((self.file.tell(), number))
+            self.file.write(b">>\nendobj\n")
+        return insertions
+
+    def close_fragment(self):
+        """Closes a fragment merger, returning what stitch_pdf needs to know"""
+        outline_items = self.write_outline_items()
+        fragment = {
+            "size": len(self.offsets),
+            "objects": self.objects,
+            "references": self.references,
+            "pages": self.page_numbers,
+            "outlines": self.outlines_number,
+            "outline_items": outline_items,
+            "destinations": list(self.destinations.items()),
+            "name_references": self.name_references,
+        }
+        self.file.close()
+        return fragment
+
+    def close(self):
+        catalog = DictionaryObject(
+            {
+                NameObject("/Type"): NameObject("/Catalog"),
+                NameObject("/Pages"): self.reference(PAGES_NUMBER),
+            }
+        )
+        if self.outlines_number is not None:
+            outlines = self.reference(self.outlines_number)
+            item_references = list(map(self.reference, self.outline_numbers))
+            positions = {
+                number: index for index, number in enumerate(self.outline_numbers)
+            }
+            for number, item in self.outline_items:
+                index = positions[number]
+                item[NameObject("/Parent")] = outlines
+                if index:
+                    item[NameObject("/Prev")] = item_references[index - 1]
+                if index + 1 < len(item_references):
+                    item[NameObject("/Next")] = item_references[index + 1]
+                self.write(number, item)
+            root = DictionaryObject(
+                {
+                    NameObject("/Type"): NameObject("/Outlines"),
+                    NameObject("/Count"): NumberObject(len(item_references)),
+                }
+            )
+            if item_references:
+                root[NameObject("/First")] = item_references[0]
+                root[NameObject("/Last")] = item_references[-1]
+            self.write(self.outlines_number, root)
+            catalog[NameObject("/Outlines")] = outlines
+        if self.destinations:
+            names = ArrayObject()
+            for name in sorted(self.destinations):
+                names.append(TextStringObject(name))
+                names.append(self.reference(self.destinations[name]))
+            catalog[NameObject("/Names")] = DictionaryObject(
+                {NameObject("/Dests"): DictionaryObject({NameObject("/Names"): names})}
+            )
+        self.write(1, catalog)
+        self.write(
+            PAGES_NUMBER,
+            DictionaryObject(
+                {
+                    NameObject("/Type"): NameObject("/Pages"),
+                    NameObject("/Count"): NumberObject(len(self.page_numbers)),
+                    NameObject("/Kids"): ArrayObject(
+                        map(self.reference, self.page_numbers)
+                    ),
+                }
+            ),
+        )
+
+        # Numbers left unused by stitched fragments are free entries.
+        xref = self.file.tell()
+        self.file.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(self.offsets) + 1))
+        for offset in self.offsets:
+            if offset is None:
+                self.file.write(b"0000000000 00000 f \n")
+            else:
+                self.file.write(b"%010d 00000 n \n" % offset)
+        self.file.write(
+            b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+            % (len(self.offsets) + 1, xref)
+        )
+        self.file.close()
+
+
+def stitch_pdf(fragments, filename, complete):
+    """
+    Concatenates fragments written by fragment mergers, renumbering their
+    objects at the recorded positions instead of parsing them again.
+
+    Parameters
+    ----------
+    fragments: (data file, fragment) pairs in page order
+    filename: the merged pdf when complete, a fragment otherwise
+    complete: whether to write a pdf or a fragment for the next level
+    Returns: the fragment written when not complete
+    -------
+    """
+    merger = StreamingPdfMerger(filename, fragment=not complete)
+    insertions = []
+    outlines = None
+    if any(fragment["outline_items"] for _, fragment in fragments):
+        outlines = merger.get_outlines_number()
+    bases = []
+    renames = []
+    for _, fragment in fragments:
+        bases.append(len(merger.offsets))
+        merger.offsets.extend([None] * fragment["size"])
+        for _, number in fragment["outline_items"]:
+            merger.outline_numbers.append(bases[-1] + number)
+        renames.append({})
+        for name, number in fragment["destinations"]:
+            renames[-1][name] = merger.unique_name(name)
+            merger.destinations[renames[-1][name]] = bases[-1] + number
+    neighbours = dict(
+        zip(
+            merger.outline_numbers,
+            zip([None] + merger.outline_numbers, merger.outline_numbers[1:] + [None]),
+        )
+    )
+
+    for base, fragment_renames, (data_file, fragment) in zip(bases, renames, fragments):
+        numbers = {1: 1, PAGES_NUMBER: PAGES_NUMBER, fragment["outlines"]: outlines}
+        merger.page_numbers.extend(numbers.get(n, base + n) for n in fragment["pages"])
+        patches = sorted(
+            [(position, 0, number) for position, number in fragment["objects"]]
+            + [(position, 1, number) for position, number in fragment["references"]]
+            + [(position, 2, number) for position, number in fragment["outline_items"]]
+            + [
+                (position, 3, index)
+                for index, (position, _, _) in enumerate(fragment["name_references"])
+            ]
+        )
+        with open(data_file, "rb") as file:
+            for position, kind, number in patches:
+                merger.file.write(file.read(position - file.tell()))
+                new_number = numbers.get(number, base + number)
+                if kind == 0:
+                    merger.write_header(new_number)
+                    file.read(len(b"%d 0 obj\n" % number))
+                elif kind == 1:
+                    merger.reference(new_number).write_to_stream(merger.file, None)
+                    file.read(len(b"%d 0 R" % number))
+                elif kind == 3:
+                    _, length, name = fragment["name_references"][number]
+                    DestinationName(
+                        fragment_renames.get(name, name), merger
+                    ).write_to_stream(merger.file, None)
+                    file.read(length)
+                elif complete:
+                    previous, following = neighbours[new_number]
+                    merger.file.write(b"/Parent %d 0 R\n" % outlines)
+                    if previous:
+                        merger.file.write(b"/Prev %d 0 R\n" % previous)
+                    if following:
+                        merger.file.write(b"/Next %d 0 R\n" % following)
+                else:
+                    insertions.append((merger.file.tell(), new_number))
+            copyfileobj(file, merger.file)
+
+    if complete:
+        merger.close()
+        return None
+    merger.file.close()
+    return {
+        "size": len(merger.offsets),
+        "objects": merger.objects,
+        "references": merger.references,
+        "pages": merger.page_numbers,
+        "outlines": outlines,
+        "outline_items": insertions,
+        "destinations": list(merger.destinations.items()),
+        "name_references": merger.name_references,
+    }
+
+
+def append_pdfs(merger, pdfs, budget):
+    """
+    Appends the pdfs in order. Inputs that fit the memory budget are read
+    whole, larger ones are parsed from disk and released as their pages are
+    copied.
+    """
+    for pdf_file in pdfs:
+        size = os.path.getsize(pdf_file)
+        if size * PDF_MEMORY_FACTOR > budget:
+            logger.info(f"{pdf_file} of {size} bytes exceeds the merge budget.")
+        merger.append(pdf_file, buffered=size * PDF_MEMORY_FACTOR <= budget)
+
+
+def stream_merge_pdf(pdfs, filename, budget):
+    """
+    Merges the pdfs in order into one file, streaming one input at a time.
 
     Parameters
     ----------
     pdfs: pdf files to be merged
     filename: filename of the consolidated file
+    budget: bytes the merge may hold in memory
+    """
+    merger = StreamingPdfMerger(filename)
+    append_pdfs(merger, pdfs, budget)
+    merger.close()
+
+
+def merge_fragment(pdfs, filename, budget):
+    """Merges the pdfs of a leaf of the tree merge into a fragment"""
+    merger = StreamingPdfMerger(filename, fragment=True)
+    append_pdfs(merger, pdfs, budget)
+    return merger.close_fragment()
+
+
+def merge_worker(connection, function, args):
+    """Runs a merge of the tree merge and sends back its result or error"""
+    try:
+        connection.send((None, function(*args)))
+    except Exception as exception:
+        connection.send((f"{type(exception).__name__}: {exception}", None))
+    connection.close()
+
+
+def run_merge_processes(merges, workers):
+    """
+    Runs the (function, args) merges in up to workers processes at a time.
+    Processes are started directly as multiprocessing pools need /dev/shm,
+    which lambda does not have.
+
+    Returns: the results of the merges in order
+    -------
+    """
+    pending = list(enumerate(merges))
+    results = [None] * len(pending)
+    running = {}
+    try:
+        while pending or running:
+            while pending and len(running) < workers:
+                index, (function, args) = pending.pop(0)
+                receiver, sender = multiprocessing.Pipe(duplex=False)
+                process = multiprocessing.Process(
+                    target=merge_worker, args=(sender, function, args)
+                )
+                process.start()
+                sender.close()
+                running[receiver] = index, process
+
+            for receiver in multiprocessing.connection.wait(list(running)):
+                index, process = running.pop(receiver)
+                try:
+                    error, results[index] = receiver.recv()
+                except EOFError as _:
+                    process.join()
+                    error = f"Merge worker exited with code {process.exitcode}"
+                receiver.close()
+                process.join()
+                if error:
+                    raise ValueError(error)
+    finally:
+        for receiver, (_, process) in running.items():
+            process.kill()
+            process.join()
+            receiver.close()
+    return results
+
+
+def tree_merge_pdf(pdfs, filename, fan_in, workers, budget, complete=True):
+    """
+    Merges fan_in consecutive pdfs at a time into fragments in parallel,
+    then stitches fan_in consecutive fragments at a time level by level
+    until one level is left to stitch into the pdf, or into a fragment when
+    not complete. Consecutive grouping keeps the page order of a sequential
+    merge.
+
+    Parameters
+    ----------
+    pdfs: pdf files to be merged
+    filename: filename of the consolidated file
+    fan_in: number of files merged into each file of the next level
+    workers: number of merge processes
+    budget: bytes each merge process may hold in memory
+    complete: whether to write a pdf or a fragment
+    Returns: the fragment written when not complete
+    -------
+    """
+
+    def groups(items):
+        return [items[start : start + fan_in] for start in range(0, len(items), fan_in)]
+
+    data_files = [f"{filename}.0.{index}" for index in range(len(groups(pdfs)))]
+    logger.info(f"Merging {len(pdfs)} pdfs into {len(data_files)} fragments.")
+    fragments = run_merge_processes(
+        [
+            (merge_fragment, (group, data_file, budget))
+            for group, data_file in zip(groups(pdfs), data_files)
+        ],
+        workers,
+    )
+    level = list(zip(data_files, fragments))
+
+    depth = 1
+    while len(level) > fan_in:
+        data_files = [
+            f"{filename}.{depth}.{index}" for index in range(len(groups(level)))
+        ]
+        logger.info(f"Stitching {len(level)} fragments into {len(data_files)}.")
+        fragments = run_merge_processes(
+            [
+                (stitch_pdf, (group, data_file, False))
+                for group, data_file in zip(groups(level), data_files)
+            ],
+            workers,
+        )
+        for data_file, _ in level:
+            os.remove(data_file)
+        level = list(zip(data_files, fragments))
+        depth += 1
+
+    fragment = stitch_pdf(level, filename, complete)
+    for data_file, _ in level:
+        os.remove(data_file)
+    return fragment
+
+
+def merge_pdf(pdfs, filename, complete=True, budget=None):
+    """
+    Merges the pdfs in order. With merge_mode=tree the merge is split over
+    merge_workers processes, each merging merge_fan_in files at a time,
+    otherwise the pdfs are streamed into the output one after another.
+
+    Parameters
+    ----------
+    pdfs: pdf files to be merged
+    filename: filename of the consolidated file
+    complete: whether to write a pdf or a fragment for stitch_pdf
+    budget: bytes the merge may hold in memory, by default the merge budget
+    Returns: the fragment written when not complete
+    -------
     """
     logger.info(f"Number of pdfs to Merge: {str(len(pdfs))}")
-    if len(pdfs) < batchsize:
-        merger = PdfFileMerger()
-        logger.info(f"pdf files: {pdfs}")
-        for pdf_file in pdfs:
-            with open(pdf_file, "rb") as file:
-                merger.append(PdfFileReader(file))
-        merger.write(filename)
-        merger.close()
-        logger.info(f"Creating: {filename}")
+    if budget is None:
+        budget = get_merge_memory_budget()
+    fan_in = max(2, int(os.environ.get("merge_fan_in", "50")))
+    workers = int(os.environ.get("merge_workers", str(os.cpu_count() or 1)))
+    if (
+        os.environ.get("merge_mode", "sequential") == "tree"
+        and workers > 1
+        and len(pdfs) > fan_in
+    ):
+        fragment = tree_merge_pdf(
+            pdfs, filename, fan_in, workers, budget // workers, complete
+        )
+    elif complete:
+        fragment = stream_merge_pdf(pdfs, filename, budget)
     else:
-        batch_pdfs = []
-        list_of_batches = []
-        for count, pdf in enumerate(pdfs, 1):
-            batch_pdfs.append(pdf)
-            if count % batchsize == 0:
-                list_of_batches.append(batch_pdfs)
-                batch_pdfs = []
-
-            if count > len(pdfs) + 2:
-                logger.info("List count larger than number of PDFs. Exiting..")
-                sys.exit(1)
-
-        list_of_batches.append(batch_pdfs)
-        list_of_batches = [x for x in list_of_batches if x]
-        logger.info(list_of_batches)
-        logger.info(f"No of batches: {str(len(list_of_batches))}")
-
-        final_pdfs = []
-        for i, batchlist in enumerate(list_of_batches):
-            logger.info(
-                f"Processing Batch: {str(i)} with length: {str(len(batchlist))}"
-            )
-            if len(batchlist) > 0:
-                merger = PdfFileMerger()
-                for pdf in batchlist:
-                    with open(pdf, "rb") as file:
-                        merger.append(PdfFileReader(file))
-
-                merger.write(filename + str(i) + ".pdf")
-                merger.close()
-                final_pdfs.append(filename + str(i) + ".pdf")
-
-        logger.info(f"Merging Final {str(len(list_of_batches))} pdf files.")
-        merger = PdfFileMerger()
-        for pdf_file in final_pdfs:
-            merger.append(pdf_file)
-        logger.info(f"Creating: {filename}")
-        merger.write(filename)
-        merger.close()
+        fragment = merge_fragment(pdfs, filename, budget)
+    logger.info(f"Creating: {filename}")
+    return fragment
+
+
+def get_s3_path(pdf_file_name):
+    return pdf_file_name.replace(os.environ["lambda_write_path"], "")
 
 
 def upload_to_s3(pdf_file_name, s3_client, bucket_name):
-    s3_path = pdf_file_name.replace(os.environ["lambda_write_path"], "")
+    s3_path = get_s3_path(pdf_file_name)
     s3_client.upload_file(pdf_file_name, bucket_name, s3_path)
 
 
+def copy_in_s3(s3_client, bucket_name, source_key, key):
+    """
+    Copies an object server side. Objects over merge_copy_multipart_mb are
+    copied as concurrent parts of merge_copy_part_mb.
+    """
+    threshold_mb = int(os.environ.get("merge_copy_multipart_mb", "256"))
+    part_mb = int(os.environ.get("merge_copy_part_mb", "128"))
+    config = TransferConfig(
+        multipart_threshold=threshold_mb << 20, multipart_chunksize=part_mb << 20
+    )
+    s3_client.copy(
+        {"Bucket": bucket_name, "Key": source_key}, bucket_name, key, Config=config
+    )
+
+
+def is_current_same_as_source(data):
+    """
+    Whether current merges the same pdfs as source and so can be copied from
+    it instead of being merged again.
+    """
+    if data["copy_source_to_current"] == "true":
+        return True
+    if all(item["source"] == item["current"] for item in data["files"]):
+        logger.info("Source and current list the same files.")
+        return True
+    return False
+
+
+def get_merged_pdf_name(
+    lambda_write_path, s3_folder, exhibit_id, file_type, pdf_file_suffix
+):
+    return (
+        lambda_write_path
+        + s3_folder
+        + "/doc_pdf/"
+        + exhibit_id.replace("document_", "")
+        + "/"
+        + file_type
+        + pdf_file_suffix
+        + ".pdf"
+    )
+
+
+def download_pdfs(keys, s3_client, bucket_name, lambda_write_path):
+    """
+    Downloads each distinct key once, merge_download_workers at a time
+
+    Parameters
+    ----------
+    keys: s3 keys of the pdfs, repeated keys are downloaded once
+    s3_client: s3 object
+    bucket_name: bucket name
+    lambda_write_path: lambda path /tmp
+    Returns: the local path of every downloaded key
+    -------
+    """
+
+    def download(key):
+        file_path = lambda_write_path + key
+        os.makedirs(name=os.path.dirname(file_path), exist_ok=True)
+        logger.info(f"Downloading: {key}")
+        s3_client.download_file(bucket_name, key, file_path)
+        return key, file_path
+
+    keys = list(dict.fromkeys(keys))
+    workers = int(os.environ.get("merge_download_workers", "10"))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        downloaded = {
+            key: file_path
+            for key, file_path in executor.map(download, keys)
+            if os.path.isfile(file_path)
+        }
+    logger.info(f"Downloaded {len(downloaded)} pdfs for {len(keys)} keys.")
+    return downloaded
+
+
+def download_and_merge(
+    file_types, files, filenames, s3_client, bucket_name, lambda_write_path, complete
+):
+    """
+    Downloads the pdfs of all file types once and merges the file types into
+    their filenames concurrently, sharing the merge memory budget.
+
+    Parameters
+    ----------
+    file_types: source / current file types
+    files: control file items
+    filenames: merged file of each file type
+    s3_client: s3 object
+    bucket_name: bucket name
+    lambda_write_path: lambda path /tmp
+    complete: whether to write pdfs or fragments
+    Returns: the downloaded pdfs and the fragments written when not complete
+    -------
+    """
+    downloaded = download_pdfs(
+        [item[file_type] for file_type in file_types for item in files],
+        s3_client,
+        bucket_name,
+        lambda_write_path,
+    )
+    budget = get_merge_memory_budget() // len(file_types)
+    merges = []
+    for file_type, filename in zip(file_types, filenames):
+        pdfs = [
+            downloaded[item[file_type]]
+            for item in files
+            if item[file_type] in downloaded
+        ]
+        os.makedirs(name=os.path.dirname(filename), exist_ok=True)
+        merges.append((merge_pdf, (pdfs, filename, complete, budget)))
+
+    if len(merges) > 1:
+        fragments = run_merge_processes(merges, len(merges))
+    else:
+        fragments = [merge_pdf(*args) for _, args in merges]
+    return list(downloaded.values()), fragments
+
+
+def upload_merged_pdf(pdf_file_name, s3_client, bucket_name, pdf_file_name_current):
+    """
+    Uploads the merged pdf, and copies it to current in s3 when
+    pdf_file_name_current is given.
+    """
+    logger.info(f"Uploading: {pdf_file_name}")
+    if os.path.isfile(pdf_file_name):
+        logger.info("File Exists after Merging. Uploading to S3.")
+        upload_to_s3(pdf_file_name, s3_client, bucket_name)
+
+    if pdf_file_name_current:
+        logger.info("copy_source_to_current is True. Copying in S3.")
+        copy_in_s3(
+            s3_client,
+            bucket_name,
+            get_s3_path(pdf_file_name),
+            get_s3_path(pdf_file_name_current),
+        )
+
+
 def process(
-    file_type,
+    file_types,
     exhibit_id,
     data,
     s3_client,
@@ -127,7 +973,7 @@ def process(
 
     Parameters
     ----------
-    file_type: source / current file type
+    file_types: source / current file types, merged concurrently
     exhibit_id: name of the folder
     data: control file content
     s3_client: s3 object
@@ -136,56 +982,30 @@ def process(
     pdf_file_suffix: _dv
     s3_folder: the upload location of the merged file
     """
-    pdf_file_name = (
-        lambda_write_path
-        + s3_folder
-        + "/doc_pdf/"
-        + exhibit_id.replace("document_", "")
-        + "/"
-        + file_type
-        + pdf_file_suffix
-        + ".pdf"
+    pdf_file_names = [
+        get_merged_pdf_name(
+            lambda_write_path, s3_folder, exhibit_id, file_type, pdf_file_suffix
+        )
+        for file_type in file_types
+    ]
+    download_and_merge(
+        file_types,
+        data["files"],
+        pdf_file_names,
+        s3_client,
+        bucket_name,
+        lambda_write_path,
+        True,
     )
 
-    pdfs = []
-    for item in data["files"]:
-        file_path = lambda_write_path + item[file_type]
-        logger.info(f"file_path: {file_path}")
-        logger.info(f"dir_path: {os.path.dirname(file_path)}")
-        if not os.path.exists(os.path.dirname(file_path)):
-            os.makedirs(name=os.path.dirname(file_path), exist_ok=True)
-
-        logger.info(f"Downloading: {item[file_type]}")
-        if os.path.isdir(os.path.dirname(file_path)):
-            s3_client.download_file(bucket_name, item[file_type], file_path)
-        if os.path.isfile(file_path):
-            logger.info("File Exists after Download. Appending to list")
-            pdfs.append(file_path)
-            logger.info(pdfs)
-            logger.info(f"list of pdfs: {len(pdfs)}")
-
-    merge_pdf(pdfs, pdf_file_name, 500)
-    logger.info(f"Merged: {pdf_file_name}")
-    logger.info(f"Uploading: {pdf_file_name}")
-    if os.path.isfile(pdf_file_name):
-        logger.info("File Exists after Merging. Uploading to S3.")
-        upload_to_s3(pdf_file_name, s3_client, bucket_name)
-
+    pdf_file_name_current = None
     if copy_source_to_current:
-        pdf_file_name_current = (
-            lambda_write_path
-            + s3_folder
-            + "/doc_pdf/"
-            + exhibit_id.replace("document_", "")
-            + "/"
-            + "current"
-            + pdf_file_suffix
-            + ".pdf"
+        pdf_file_name_current = get_merged_pdf_name(
+            lambda_write_path, s3_folder, exhibit_id, "current", pdf_file_suffix
         )
-        copyfile(pdf_file_name, pdf_file_name_current)
-
-        logger.info("copy_source_to_current is True. Uploading to S3.")
-        upload_to_s3(pdf_file_name_current, s3_client, bucket_name)
+    for pdf_file_name in pdf_file_names:
+        logger.info(f"Merged: {pdf_file_name}")
+        upload_merged_pdf(pdf_file_name, s3_client, bucket_name, pdf_file_name_current)
 
 
 def delete_metadata_folder(control_file_path, metadata_s3_bucket_name, folder_type):
@@ -278,6 +1098,349 @@ def place_processed_control_files(s3_folder, exhibit_id, s3_client, bucket_name)
     s3_client.put_object(Body="", Bucket=bucket_name, Key=processed_control_files_path)
 
 
+def get_folder_type(exhibit_id):
+    if exhibit_id.startswith("document"):
+        return "wire"
+    return "exhibits"
+
+
+def place_unmerged_control_file(
+    control_file, s3_client, main_s3_bucket, s3_folder, exhibit_id
+):
+    logger.info("Creating unmerged control File.")
+    s3_client.put_object(
+        Body="",
+        Bucket=main_s3_bucket,
+        Key=control_file.replace("control_files", "unmerged_control_files"),
+    )
+
+    update_rds_entry_on_unmerged(s3_folder, exhibit_id)
+
+
+def log_exception():
+    exception_type, exception_value, exception_traceback = sys.exc_info()
+    traceback_string = traceback.format_exception(
+        exception_type, exception_value, exception_traceback
+    )
+    err_msg = json.dumps(
+        {
+            "errorType": exception_type.__name__,
+            "errorMessage": str(exception_value),
+            "stackTrace": traceback_string,
+        }
+    )
+    logger.error(err_msg)
+
+
+def get_shard_prefix(control_file):
+    s3_folder = control_file.split("/")[0]
+    exhibit_id = control_file.split("/")[3].split(".")[0]
+    return f"{s3_folder}/doc_pdf/merge_shards/{exhibit_id}"
+
+
+def delete_shards(bucket_name, prefix):
+    s3 = boto3.resource("s3")
+    bucket = s3.Bucket(bucket_name)
+    bucket.objects.filter(Prefix=prefix + "/").delete()
+
+
+def invoke_merge_task(function_name, task_type, task):
+    """Invokes the merge lambda asynchronously for a shard or the reduce step"""
+    session = boto3.Session()
+    lambda_client = session.client(service_name="lambda")
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType="Event",
+        Payload=json.dumps({task_type: task}),
+    )
+
+
+def start_sharded_merge(
+    control_file, trigger_bucket_name, data, s3_client, main_s3_bucket, function_name
+):
+    """
+    Splits the files of a control file into shards of merge_shard_size
+    consecutive files and invokes a merge of each shard. The manifest and
+    the progress of the shards are kept under the merge_shards folder of
+    the case, the last shard to finish invokes the reduce step.
+
+    Parameters
+    ----------
+    control_file: the control file being merged
+    trigger_bucket_name: bucket of the merge trigger
+    data: control file content
+    s3_client: s3 object
+    main_s3_bucket: bucket name
+    function_name: name of the merge lambda
+    Returns: False when the merge lambda cannot invoke itself and the
+    control file is to be merged in this invocation instead
+    -------
+    """
+    prefix = get_shard_prefix(control_file)
+    # Shards of an earlier version of the control file are stale.
+    delete_shards(main_s3_bucket, prefix)
+
+    shard_size = int(os.environ["merge_shard_size"])
+    files = len(data["files"])
+    manifest = {
+        "control_file": control_file,
+        "trigger_bucket": trigger_bucket_name,
+        "copy_source_to_current": is_current_same_as_source(data),
+        "function_name": function_name,
+        "shards": [
+            [start, min(start + shard_size, files)]
+            for start in range(0, files, shard_size)
+        ],
+    }
+    manifest_key = prefix + "/manifest.json"
+    s3_client.put_object(
+        Body=json.dumps(manifest), Bucket=main_s3_bucket, Key=manifest_key
+    )
+    logger.info(f"Merging {files} files in {len(manifest['shards'])} shards.")
+    for index in range(len(manifest["shards"])):
+        try:
+            invoke_merge_task(
+                function_name,
+                "merge_shard",
+                {"manifest": manifest_key, "index": index, "attempt": 1},
+            )
+        except ClientError as _:
+            if index:
+                raise
+            # Without lambda:InvokeFunction on itself no shard is started.
+            log_exception()
+            logger.info("Could not invoke the shards, merging in this invocation.")
+            delete_shards(main_s3_bucket, prefix)
+            return False
+    return True
+
+
+def read_json(s3_client, bucket_name, key):
+    s3_client_obj = s3_client.get_object(Bucket=bucket_name, Key=key)
+    return json.loads(s3_client_obj["Body"].read().decode("utf-8"))
+
+
+def count_objects(s3_client, bucket_name, prefix):
+    paginator = s3_client.get_paginator("list_objects_v2")
+    return sum(
+        page.get("KeyCount", 0)
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+    )
+
+
+def claim_reduce(s3_client, bucket_name, prefix):
+    """
+    Returns True for the one caller that gets to start the reduce step.
+    The claim is a conditional write, where conditional writes are not
+    supported two shards finishing together may both start it.
+    """
+    key = prefix + "/reduce"
+    try:
+        s3_client.put_object(Body="", Bucket=bucket_name, Key=key, IfNoneMatch="*")
+        return True
+    except ParamValidationError as _:
+        logger.info("botocore does not know IfNoneMatch, claiming without it.")
+    except ClientError as error:
+        if error.response["Error"]["Code"] in (
+            "PreconditionFailed",
+            "ConditionalRequestConflict",
+        ):
+            return False
+        if error.response["Error"]["Code"] != "NotImplemented":
+            raise
+        logger.info("The bucket does not support IfNoneMatch, claiming without it.")
+
+    if count_objects(s3_client, bucket_name, key):
+        return False
+    s3_client.put_object(Body="", Bucket=bucket_name, Key=key)
+    return True
+
+
+def merge_shard(task, manifest, s3_client, main_s3_bucket, lambda_write_path):
+    """
+    Merges the files of one shard into a fragment per file type and marks
+    the shard done, invoking the reduce step when it is the last one.
+    """
+    prefix = get_shard_prefix(manifest["control_file"])
+    index = task["index"]
+    marker = f"{prefix}/shards/{index}.json"
+    file_types = (
+        ["source"] if manifest["copy_source_to_current"] else ["source", "current"]
+    )
+
+    if count_objects(s3_client, main_s3_bucket, marker):
+        logger.info(f"Shard {index} is already merged.")
+    else:
+        data = read_json(s3_client, main_s3_bucket, manifest["control_file"])
+        start, end = manifest["shards"][index]
+        data_files = [
+            f"{lambda_write_path}{prefix}/{file_type}.{index}"
+            for file_type in file_types
+        ]
+        pdfs, fragments = download_and_merge(
+            file_types,
+            data["files"][start:end],
+            data_files,
+            s3_client,
+            main_s3_bucket,
+            lambda_write_path,
+            False,
+        )
+        for file_type, data_file in zip(file_types, data_files):
+            s3_client.upload_file(
+                data_file, main_s3_bucket, f"{prefix}/fragments/{file_type}.{index}"
+            )
+        for pdf_file in pdfs + data_files:
+            os.remove(pdf_file)
+        s3_client.put_object(
+            Body=json.dumps(dict(zip(file_types, fragments))),
+            Bucket=main_s3_bucket,
+            Key=marker,
+        )
+        logger.info(f"Merged shard {index}: files {start} to {end}.")
+
+    shards_done = count_objects(s3_client, main_s3_bucket, prefix + "/shards/")
+    logger.info(f"{shards_done} of {len(manifest['shards'])} shards merged.")
+    if shards_done == len(manifest["shards"]) and claim_reduce(
+        s3_client, main_s3_bucket, prefix
+    ):
+        invoke_merge_task(
+            manifest["function_name"],
+            "merge_reduce",
+            {"manifest": task["manifest"], "attempt": 1},
+        )
+
+
+def reduce_shards(
+    manifest,
+    s3_client,
+    main_s3_bucket,
+    metadata_s3_bucket,
+    lambda_write_path,
+    pdf_file_suffix,
+):
+    """
+    Stitches the fragments of all shards into the source and current pdfs
+    and completes the control file.
+    """
+    control_file = manifest["control_file"]
+    s3_folder = control_file.split("/")[0]
+    exhibit_id = control_file.split("/")[3].split(".")[0]
+    prefix = get_shard_prefix(control_file)
+    shards = [
+        read_json(s3_client, main_s3_bucket, f"{prefix}/shards/{index}.json")
+        for index in range(len(manifest["shards"]))
+    ]
+
+    for file_type in shards[0]:
+        fragments = []
+        for index, shard in enumerate(shards):
+            data_file = f"{lambda_write_path}{prefix}/{file_type}.{index}"
+            os.makedirs(name=os.path.dirname(data_file), exist_ok=True)
+            s3_client.download_file(
+                main_s3_bucket, f"{prefix}/fragments/{file_type}.{index}", data_file
+            )
+            fragments.append((data_file, shard[file_type]))
+
+        pdf_file_name = get_merged_pdf_name(
+            lambda_write_path, s3_folder, exhibit_id, file_type, pdf_file_suffix
+        )
+        os.makedirs(name=os.path.dirname(pdf_file_name), exist_ok=True)
+        stitch_pdf(fragments, pdf_file_name, True)
+        logger.info(f"Merged: {pdf_file_name}")
+        for data_file, _ in fragments:
+            os.remove(data_file)
+
+        pdf_file_name_current = None
+        if manifest["copy_source_to_current"]:
+            pdf_file_name_current = get_merged_pdf_name(
+                lambda_write_path, s3_folder, exhibit_id, "current", pdf_file_suffix
+            )
+        upload_merged_pdf(
+            pdf_file_name, s3_client, main_s3_bucket, pdf_file_name_current
+        )
+
+    update_rds_entry(s3_folder, exhibit_id)
+    place_processed_control_files(s3_folder, exhibit_id, s3_client, main_s3_bucket)
+    delete_metadata_folder(
+        control_file, metadata_s3_bucket, get_folder_type(exhibit_id)
+    )
+    s3_client.delete_object(Bucket=manifest["trigger_bucket"], Key=control_file)
+    delete_shards(main_s3_bucket, prefix)
+
+
+def merge_task_handler(event, context):
+    """
+    Runs a shard or the reduce step of a sharded merge. A failed task is
+    invoked again on its own up to merge_shard_attempts times before the
+    control file is marked unmerged.
+
+    Parameters
+    ----------
+    event: {"merge_shard": task} or {"merge_reduce": task}
+    context: lambda context
+    """
+    task_type = "merge_shard" if "merge_shard" in event else "merge_reduce"
+    task = event[task_type]
+    (
+        s3_client,
+        main_s3_bucket,
+        metadata_s3_bucket,
+        lambda_write_path,
+        pdf_file_suffix,
+    ) = init()
+    manifest = None
+    try:
+        signal.alarm(int(context.get_remaining_time_in_millis() / 1000) - 60)
+        manifest = read_json(s3_client, main_s3_bucket, task["manifest"])
+        if task_type == "merge_shard":
+            merge_shard(task, manifest, s3_client, main_s3_bucket, lambda_write_path)
+        else:
+            reduce_shards(
+                manifest,
+                s3_client,
+                main_s3_bucket,
+                metadata_s3_bucket,
+                lambda_write_path,
+                pdf_file_suffix,
+            )
+        signal.alarm(0)
+    except Exception as error:
+        signal.alarm(0)
+        log_exception()
+
+        if manifest is None and (
+            not isinstance(error, ClientError)
+            or error.response["Error"]["Code"] == "NoSuchKey"
+        ):
+            # The manifest is deleted with the shards once the merge is
+            # reduced or given up on, which leaves this task nothing to do.
+            logger.info(f"No manifest for {task_type} {task}. Skipping it.")
+            return
+
+        if task["attempt"] < int(os.environ.get("merge_shard_attempts", "3")):
+            logger.info(f"Retrying {task_type} {task}.")
+            invoke_merge_task(
+                manifest["function_name"] if manifest else context.function_name,
+                task_type,
+                dict(task, attempt=task["attempt"] + 1),
+            )
+        elif manifest is None:
+            logger.info(f"Giving up on {task_type} {task} without its manifest.")
+        else:
+            control_file = manifest["control_file"]
+            s3_folder = control_file.split("/")[0]
+            exhibit_id = control_file.split("/")[3].split(".")[0]
+            place_unmerged_control_file(
+                control_file, s3_client, main_s3_bucket, s3_folder, exhibit_id
+            )
+            delete_metadata_folder(
+                control_file, metadata_s3_bucket, get_folder_type(exhibit_id)
+            )
+            s3_client.delete_object(Bucket=manifest["trigger_bucket"], Key=control_file)
+            delete_shards(main_s3_bucket, get_shard_prefix(control_file))
+
+
 def timeout_handler(_signal, _frame):
     raise ValueError("Time exceeded!")
 
@@ -293,6 +1456,11 @@ def lambda_handler(event, context):
     event: lambda event
     context: lambda context
     """
+    if "merge_shard" in event or "merge_reduce" in event:
+        logger.info(f"event: {event}")
+        merge_task_handler(event, context)
+        return
+
     try:
         signal.alarm(int(context.get_remaining_time_in_millis() / 1000) - 60)
         logger.info(f"event: {event}")
@@ -313,10 +1481,7 @@ def lambda_handler(event, context):
             logger.info("Not the latest versionId. Exiting from here.")
             return
 
-        if exhibit_id.startswith("document"):
-            folder_type = "wire"
-        else:
-            folder_type = "exhibits"
+        folder_type = get_folder_type(exhibit_id)
 
         (
             s3_client,
@@ -329,67 +1494,61 @@ def lambda_handler(event, context):
         s3_client_obj = s3_client.get_object(Bucket=main_s3_bucket, Key=control_file)
         data = json.loads(s3_client_obj["Body"].read().decode("utf-8"))
 
+        shard_size = int(os.environ.get("merge_shard_size", "0"))
+        if (
+            shard_size
+            and len(data["files"]) > shard_size
+            and start_sharded_merge(
+                control_file,
+                trigger_bucket_name,
+                data,
+                s3_client,
+                main_s3_bucket,
+                context.function_name,
+            )
+        ):
+            signal.alarm(0)
+            return
+
         if not data["files"]:
             logger.info("Empty Control File.")
-        elif data["copy_source_to_current"] == "true":
-            for file_type in ["source"]:
-                process(
-                    file_type,
-                    exhibit_id,
-                    data,
-                    s3_client,
-                    main_s3_bucket,
-                    lambda_write_path,
-                    pdf_file_suffix,
-                    s3_folder,
-                    True,
-                )
-
-                if os.path.exists(lambda_write_path):
-                    rmtree(lambda_write_path, ignore_errors=True)
+        elif is_current_same_as_source(data):
+            process(
+                ["source"],
+                exhibit_id,
+                data,
+                s3_client,
+                main_s3_bucket,
+                lambda_write_path,
+                pdf_file_suffix,
+                s3_folder,
+                True,
+            )
         else:
-            for file_type in ["source", "current"]:
-                process(
-                    file_type,
-                    exhibit_id,
-                    data,
-                    s3_client,
-                    main_s3_bucket,
-                    lambda_write_path,
-                    pdf_file_suffix,
-                    s3_folder,
-                    False,
-                )
-
-                if os.path.exists(lambda_write_path):
-                    rmtree(lambda_write_path, ignore_errors=True)
+            process(
+                ["source", "current"],
+                exhibit_id,
+                data,
+                s3_client,
+                main_s3_bucket,
+                lambda_write_path,
+                pdf_file_suffix,
+                s3_folder,
+                False,
+            )
+        if os.path.exists(lambda_write_path):
+            rmtree(lambda_write_path, ignore_errors=True)
         update_rds_entry(s3_folder, exhibit_id)
         place_processed_control_files(s3_folder, exhibit_id, s3_client, main_s3_bucket)
     except Exception as _:
-        exception_type, exception_value, exception_traceback = sys.exc_info()
-        traceback_string = traceback.format_exception(
-            exception_type, exception_value, exception_traceback
-        )
-        err_msg = json.dumps(
-            {
-                "errorType": exception_type.__name__,
-                "errorMessage": str(exception_value),
-                "stackTrace": traceback_string,
-            }
-        )
-        logger.error(err_msg)
+        log_exception()
 
-        logger.info("Creating unmerged control File.")
         session = boto3.Session()
         s3_client = session.client(service_name="s3")
-        s3_client.put_object(
-            Body="",
-            Bucket=main_s3_bucket,
-            Key=control_file.replace("control_files", "unmerged_control_files"),
+        place_unmerged_control_file(
+            control_file, s3_client, main_s3_bucket, s3_folder, exhibit_id
         )
 
-        update_rds_entry_on_unmerged(s3_folder, exhibit_id)
-
     delete_metadata_folder(control_file, metadata_s3_bucket, folder_type)
 
     s3_client.delete_object(Bucket=trigger_bucket_name, Key=control_file)
@@ -0,0 +1,68 @@
+"""
+Compares OCR time and pdf size of the current image preparation
+(update_image_dpi) against the ocr_normalize preprocessing of main.py.
+Without tesseract on the PATH, or with --prepare-only, only the
+preparation is timed and the size of the image given to tesseract
+is reported instead.
+
+Usage: python tests/benchmark_ocr_normalization.py [--prepare-only] <image or tiff> ...
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import main  # noqa: E402
+
+
+def run(file_path, normalize, prepare_only):
+    os.environ["ocr_normalize"] = "true" if normalize else "false"
+    work_dir = tempfile.mkdtemp()
+    try:
+        input_file = shutil.copy(file_path, work_dir)
+        pdf_file_name = os.path.join(work_dir, "output.pdf")
+        is_tiff = input_file.lower().endswith((".tif", ".tiff"))
+
+        start = time.perf_counter()
+        if prepare_only:
+            if is_tiff:
+                output_file = os.path.join(work_dir, "ocr.tif")
+                main.write_ocr_tiff(input_file, output_file)
+            else:
+                output_file = main.prepare_image_for_ocr(input_file)
+            converted = True
+        elif is_tiff:
+            output_file = pdf_file_name
+            converted = main.tiff_to_pdf(input_file, pdf_file_name)
+        else:
+            output_file = pdf_file_name
+            converted = main.create_pdf(
+                main.prepare_image_for_ocr(input_file), pdf_file_name
+            )
+        elapsed = time.perf_counter() - start
+
+        size = os.path.getsize(output_file) if converted else 0
+        return elapsed, size
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    file_paths = [arg for arg in sys.argv[1:] if arg != "--prepare-only"]
+    prepare_only = "--prepare-only" in sys.argv or shutil.which("tesseract") is None
+    print(
+        f"{'file':40} {'path':10} {'seconds':>8} "
+        f"{'ocr input bytes' if prepare_only else 'pdf bytes':>16}"
+    )
+    for file_path in file_paths:
+        for normalize in (False, True):
+            elapsed, size = run(file_path, normalize, prepare_only)
+            print(
+                f"{os.path.basename(file_path)[:40]:40} "
+                f"{'normalize' if normalize else 'current':10} "
+                f"{elapsed:8.2f} {size:16d}"
+            )
@@ -0,0 +1,50 @@
+"""
+Compares time and pdf size of rasterizing an svg and OCRing it
+against rendering the svg2rlg drawing directly to a vector pdf.
+
+Usage: python tests/benchmark_svg_rendering.py <svg> ...
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "app"))
+
+import main  # noqa: E402
+
+
+def run(file_path, vector):
+    work_dir = tempfile.mkdtemp()
+    try:
+        input_file = shutil.copy(file_path, work_dir)
+        filename, _ = os.path.splitext(input_file)
+        pdf_file_name = os.path.join(work_dir, "output.pdf")
+
+        start = time.perf_counter()
+        drawing = main.svg2rlg(input_file, resolve_entities=True)
+        if vector:
+            main.renderPDF.drawToFile(drawing, pdf_file_name)
+            converted = True
+        else:
+            converted = main.svg_to_pdf_raster(drawing, filename, pdf_file_name)
+        elapsed = time.perf_counter() - start
+
+        size = os.path.getsize(pdf_file_name) if converted else 0
+        return elapsed, size
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    print(f"{'file':40} {'path':10} {'seconds':>8} {'pdf bytes':>12}")
+    for file_path in sys.argv[1:]:
+        for vector in (False, True):
+            elapsed, size = run(file_path, vector)
+            print(
+                f"{os.path.basename(file_path)[:40]:40} "
+                f"{'vector' if vector else 'raster':10} "
+                f"{elapsed:8.2f} {size:12d}"
+            )
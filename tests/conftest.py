@@ -0,0 +1,209 @@
+"""
+Shared fixtures of the tests. The lambdas in app/ are single modules,
+so app/ is put on the path and they are imported by name.
+"""
+
+import base64
+import datetime
+import hashlib
+import io
+import json
+import os
+import sys
+
+import pytest
+from botocore.exceptions import ClientError
+from PyPDF2 import PdfWriter
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, os.path.abspath(APP_DIR))
+
+
+def client_error(code, operation):
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class FakeBody:
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakePaginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix="", **kwargs):
+        yield self.s3.list_objects_v2(Bucket=Bucket, Prefix=Prefix)
+
+
+class FakeS3:
+    """
+    In memory stand in for the boto3 S3 client, covering the calls
+    the lambdas make. Every call is recorded in calls.
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.modified = {}
+        self.checksums = {}
+        self.calls = []
+
+    def _put(self, bucket, key, data):
+        self.objects[(bucket, key)] = data
+        self.modified[(bucket, key)] = datetime.datetime.now(datetime.timezone.utc)
+
+    def _get(self, bucket, key, operation, code="NoSuchKey"):
+        self.calls.append((operation, key))
+        if (bucket, key) not in self.objects:
+            raise client_error(code, operation)
+        return self.objects[(bucket, key)]
+
+    def put_object(
+        self, Body, Bucket, Key, IfNoneMatch=None, ChecksumAlgorithm=None, **kwargs
+    ):
+        self.calls.append(("PutObject", Key))
+        if IfNoneMatch == "*" and (Bucket, Key) in self.objects:
+            raise client_error("PreconditionFailed", "PutObject")
+        if isinstance(Body, str):
+            Body = Body.encode()
+        elif hasattr(Body, "read"):
+            Body = Body.read()
+        self._put(Bucket, Key, Body)
+        self.checksums.pop((Bucket, Key), None)
+        if ChecksumAlgorithm == "SHA256":
+            self.checksums[(Bucket, Key)] = base64.b64encode(
+                hashlib.sha256(Body).digest()
+            ).decode()
+        return {}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        data = self._get(Bucket, Key, "GetObject")
+        if Range is not None:
+            start, end = Range[len("bytes=") :].split("-")
+            if not start:
+                data = data[-int(end) :]
+            else:
+                data = data[int(start) : int(end) + 1 if end else None]
+        return {"Body": FakeBody(data), "ContentLength": len(data)}
+
+    def head_object(self, Bucket, Key, ChecksumMode=None, **kwargs):
+        data = self._get(Bucket, Key, "HeadObject", code="404")
+        head = {
+            "ETag": '"{}"'.format(hashlib.md5(data).hexdigest()),
+            "ContentLength": len(data),
+            "LastModified": self.modified[(Bucket, Key)],
+        }
+        # S3 only returns the checksums of objects when asked to.
+        if ChecksumMode == "ENABLED" and (Bucket, Key) in self.checksums:
+            head["ChecksumSHA256"] = self.checksums[(Bucket, Key)]
+        return head
+
+    def delete_object(self, Bucket, Key, **kwargs):
+        self.calls.append(("DeleteObject", Key))
+        self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        for item in Delete["Objects"]:
+            self.delete_object(Bucket=Bucket, Key=item["Key"])
+        return {}
+
+    def copy_object(self, Bucket, Key, CopySource, **kwargs):
+        data = self._get(CopySource["Bucket"], CopySource["Key"], "CopyObject")
+        self._put(Bucket, Key, data)
+        return {}
+
+    def copy(self, CopySource, Bucket, Key, **kwargs):
+        return self.copy_object(Bucket=Bucket, Key=Key, CopySource=CopySource)
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        self.calls.append(("UploadFile", Key))
+        with open(Filename, "rb") as f:
+            self._put(Bucket, Key, f.read())
+
+    def upload_fileobj(self, Fileobj, Bucket, Key, **kwargs):
+        self.calls.append(("UploadFile", Key))
+        self._put(Bucket, Key, Fileobj.read())
+
+    def download_file(self, Bucket, Key, Filename, **kwargs):
+        data = self._get(Bucket, Key, "DownloadFile", code="404")
+        with open(Filename, "wb") as f:
+            f.write(data)
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        Fileobj.write(self._get(Bucket, Key, "DownloadFile", code="404"))
+
+    def list_objects_v2(self, Bucket, Prefix="", **kwargs):
+        self.calls.append(("ListObjectsV2", Prefix))
+        contents = [
+            {
+                "Key": key,
+                "Size": len(data),
+                "LastModified": self.modified[(bucket, key)],
+            }
+            for (bucket, key), data in sorted(self.objects.items())
+            if bucket == Bucket and key.startswith(Prefix)
+        ]
+        if not contents:
+            # S3 leaves Contents out of empty listings.
+            return {"KeyCount": 0}
+        return {"Contents": contents, "KeyCount": len(contents)}
+
+    def get_paginator(self, operation):
+        return FakePaginator(self)
+
+    def count(self, operation):
+        return sum(1 for name, _ in self.calls if name == operation)
+
+
+class FakeDocToPdf:
+    """
+    Stands in for the lambda client invoking doc_to_pdf. The documents
+    of a request become blank pdfs, except those with "broken" in
+    their name.
+    """
+
+    def __init__(self, s3, bucket="bucket"):
+        self.s3 = s3
+        self.bucket = bucket
+        self.requests = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        files = json.loads(Payload)["files"]
+        self.requests.append(files)
+        results = []
+        for file in files:
+            converted = "broken" not in file["s3_input_file"]
+            if converted:
+                self.s3._get(self.bucket, file["s3_input_file"], "DownloadFile")
+                self.s3.put_object(
+                    Body=blank_pdf(), Bucket=self.bucket, Key=file["s3_output_file"]
+                )
+            results.append({**file, "response": converted})
+        return {"Payload": io.BytesIO(json.dumps({"files": results}).encode())}
+
+
+def blank_pdf():
+    writer = PdfWriter()
+    writer.add_blank_page(width=200, height=200)
+    data = io.BytesIO()
+    writer.write(data)
+    return data.getvalue()
+
+
+@pytest.fixture
+def s3():
+    return FakeS3()
+
+
+@pytest.fixture
+def doc_to_pdf(s3, monkeypatch):
+    import main
+
+    monkeypatch.setenv("doc_to_pdf_arn", "doc_to_pdf")
+    fake = FakeDocToPdf(s3)
+    monkeypatch.setattr(main, "get_lambda_client", lambda: fake)
+    return fake
@@ -0,0 +1,75 @@
+"""
+Reports the cold import cost of main.py and of the converter
+dependencies it loads on first use, measured with python -X importtime
+in a fresh interpreter.
+
+Usage: python tests/measure_import_cost.py [number of imports to list]
+"""
+
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+
+DEPENDENCIES = (
+    "charset_normalizer",
+    "extract_msg",
+    "fpdf",
+    "img2pdf",
+    "numpy",
+    "openpyxl",
+    "pandas",
+    "pdfkit",
+    "PIL.Image",
+    "PyPDF2",
+    "pytesseract",
+    "reportlab.graphics.renderPDF",
+    "svglib.svglib",
+)
+
+
+def import_times(module):
+    """
+    Imports module in a new interpreter and returns the
+    (cumulative microseconds, depth, name) of every module it imported.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=APP_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append((int(cumulative), depth, name.strip()))
+    return times
+
+
+def cold_import_ms(module):
+    for cumulative, _, name in import_times(module):
+        if name == module:
+            return cumulative / 1000
+    return 0.0
+
+
+if __name__ == "__main__":
+    top = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    main_times = import_times("main")
+    print(f"main: {cold_import_ms('main'):.1f} ms")
+    print(f"\nSlowest imports of main (top {top}):")
+    for cumulative, _, name in sorted(
+        (entry for entry in main_times if entry[1] == 1), reverse=True
+    )[:top]:
+        print(f"  {name:40} {cumulative / 1000:8.1f} ms")
+
+    print("\nConverter dependencies imported on first use:")
+    for dependency in DEPENDENCIES:
+        print(f"  {dependency:40} {cold_import_ms(dependency):8.1f} ms")
@@ -0,0 +1,135 @@
+import datetime
+
+import pytest
+
+import main
+
+BUCKET = "bucket"
+
+
+@pytest.fixture
+def efs_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv("conversion_cache_path", str(tmp_path / "cache"))
+    monkeypatch.setattr(main, "conversion_cache", None)
+    return tmp_path
+
+
+def put_input(s3, tmp_path, name, data):
+    s3.put_object(Body=data, Bucket=BUCKET, Key="case/input/" + name)
+    input_file = tmp_path / name
+    input_file.write_bytes(data)
+    return "case/input/" + name, str(input_file)
+
+
+def test_cache_key_includes_ocr_settings(s3, tmp_path, monkeypatch):
+    s3_input_file, input_file = put_input(s3, tmp_path, "scan.png", b"\x89PNG")
+
+    def key(ocr_mode="inline"):
+        return main.get_conversion_cache_key(
+            s3, BUCKET, s3_input_file, input_file, ocr_mode
+        )
+
+    keys = {key(), key("deferred")}
+    monkeypatch.setenv("ocr_normalize", "true")
+    keys.add(key())
+    monkeypatch.setenv("ocr_target_dpi", "200")
+    keys.add(key())
+    assert len(keys) == 4
+    assert key() == key()
+
+
+def test_cache_key_uses_the_sha256_checksum(s3, tmp_path):
+    keys = []
+    for name, checksum in (("a.txt", "SHA256"), ("b.txt", "SHA256"), ("c.txt", None)):
+        s3.put_object(
+            Body=b"same text",
+            Bucket=BUCKET,
+            Key="case/input/" + name,
+            ChecksumAlgorithm=checksum,
+        )
+        keys.append(
+            main.get_conversion_cache_key(
+                s3, BUCKET, "case/input/" + name, str(tmp_path / name)
+            )
+        )
+
+    assert keys[0] == keys[1]
+    # Objects uploaded without a checksum fall back to their ETag.
+    assert keys[2] != keys[0]
+
+
+def test_cache_hit_is_published_without_conversion(s3, efs_cache):
+    s3_input_file, input_file = put_input(s3, efs_cache, "notes.txt", b"hello")
+
+    published, cache_key = main.publish_without_conversion(
+        s3, s3_input_file, input_file, "case/doc_pdf/notes.pdf", BUCKET, "inline"
+    )
+    assert published is None and cache_key is not None
+
+    pdf_file = efs_cache / "notes.pdf"
+    pdf_file.write_bytes(b"%PDF-1.4 converted")
+    main.conversion_cache.put(cache_key, str(pdf_file))
+
+    published, _ = main.publish_without_conversion(
+        s3, s3_input_file, input_file, "case/doc_pdf/notes.pdf", BUCKET, "inline"
+    )
+    assert published is True
+    assert s3.objects[(BUCKET, "case/doc_pdf/notes.pdf")] == b"%PDF-1.4 converted"
+
+
+def test_sniffed_converter_selects_its_own_entry(s3, efs_cache):
+    # A pdf saved with the extension of a text file.
+    s3_input_file, input_file = put_input(
+        s3, efs_cache, "report.txt", b"%PDF-1.4\n\x00"
+    )
+
+    _, by_extension = main.publish_without_conversion(
+        s3, s3_input_file, input_file, "case/doc_pdf/report.pdf", BUCKET, "inline"
+    )
+    published, by_content = main.publish_from_sniffed_cache(
+        s3,
+        s3_input_file,
+        input_file,
+        "case/doc_pdf/report.pdf",
+        BUCKET,
+        "inline",
+        by_extension,
+    )
+    assert published is None
+    assert by_content != by_extension
+    assert by_content == main.get_conversion_cache_key(
+        s3, BUCKET, s3_input_file, input_file, "inline", "pdf"
+    )
+
+    main.conversion_cache.put_bytes(by_content, b"%PDF-1.4 cached")
+    published, _ = main.publish_from_sniffed_cache(
+        s3,
+        s3_input_file,
+        input_file,
+        "case/doc_pdf/report.pdf",
+        BUCKET,
+        "inline",
+        by_extension,
+    )
+    assert published is True
+
+
+def test_s3_cache_evicts_oldest_entries_once_per_interval(s3, monkeypatch):
+    monkeypatch.setenv("conversion_cache_evict_interval", "3600")
+    cache = main.S3ConversionCache(s3, BUCKET, "cache", max_bytes=10)
+    old = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+    for i, key in enumerate(["a", "b", "c"]):
+        cache.put_bytes(key, b"12345")
+        s3.modified[(BUCKET, "cache/{}.pdf".format(key))] = old.replace(day=i + 1)
+
+    cache.evict()
+    assert (BUCKET, "cache/a.pdf") not in s3.objects
+    assert (BUCKET, "cache/b.pdf") in s3.objects
+    assert (BUCKET, "cache/c.pdf") in s3.objects
+
+    cache.put_bytes("d", b"12345")
+    cache.evict()
+    # Another container sees the marker left by the first eviction.
+    main.S3ConversionCache(s3, BUCKET, "cache", max_bytes=10).evict()
+    assert s3.count("ListObjectsV2") == 1
+    assert (BUCKET, "cache/b.pdf") in s3.objects
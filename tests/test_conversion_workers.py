@@ -0,0 +1,205 @@
+import collections.abc
+import concurrent.futures
+import datetime
+import os
+import signal
+import threading
+import time
+import types
+import urllib.parse
+
+import pytest
+from conftest import FakeS3
+
+import main
+
+BUCKET = "bucket"
+
+
+class ObjectFiles(collections.abc.MutableMapping):
+    """
+    Objects of a FakeS3 kept as files, so that they are shared with
+    the forked workers of a process pool.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, bucket_key):
+        return os.path.join(
+            self.root, urllib.parse.quote("\n".join(bucket_key), safe="")
+        )
+
+    def __getitem__(self, bucket_key):
+        try:
+            with open(self.path(bucket_key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(bucket_key)
+
+    def __setitem__(self, bucket_key, data):
+        with open(self.path(bucket_key), "wb") as f:
+            f.write(data)
+
+    def __delitem__(self, bucket_key):
+        try:
+            os.remove(self.path(bucket_key))
+        except FileNotFoundError:
+            raise KeyError(bucket_key)
+
+    def __iter__(self):
+        for name in os.listdir(self.root):
+            yield tuple(urllib.parse.unquote(name).split("\n", 1))
+
+    def __len__(self):
+        return len(os.listdir(self.root))
+
+
+@pytest.fixture
+def shared_s3(tmp_path, monkeypatch):
+    s3 = FakeS3()
+    s3.objects = ObjectFiles(str(tmp_path / "s3"))
+    s3.modified = collections.defaultdict(
+        lambda: datetime.datetime.now(datetime.timezone.utc)
+    )
+    # The pool workers and create_unprocessed_file make their own clients.
+    session = types.SimpleNamespace(client=lambda service_name: s3)
+    monkeypatch.setattr(main.boto3, "Session", lambda: session)
+    return s3
+
+
+@pytest.fixture
+def write_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("lambda_write_path", str(tmp_path / "work"))
+    monkeypatch.setenv("conversion_workers", "3")
+    monkeypatch.setenv("doc_batching", "false")
+    monkeypatch.delenv("pipeline_prefetch", raising=False)
+    monkeypatch.delenv("conversion_pool", raising=False)
+    monkeypatch.delenv("conversion_sandbox", raising=False)
+    monkeypatch.delenv("conversion_cache_path", raising=False)
+    monkeypatch.delenv("conversion_cache_s3_prefix", raising=False)
+    monkeypatch.setattr(main, "conversion_cache", None)
+    monkeypatch.setattr(main, "in_flight_files", {})
+    return tmp_path / "work"
+
+
+def make_items(s3, write_path, names):
+    items = []
+    for name in names:
+        s3_input_file = f"case/source/{name}"
+        s3.put_object(Body=f"{name}\n" * 50, Bucket=BUCKET, Key=s3_input_file)
+        base, _ = os.path.splitext(name)
+        items.append(
+            {
+                "s3_input": s3_input_file,
+                "efs_input": str(write_path / "case/source" / name),
+                "s3_output": f"case/doc_pdf/{base}.pdf",
+                "efs_output": str(write_path / "case/source" / f"{base}.pdf"),
+                "ocr": "inline",
+            }
+        )
+    return items
+
+
+def test_files_are_converted_concurrently(s3, write_path, monkeypatch):
+    names = [f"note{i}.txt" for i in range(6)]
+    items = make_items(s3, write_path, names)
+    lock = threading.Lock()
+    running = []
+    peak = []
+    convert_group = main.convert_group
+
+    def record_group(group_items, s3_client, bucket_name):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        try:
+            return convert_group(group_items, s3_client, bucket_name)
+        finally:
+            with lock:
+                running.pop()
+
+    monkeypatch.setattr(main, "convert_group", record_group)
+
+    flags = main.convert_items(items, s3, BUCKET)
+
+    assert flags == [True] * 6
+    assert 1 < max(peak) <= 3
+    for item in items:
+        assert s3.objects[(BUCKET, item["s3_output"])].startswith(b"%PDF-")
+    assert main.in_flight_files == {}
+
+
+def test_failed_worker_marks_only_its_file_unprocessed(s3, write_path, monkeypatch):
+    items = make_items(s3, write_path, ["good.txt", "bad.txt", "fine.txt"])
+    unprocessed = []
+    monkeypatch.setattr(
+        main,
+        "create_unprocessed_file",
+        lambda bucket_name, s3_input_file: unprocessed.append(s3_input_file),
+    )
+    convert_group = main.convert_group
+
+    def fail_bad(group_items, s3_client, bucket_name):
+        if "bad" in group_items[0]["s3_input"]:
+            raise RuntimeError("worker died")
+        return convert_group(group_items, s3_client, bucket_name)
+
+    monkeypatch.setattr(main, "convert_group", fail_bad)
+
+    assert main.convert_items(items, s3, BUCKET) == [True, False, True]
+    assert unprocessed == ["case/source/bad.txt"]
+    assert main.in_flight_files == {}
+
+
+def test_process_pool_converts_in_workers(shared_s3, write_path, monkeypatch):
+    monkeypatch.setenv("conversion_pool", "process")
+    executor = main.get_cpu_bound_executor(2)
+    executor.shutdown()
+    if not isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+        pytest.skip("process pools are not available here")
+    items = make_items(shared_s3, write_path, ["a.txt", "b.txt", "c.txt"])
+    main.converter_registry.timings = {}
+
+    flags = main.convert_items(items, shared_s3, BUCKET)
+
+    assert flags == [True] * 3
+    for item in items:
+        assert shared_s3.objects[(BUCKET, item["s3_output"])].startswith(b"%PDF-")
+    # The timings collected in the workers are merged into this process.
+    assert main.converter_registry.timings["text"]["count"] == 3
+
+
+def test_handler_forgets_files_of_earlier_invocations(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "in_flight_files", {"case/source/stale.txt": BUCKET})
+    monkeypatch.setattr(
+        main, "init", lambda: [s3, BUCKET, str(tmp_path), "metadata", "merge"]
+    )
+    monkeypatch.setattr(main, "read_control_file", lambda **kwargs: [])
+    seen = []
+
+    def convert_items(items, s3_client, bucket_name):
+        seen.append(dict(main.in_flight_files))
+        return []
+
+    monkeypatch.setattr(main, "convert_items", convert_items)
+    context = types.SimpleNamespace(get_remaining_time_in_millis=lambda: 900_000)
+    event = {
+        "Records": [
+            {
+                "s3": {
+                    "bucket": {"name": "trigger"},
+                    "object": {"key": "case/exhibits/folder1/trigger"},
+                }
+            }
+        ]
+    }
+
+    try:
+        main.lambda_handler(event, context)
+    finally:
+        signal.alarm(0)
+
+    assert seen == [{}]
@@ -0,0 +1,75 @@
+import copy
+import io
+import zipfile
+
+import pytest
+
+import main
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+PDF = b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n"
+TIFF = b"II*\x00" + b"\x00" * 32
+OLE2 = main.OLE2_MAGIC + b"\x00" * 32
+
+
+def zip_with(name):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as archive:
+        archive.writestr(name, "<xml/>")
+    return data.getvalue()
+
+
+def select(tmp_path, name, content, ocr_mode="inline"):
+    input_file = tmp_path / name
+    input_file.write_bytes(content)
+    converter = main.converter_registry.select(str(input_file), ocr_mode)
+    return converter.name if converter is not None else None
+
+
+@pytest.mark.parametrize(
+    "name, content, expected",
+    [
+        ("scan.png", PNG, "image"),
+        ("scan.txt", PNG, "image"),
+        ("report.docx", PDF, "pdf"),
+        ("scan.jpg", TIFF, "tiff"),
+        ("letter.pdf", zip_with("word/document.xml"), "doc"),
+        ("book.doc", zip_with("xl/workbook.xml"), "excel"),
+        ("mail", b"Received: from host\r\nSubject: hi\r\n", "eml"),
+        ("page", b"<!DOCTYPE html><html></html>", "html"),
+        ("drawing", b'<?xml version="1.0"?><svg></svg>', "svg"),
+        ("notes.csv", b"a,b\n1,2\n", "csv"),
+        ("notes.log", b"plain text", "text"),
+    ],
+)
+def test_content_selects_the_converter(tmp_path, name, content, expected):
+    assert select(tmp_path, name, content) == expected
+
+
+def test_loose_text_keeps_the_extension(tmp_path):
+    # Text only identified loosely never overrides a text extension.
+    assert select(tmp_path, "page.html", b"just some words") == "html"
+    assert select(tmp_path, "notes.csv", b"<html></html>") == "csv"
+    assert select(tmp_path, "mail.txt", b"Received: from host\r\n") == "text"
+
+
+def test_ocr_mode_selects_the_image_converter(tmp_path):
+    assert select(tmp_path, "scan.png", PNG, "deferred") == "image_lossless"
+    assert select(tmp_path, "scan.bin", PNG, "none") == "image_lossless"
+
+
+def test_unknown_binary_falls_back_to_the_extension(tmp_path):
+    assert select(tmp_path, "file.xlsx", OLE2) == "excel"
+    assert select(tmp_path, "file.bin", OLE2) is None
+
+
+def test_timings_are_recorded_and_merged():
+    registry = main.ConverterRegistry([])
+    registry.record("pdf", 0.2)
+    registry.record("pdf", 7)
+    registry.merge(copy.deepcopy(registry.timings))
+    histogram = registry.timings["pdf"]
+    assert histogram["count"] == 4
+    assert histogram["seconds"] == pytest.approx(14.4)
+    assert histogram["buckets"][0] == 2
+    assert histogram["buckets"][main.TIMING_BUCKETS.index(10)] == 2
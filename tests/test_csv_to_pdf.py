@@ -0,0 +1,35 @@
+import pytest
+from PyPDF2 import PdfReader
+
+import main
+
+
+def pdf_text(pdf_file_name):
+    reader = PdfReader(str(pdf_file_name))
+    return "\n".join(page.extract_text() for page in reader.pages)
+
+
+@pytest.mark.parametrize(
+    "content, expected",
+    [
+        ("a,b\n1,2,3\n", ["a", "b", "1", "2", "3"]),
+        ("a,b,c\n1\n4,5,6\n", ["a", "c", "1", "4", "6"]),
+        ("a,b\n\n1,2\n", ["a", "b", "1", "2"]),
+    ],
+    ids=["long row", "short row", "blank line"],
+)
+def test_ragged_rows_keep_all_fields(tmp_path, content, expected):
+    input_file = tmp_path / "table.csv"
+    input_file.write_text(content)
+    pdf_file_name = tmp_path / "table.pdf"
+
+    assert main.csv_to_pdf(str(input_file), str(pdf_file_name))
+    text = pdf_text(pdf_file_name).split()
+    for value in expected:
+        assert value in text
+
+
+def test_empty_csv(tmp_path):
+    input_file = tmp_path / "empty.csv"
+    input_file.write_text("")
+    assert main.csv_to_pdf(str(input_file), str(tmp_path / "empty.pdf"))
@@ -0,0 +1,79 @@
+import json
+
+import main
+
+BUCKET = "bucket"
+MERGE_BUCKET = "merge-trigger"
+CONTROL_FILE = "case/doc_pdf/control_files/folder.json"
+
+
+def test_cache_hit_leaves_the_ocr_job(s3, tmp_path, monkeypatch):
+    monkeypatch.setenv("conversion_cache_path", str(tmp_path / "cache"))
+    monkeypatch.setattr(main, "conversion_cache", None)
+    s3.put_object(Body=b"\x89PNG", Bucket=BUCKET, Key="case/source/scan.png")
+    s3_output_file = "case/doc_pdf/folder/scan.pdf"
+    args = (
+        s3,
+        "case/source/scan.png",
+        str(tmp_path / "scan.png"),
+        s3_output_file,
+        BUCKET,
+        "deferred",
+    )
+
+    published, cache_key = main.publish_without_conversion(*args)
+    assert published is None
+    main.conversion_cache.put_bytes(cache_key, b"%PDF-1.4 no text layer")
+
+    published, _ = main.publish_without_conversion(*args)
+    assert published is True
+    job = s3.objects[(BUCKET, main.get_ocr_job_key(s3_output_file))]
+    assert json.loads(job)["s3_output_file"] == s3_output_file
+
+
+def put_control_file(s3, ocr_mode):
+    s3.put_object(
+        Body=json.dumps(
+            {
+                "ocr": ocr_mode,
+                "files": [
+                    {
+                        "source": "case/doc_pdf/folder/a.pdf",
+                        "current": "case/doc_pdf/folder/b.pdf",
+                    }
+                ],
+            }
+        ),
+        Bucket=BUCKET,
+        Key=CONTROL_FILE,
+    )
+
+
+def test_merge_waits_for_the_ocr_jobs(s3):
+    put_control_file(s3, "deferred")
+    job_key = main.get_ocr_job_key("case/doc_pdf/folder/a.pdf")
+    s3.put_object(Body="{}", Bucket=BUCKET, Key=job_key)
+
+    assert main.hold_merge_for_ocr(s3, BUCKET, CONTROL_FILE, MERGE_BUCKET)
+    assert (MERGE_BUCKET, CONTROL_FILE) not in s3.objects
+
+    main.release_held_merges(s3, BUCKET, "case")
+    assert (MERGE_BUCKET, CONTROL_FILE) not in s3.objects
+
+    s3.delete_object(Bucket=BUCKET, Key=job_key)
+    main.release_held_merges(s3, BUCKET, "case")
+    assert (MERGE_BUCKET, CONTROL_FILE) in s3.objects
+    assert (BUCKET, main.get_merge_hold_key(CONTROL_FILE)) not in s3.objects
+
+
+def test_merge_is_not_held_without_pending_jobs(s3):
+    put_control_file(s3, "deferred")
+    assert not main.hold_merge_for_ocr(s3, BUCKET, CONTROL_FILE, MERGE_BUCKET)
+
+    put_control_file(s3, "inline")
+    s3.put_object(
+        Body="{}",
+        Bucket=BUCKET,
+        Key=main.get_ocr_job_key("case/doc_pdf/folder/a.pdf"),
+    )
+    assert not main.hold_merge_for_ocr(s3, BUCKET, CONTROL_FILE, MERGE_BUCKET)
@@ -0,0 +1,89 @@
+import pytest
+
+import main
+
+BUCKET = "bucket"
+
+
+@pytest.fixture
+def unprocessed(monkeypatch):
+    files = []
+    monkeypatch.setattr(
+        main,
+        "create_unprocessed_file",
+        lambda bucket_name, s3_input_file: files.append(s3_input_file),
+    )
+    return files
+
+
+@pytest.fixture(autouse=True)
+def no_cache(monkeypatch):
+    monkeypatch.delenv("conversion_cache_path", raising=False)
+    monkeypatch.delenv("conversion_cache_s3_prefix", raising=False)
+    monkeypatch.setattr(main, "conversion_cache", None)
+
+
+def make_items(s3, tmp_path, names):
+    items = []
+    for name in names:
+        s3_input_file = f"case/source/{name}"
+        s3.put_object(Body=b"document", Bucket=BUCKET, Key=s3_input_file)
+        items.append(
+            {
+                "s3_input": s3_input_file,
+                "efs_input": str(tmp_path / "source" / name),
+                "s3_output": f"case/doc_pdf/{name}.pdf",
+                "efs_output": str(tmp_path / "source" / f"{name}.pdf"),
+                "ocr": "inline",
+            }
+        )
+    return items
+
+
+def test_documents_are_sent_in_batches(
+    s3, tmp_path, doc_to_pdf, unprocessed, monkeypatch
+):
+    monkeypatch.setenv("doc_batch_size", "2")
+    names = ["a.docx", "b.doc", "broken.docx", "d.docx", "e.docx"]
+    items = make_items(s3, tmp_path, names)
+
+    flags = main.convert_doc_items(items, s3, BUCKET)
+
+    assert flags == [True, True, False, True, True]
+    assert sorted(len(request) for request in doc_to_pdf.requests) == [1, 2, 2]
+    assert unprocessed == ["case/source/broken.docx"]
+    for item in items:
+        assert ((BUCKET, item["s3_output"]) in s3.objects) == (
+            "broken" not in item["s3_input"]
+        )
+
+
+def test_batched_documents_are_cached(s3, tmp_path, doc_to_pdf, monkeypatch):
+    monkeypatch.setenv("conversion_cache_path", str(tmp_path / "cache"))
+    items = make_items(s3, tmp_path, ["a.docx", "b.docx"])
+
+    assert main.convert_doc_items(items, s3, BUCKET) == [True, True]
+    for item in items:
+        s3.delete_object(Bucket=BUCKET, Key=item["s3_output"])
+    assert main.convert_doc_items(items, s3, BUCKET) == [True, True]
+
+    assert len(doc_to_pdf.requests) == 1
+    for item in items:
+        assert (BUCKET, item["s3_output"]) in s3.objects
+
+
+def test_documents_convert_alongside_other_files(s3, tmp_path, doc_to_pdf, monkeypatch):
+    monkeypatch.setenv("lambda_write_path", str(tmp_path))
+    items = make_items(s3, tmp_path, ["notes.txt", "a.docx", "more.txt", "b.docx"])
+    (tmp_path / "source").mkdir()
+
+    flags = main.convert_items(items, s3, BUCKET)
+
+    assert flags == [True] * 4
+    assert [file["s3_input_file"] for file in doc_to_pdf.requests[0]] == [
+        "case/source/a.docx",
+        "case/source/b.docx",
+    ]
+    for item in items:
+        assert s3.objects[(BUCKET, item["s3_output"])].startswith(b"%PDF-")
+    assert not main.in_flight_files
@@ -0,0 +1,271 @@
+import concurrent.futures
+import io
+import os
+import sys
+import tarfile
+import textwrap
+import threading
+import time
+
+import brotli
+import pytest
+
+# doc_to_pdf reads its paths from the environment on import.
+with pytest.MonkeyPatch.context() as patch:
+    patch.setenv("lambda_write_path", os.environ.get("lambda_write_path", "/tmp"))
+    import doc_to_pdf
+
+BUCKET = "bucket"
+
+FAKE_SOFFICE = """\
+    #!{python}
+    # Converts the files after --outdir, failing the ones containing "fail"
+    # and hanging on the ones containing "hang".
+    import os
+    import sys
+    import time
+
+    args = sys.argv[1:]
+    outdir = args[args.index("--outdir") + 1]
+    for path in args[args.index("--outdir") + 2 :]:
+        with open(path) as f:
+            text = f.read()
+        if "hang" in text:
+            time.sleep(60)
+        if "fail" in text:
+            continue
+        name, _ = os.path.splitext(os.path.basename(path))
+        with open(os.path.join(outdir, name + ".pdf"), "w") as f:
+            f.write("%PDF-1.4 " + text)
+"""
+
+
+@pytest.fixture
+def soffice(tmp_path, monkeypatch):
+    binary = tmp_path / "soffice.bin"
+    binary.write_text(textwrap.dedent(FAKE_SOFFICE.format(python=sys.executable)))
+    binary.chmod(0o755)
+    monkeypatch.setenv("lambda_write_path", str(tmp_path))
+    monkeypatch.setenv("libre_office_convert_timeout", "2")
+    return str(binary)
+
+
+def make_documents(tmp_path, texts):
+    documents = []
+    for index, text in enumerate(texts):
+        # Documents of a batch may share their base name.
+        word_file = tmp_path / "source" / str(index) / "letter.docx"
+        word_file.parent.mkdir(parents=True)
+        word_file.write_text(text)
+        documents.append((str(word_file), str(tmp_path / "pdf" / f"{index}.pdf")))
+    return documents
+
+
+def test_soffice_batch_converts_each_document(tmp_path, soffice):
+    documents = make_documents(tmp_path, ["one", "fail", "three"])
+
+    flags = doc_to_pdf.convert_word_to_pdf(soffice, documents)
+
+    assert flags == [True, False, True]
+    for (_, pdf_file), text in zip(documents[::2], ["one", "three"]):
+        with open(pdf_file) as f:
+            assert f.read() == "%PDF-1.4 " + text
+
+
+def test_hung_soffice_batch_is_killed(tmp_path, soffice, monkeypatch):
+    monkeypatch.setenv("libre_office_convert_timeout", "1")
+    documents = make_documents(tmp_path, ["hang"])
+
+    assert doc_to_pdf.convert_word_to_pdf(soffice, documents) == [False]
+
+
+class FakeListener(doc_to_pdf.LibreOfficeServer):
+    """
+    A server whose UNO conversion hangs on documents containing "hang"
+    until the listener is stopped, and crashes once on "crash".
+    """
+
+    def __init__(self, soffice_path):
+        super().__init__(soffice_path)
+        self.uno = object()
+        self.convert_timeout = 1
+        self.stopped = threading.Event()
+        self.crashed = set()
+        self.stops = 0
+
+    def stop(self):
+        self.stops += 1
+        self.stopped.set()
+
+    def convert_document(self, word_file_path, pdf_file_path):
+        self.stopped.clear()
+        with open(word_file_path) as f:
+            text = f.read()
+        if "hang" in text:
+            self.stopped.wait(60)
+            raise RuntimeError("Binary URP bridge disposed")
+        if "crash" in text and word_file_path not in self.crashed:
+            self.crashed.add(word_file_path)
+            raise RuntimeError("Binary URP bridge disposed")
+        os.makedirs(os.path.dirname(pdf_file_path), exist_ok=True)
+        with open(pdf_file_path, "w") as f:
+            f.write("%PDF-1.4 uno " + text)
+
+
+def test_listener_retries_and_falls_back_on_timeout(tmp_path, soffice, monkeypatch):
+    server = FakeListener(soffice)
+    documents = make_documents(tmp_path, ["one", "hang after a while", "crash"])
+    fallbacks = []
+
+    def convert_word_to_pdf(soffice_path, batch):
+        fallbacks.extend(batch)
+        return [True] * len(batch)
+
+    monkeypatch.setattr(doc_to_pdf, "convert_word_to_pdf", convert_word_to_pdf)
+
+    assert server.convert(documents) == [True, True, True]
+    assert fallbacks == [documents[1]]
+    # Stopped once for the hung document and once for the crash.
+    assert server.stops == 2
+    with open(documents[2][1]) as f:
+        assert f.read() == "%PDF-1.4 uno crash"
+
+
+class FakeSession:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def client(self, service_name):
+        return self.s3
+
+
+class FakeServer:
+    def __init__(self):
+        self.batches = []
+
+    def convert(self, documents):
+        self.batches.append(documents)
+        for _, pdf_file_path in documents:
+            os.makedirs(os.path.dirname(pdf_file_path), exist_ok=True)
+            with open(pdf_file_path, "w") as f:
+                f.write("%PDF-1.4")
+        return [True] * len(documents)
+
+
+@pytest.fixture
+def handler(s3, tmp_path, monkeypatch):
+    monkeypatch.setenv("main_s3_bucket", BUCKET)
+    monkeypatch.setenv("lambda_write_path", str(tmp_path))
+    monkeypatch.setattr(doc_to_pdf.boto3, "Session", lambda: FakeSession(s3))
+    server = FakeServer()
+    monkeypatch.setattr(doc_to_pdf, "get_libre_office_server", lambda: server)
+    return server
+
+
+def test_empty_batch_starts_no_conversion(handler):
+    assert doc_to_pdf.lambda_handler({"files": []}, None) == {
+        "response": True,
+        "files": [],
+    }
+    assert handler.batches == []
+
+
+def test_batch_is_converted_and_uploaded(s3, handler):
+    files = [
+        {"s3_input_file": f"case/source/{name}", "s3_output_file": f"case/pdf/{name}"}
+        for name in ("a.docx", "missing.docx", "b.doc")
+    ]
+    for file in files[::2]:
+        s3.put_object(Body=b"document", Bucket=BUCKET, Key=file["s3_input_file"])
+
+    result = doc_to_pdf.lambda_handler({"files": files}, None)
+
+    assert [file["response"] for file in result["files"]] == [True, False, True]
+    assert not result["response"]
+    assert len(handler.batches) == 1 and len(handler.batches[0]) == 2
+    assert (BUCKET, "case/pdf/b.doc") in s3.objects
+
+
+def test_single_file_event(s3, handler):
+    s3.put_object(Body=b"document", Bucket=BUCKET, Key="case/source/a.docx")
+    event = {"s3_input_file": "case/source/a.docx", "s3_output_file": "case/pdf/a"}
+    assert doc_to_pdf.lambda_handler(event, None) == {"response": True}
+
+
+def test_brotli_reader_streams_the_archive(tmp_path):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as tar:
+        content = os.urandom(300000)
+        info = tarfile.TarInfo("instdir/program/soffice.bin")
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+    archive = tmp_path / "lo.tar.br"
+    archive.write_bytes(brotli.compress(data.getvalue()))
+
+    # Chunks much smaller than the archive and the buffer of the caller.
+    with doc_to_pdf.BrotliReader(str(archive), 1024) as raw, io.BufferedReader(
+        raw, buffer_size=4096
+    ) as stream:
+        assert stream.read() == data.getvalue()
+
+
+def make_archive(path):
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode="w") as tar:
+        for name in ("instdir/program/soffice.bin", "instdir/program/fundamentalrc"):
+            info = tarfile.TarInfo(name)
+            info.size = 6
+            tar.addfile(info, io.BytesIO(b"binary"))
+    path.write_bytes(brotli.compress(data.getvalue()))
+
+
+@pytest.fixture
+def shared_path(tmp_path, monkeypatch):
+    archive = tmp_path / "lo.tar.br"
+    make_archive(archive)
+    shared_path = tmp_path / "efs"
+    monkeypatch.setattr(doc_to_pdf, "libre_office_archive", str(archive))
+    monkeypatch.setattr(doc_to_pdf, "libre_office_shared_path", str(shared_path))
+    monkeypatch.setenv("libre_office_version", "7.6")
+    return shared_path
+
+
+def test_concurrent_cold_starts_extract_once(shared_path, monkeypatch):
+    extractions = []
+    extract = doc_to_pdf.extract_libre_office
+
+    def extract_libre_office(install_root):
+        extractions.append(install_root)
+        # Long enough for the other containers to reach the lock.
+        time.sleep(0.2)
+        extract(install_root)
+
+    monkeypatch.setattr(doc_to_pdf, "extract_libre_office", extract_libre_office)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=4) as executor:
+        paths = list(executor.map(lambda _: doc_to_pdf.load_libre_office(), range(4)))
+
+    install_root = shared_path / "libreoffice-7.6"
+    assert paths == [str(install_root / "instdir/program/soffice.bin")] * 4
+    assert extractions == [str(install_root)]
+    assert sorted(os.listdir(shared_path)) == [
+        "libreoffice-7.6",
+        "libreoffice-7.6.lock",
+    ]
+
+
+def test_partial_extractions_are_recovered(shared_path):
+    # A container died while extracting, and an older release of this
+    # code left an install without soffice.bin behind.
+    partial = shared_path / ".libreoffice-7.6.extract-x1y2"
+    (partial / "instdir").mkdir(parents=True)
+    other_version = shared_path / ".libreoffice-7.6-1.extract-z3"
+    other_version.mkdir()
+    (shared_path / "libreoffice-7.6" / "instdir").mkdir(parents=True)
+    (shared_path / "libreoffice-7.6.lock").write_text("")
+
+    soffice_path = doc_to_pdf.load_libre_office()
+
+    assert open(soffice_path, "rb").read() == b"binary"
+    assert not partial.exists()
+    # An extraction of another version may still be running.
+    assert other_version.exists()
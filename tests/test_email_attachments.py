@@ -0,0 +1,44 @@
+import io
+import zipfile
+
+from PyPDF2 import PdfReader
+
+import main
+
+BUCKET = "bucket"
+
+
+def docx():
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as archive:
+        archive.writestr("word/document.xml", "<w:document/>")
+    return data.getvalue()
+
+
+def test_word_attachments_are_converted_by_doc_to_pdf(s3, tmp_path, doc_to_pdf):
+    input_file = tmp_path / "mail.eml"
+    job = main.ConversionJob(
+        s3,
+        "case/source/mail.eml",
+        str(input_file),
+        str(tmp_path / "mail.pdf"),
+        "case/doc_pdf/mail.pdf",
+        BUCKET,
+        None,
+        "none",
+    )
+
+    assert main.email_to_pdf(
+        job,
+        [("Subject", "Letters")],
+        "See attached",
+        [("a.docx", docx()), ("notes.txt", b"notes"), ("b.docx", docx())],
+    )
+    job.remove_intermediates()
+
+    assert len(doc_to_pdf.requests) == 1 and len(doc_to_pdf.requests[0]) == 2
+    # The body, two letters and the notes.
+    assert len(PdfReader(job.pdf_file_name).pages) == 4
+    assert "(not converted)" not in PdfReader(job.pdf_file_name).pages[0].extract_text()
+    assert not [key for _, key in s3.objects if "attachment_tmp" in key]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["mail.pdf"]
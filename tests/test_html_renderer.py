@@ -0,0 +1,104 @@
+import os
+import sys
+import textwrap
+
+import pytest
+
+import main
+
+FAKE_WKHTMLTOPDF = """\
+    #!{python}
+    # Renders the documents of --read-args-from-stdin in order, hanging on
+    # the ones containing "hang", taking 0.6s for the ones containing "slow"
+    # and failing the ones containing "fail".
+    import shlex
+    import sys
+    import time
+
+    for line in sys.stdin:
+        args = shlex.split(line)
+        with open(args[-2]) as f:
+            text = f.read()
+        if "hang" in text:
+            time.sleep(60)
+        if "slow" in text:
+            time.sleep(0.6)
+        if "fail" in text:
+            continue
+        with open(args[-1], "w") as f:
+            f.write("%PDF-1.4 " + text)
+"""
+
+
+@pytest.fixture
+def renderer(tmp_path, monkeypatch):
+    binary = tmp_path / "wkhtmltopdf"
+    binary.write_text(textwrap.dedent(FAKE_WKHTMLTOPDF.format(python=sys.executable)))
+    binary.chmod(0o755)
+    monkeypatch.setenv("html_renderer_timeout", "1")
+    return main.HtmlRenderer(binary=str(binary), display="none")
+
+
+def make_batch(tmp_path, texts):
+    batch = []
+    for index, text in enumerate(texts):
+        input_file = tmp_path / f"{index}.html"
+        input_file.write_text(text)
+        batch.append(
+            (
+                str(input_file),
+                str(tmp_path / f"{index}.pdf"),
+                None,
+                main.concurrent.futures.Future(),
+            )
+        )
+    return batch
+
+
+def test_only_the_document_over_its_timeout_fails(tmp_path, renderer):
+    batch = make_batch(tmp_path, ["one", "hang", "fail", "four"])
+    renderer.slots.acquire()
+    renderer._render_batch(batch)
+
+    results = [future.exception() for _, _, _, future in batch]
+    assert results[0] is None and results[3] is None
+    assert "timeout" in str(results[1])
+    assert "could not render" in str(results[2])
+    assert os.path.exists(batch[3][1])
+    assert renderer.stats()["failures"] == 2
+
+
+def test_batch_timeout_is_per_document(tmp_path, renderer):
+    # Each document is well within the timeout, the batch is not.
+    batch = make_batch(tmp_path, ["slow"] * 3)
+    renderer.slots.acquire()
+    renderer._render_batch(batch)
+    assert all(future.result() for _, _, _, future in batch)
+
+
+class FallbackRenderer:
+    def render(self, input_file, output_file, options=None):
+        if input_file.endswith(".html"):
+            raise OSError("wkhtmltopdf could not render")
+        with open(output_file, "w") as f:
+            f.write("%PDF-1.4")
+        return True
+
+
+def test_html_text_fallback_is_converted(tmp_path, monkeypatch):
+    input_file = tmp_path / "page.html"
+    input_file.write_text("<html>broken")
+    monkeypatch.setattr(main, "get_html_renderer", FallbackRenderer)
+    job = main.ConversionJob(
+        None,
+        None,
+        str(input_file),
+        str(tmp_path / "page.pdf"),
+        None,
+        None,
+        None,
+        "none",
+    )
+
+    assert main.HtmlConverter().convert(job)
+    assert os.path.exists(job.pdf_file_name)
@@ -0,0 +1,61 @@
+"""
+Fails when a cold import of main.py gets slower than IMPORT_BUDGET_MS,
+measured with python -X importtime, or when it loads a heavy converter
+dependency eagerly again. The budget is generous for a busy machine and
+can be set from the environment.
+"""
+
+import os
+import subprocess
+import sys
+
+from conftest import APP_DIR
+from measure_import_cost import cold_import_ms
+
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "1000"))
+
+LAZY_DEPENDENCIES = (
+    "charset_normalizer",
+    "extract_msg",
+    "fpdf",
+    "img2pdf",
+    "numpy",
+    "openpyxl",
+    "pandas",
+    "pdfkit",
+    "PIL",
+    "PyPDF2",
+    "pytesseract",
+    "reportlab",
+    "svglib",
+)
+
+
+def loaded_modules(module):
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            f"import sys, {module}; print(' '.join(sys.modules))",
+        ],
+        cwd=APP_DIR,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    return set(result.stdout.split())
+
+
+def test_converter_dependencies_are_lazy():
+    loaded = loaded_modules("main")
+    eager = [module for module in LAZY_DEPENDENCIES if module in loaded]
+    assert not eager, f"main imports {eager} at load time"
+
+
+def test_main_import_budget():
+    # The best of a few runs, so that a busy machine does not fail it.
+    elapsed = min(cold_import_ms("main") for _ in range(3))
+    assert 0 < elapsed <= IMPORT_BUDGET_MS, (
+        f"Importing main took {elapsed:.1f} ms, "
+        f"the budget is {IMPORT_BUDGET_MS:.0f} ms"
+    )
@@ -0,0 +1,283 @@
+import pytest
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import (
+    ArrayObject,
+    DictionaryObject,
+    NameObject,
+    NumberObject,
+    TextStringObject,
+)
+
+import merge_files
+
+
+def make_pdfs(tmp_path, count):
+    """
+    Writes count pdfs, pdf i having i % 3 + 1 pages of width 100 + i and an
+    outline item on its first page for the even ones.
+    """
+    pdfs = []
+    for index in range(count):
+        writer = PdfWriter()
+        for _ in range(index % 3 + 1):
+            writer.add_blank_page(width=100 + index, height=200)
+        if index % 2 == 0:
+            writer.add_outline_item(f"document {index}", 0)
+            # The writer points the bookmark at the page index, not the page.
+            item = writer.get_outline_root()["/First"].get_object()
+            page = writer.get_object(writer._pages)["/Kids"][0]
+            item["/A"].get_object()[NameObject("/D")] = ArrayObject(
+                [page, NameObject("/Fit")]
+            )
+        pdf_file = str(tmp_path / f"{index:03}.pdf")
+        with open(pdf_file, "wb") as file:
+            writer.write(file)
+        pdfs.append(pdf_file)
+    return pdfs
+
+
+def describe(pdf_file):
+    reader = PdfReader(pdf_file)
+    widths = [int(page.mediabox.width) for page in reader.pages]
+    outline = [
+        (item.title, int(reader.get_destination_page_number(item)))
+        for item in reader.outline
+    ]
+    return widths, outline
+
+
+def expected(count):
+    widths, outline = [], []
+    for index in range(count):
+        if index % 2 == 0:
+            outline.append((f"document {index}", len(widths)))
+        widths.extend([100 + index] * (index % 3 + 1))
+    return widths, outline
+
+
+@pytest.fixture(autouse=True)
+def sequential(monkeypatch):
+    monkeypatch.setenv("merge_mode", "sequential")
+
+
+@pytest.mark.parametrize("budget", [1 << 30, 1])
+def test_stream_merge_keeps_pages_and_outline(tmp_path, budget):
+    # A budget of one byte parses every input from disk.
+    pdfs = make_pdfs(tmp_path, 5)
+    merged = str(tmp_path / "merged.pdf")
+
+    merge_files.merge_pdf(pdfs, merged, budget=budget)
+
+    assert describe(merged) == expected(5)
+
+
+def test_tree_merge_matches_the_sequential_merge(tmp_path, monkeypatch):
+    pdfs = make_pdfs(tmp_path, 11)
+    sequential = str(tmp_path / "sequential.pdf")
+    merge_files.merge_pdf(pdfs, sequential)
+
+    # Eleven inputs by twos stitch over three levels.
+    monkeypatch.setenv("merge_mode", "tree")
+    monkeypatch.setenv("merge_fan_in", "2")
+    monkeypatch.setenv("merge_workers", "3")
+    tree = str(tmp_path / "tree.pdf")
+    merge_files.merge_pdf(pdfs, tree)
+
+    assert describe(tree) == describe(sequential) == expected(11)
+    assert (
+        sorted(path.name for path in tmp_path.iterdir() if ".pdf." in path.name) == []
+    )
+
+
+def test_stitched_fragments_match_the_sequential_merge(tmp_path):
+    # As the shards of a sharded merge do.
+    pdfs = make_pdfs(tmp_path, 7)
+    fragments = []
+    for index, shard in enumerate([pdfs[:3], pdfs[3:4], pdfs[4:]]):
+        data_file = str(tmp_path / f"fragment.{index}")
+        fragments.append(
+            (data_file, merge_files.merge_pdf(shard, data_file, complete=False))
+        )
+    merged = str(tmp_path / "merged.pdf")
+
+    merge_files.stitch_pdf(fragments, merged, True)
+
+    assert describe(merged) == expected(7)
+
+
+def test_tree_merge_reports_a_broken_input(tmp_path, monkeypatch):
+    pdfs = make_pdfs(tmp_path, 4)
+    with open(pdfs[2], "wb") as file:
+        file.write(b"not a pdf")
+    monkeypatch.setenv("merge_mode", "tree")
+    monkeypatch.setenv("merge_fan_in", "2")
+    monkeypatch.setenv("merge_workers", "2")
+
+    with pytest.raises(ValueError):
+        merge_files.merge_pdf(pdfs, str(tmp_path / "merged.pdf"))
+
+
+def upload_pdfs(s3, tmp_path, keys):
+    source_dir = tmp_path / "source"
+    source_dir.mkdir()
+    for key, pdf_file in zip(keys, make_pdfs(source_dir, len(keys))):
+        with open(pdf_file, "rb") as file:
+            s3.put_object(Body=file.read(), Bucket="bucket", Key=key)
+
+
+def test_repeated_keys_are_downloaded_once(s3, tmp_path):
+    keys = ["case/doc_pdf/a.pdf", "case/doc_pdf/b.pdf"]
+    upload_pdfs(s3, tmp_path, keys)
+    write_path = str(tmp_path / "write")
+
+    downloaded = merge_files.download_pdfs(keys + keys[::-1], s3, "bucket", write_path)
+
+    assert downloaded == {key: write_path + key for key in keys}
+    assert s3.count("DownloadFile") == 2
+
+
+def test_source_and_current_are_merged_from_one_download(s3, tmp_path, monkeypatch):
+    keys = [f"case/doc_pdf/{index}.pdf" for index in range(5)]
+    upload_pdfs(s3, tmp_path, keys)
+    # Current replaces the fourth pdf with the last, source skips the last.
+    files = [{"source": key, "current": key} for key in keys[:4]]
+    files[3]["current"] = keys[4]
+    write_path = str(tmp_path / "write")
+    filenames = [f"{write_path}/merged/source.pdf", f"{write_path}/merged/current.pdf"]
+
+    merge_files.download_and_merge(
+        ["source", "current"], files, filenames, s3, "bucket", write_path, True
+    )
+
+    assert s3.count("DownloadFile") == 5
+    source_widths, _ = describe(filenames[0])
+    current_widths, _ = describe(filenames[1])
+    assert source_widths == expected(4)[0]
+    assert current_widths == expected(3)[0] + [104] * 2
+
+
+@pytest.mark.parametrize(
+    "flag, currents, same",
+    [
+        ("true", ["b.pdf", "a.pdf"], True),
+        ("false", ["a.pdf", "b.pdf"], True),
+        ("false", ["a.pdf", "c.pdf"], False),
+    ],
+)
+def test_current_is_the_same_as_source(flag, currents, same):
+    data = {
+        "copy_source_to_current": flag,
+        "files": [
+            {"source": source, "current": current}
+            for source, current in zip(["a.pdf", "b.pdf"], currents)
+        ],
+    }
+    assert merge_files.is_current_same_as_source(data) == same
+
+
+def test_current_is_copied_from_source_in_s3(s3, tmp_path, monkeypatch):
+    keys = [f"case/doc_pdf/{index}.pdf" for index in range(3)]
+    upload_pdfs(s3, tmp_path, keys)
+    write_path = str(tmp_path / "write") + "/"
+    monkeypatch.setenv("lambda_write_path", write_path)
+    monkeypatch.setenv("merge_copy_multipart_mb", "8")
+    copies = []
+    copy = s3.copy
+
+    def record_copy(*args, Config):
+        copies.append(Config)
+        return copy(*args)
+
+    monkeypatch.setattr(s3, "copy", record_copy)
+    data = {
+        "copy_source_to_current": "false",
+        "files": [{"source": key, "current": key} for key in keys],
+    }
+
+    merge_files.process(
+        ["source"], "exhibit_1", data, s3, "bucket", write_path, "_dv", "case", True
+    )
+
+    source = s3.objects[("bucket", "case/doc_pdf/exhibit_1/source_dv.pdf")]
+    assert s3.objects[("bucket", "case/doc_pdf/exhibit_1/current_dv.pdf")] == source
+    assert s3.count("UploadFile") == 1
+    assert s3.count("DownloadFile") == 3
+    assert copies[0].multipart_threshold == 8 << 20
+
+
+def make_linked_pdf(pdf_file, width):
+    """
+    Writes a pdf of two pages whose first page links to the named
+    destination "chapter" on its second page.
+    """
+    writer = PdfWriter()
+    writer.add_blank_page(width=width, height=200)
+    writer.add_blank_page(width=width, height=200)
+    pages = writer.get_object(writer._pages)["/Kids"]
+    link = DictionaryObject(
+        {
+            NameObject("/Type"): NameObject("/Annot"),
+            NameObject("/Subtype"): NameObject("/Link"),
+            NameObject("/Rect"): ArrayObject([NumberObject(0)] * 4),
+            NameObject("/Dest"): TextStringObject("chapter"),
+        }
+    )
+    pages[0].get_object()[NameObject("/Annots")] = ArrayObject(
+        [writer._add_object(link)]
+    )
+    writer._root_object[NameObject("/Names")] = DictionaryObject(
+        {
+            NameObject("/Dests"): DictionaryObject(
+                {
+                    NameObject("/Names"): ArrayObject(
+                        [
+                            TextStringObject("chapter"),
+                            ArrayObject([pages[1], NameObject("/Fit")]),
+                        ]
+                    )
+                }
+            )
+        }
+    )
+    with open(pdf_file, "wb") as file:
+        writer.write(file)
+    return str(pdf_file)
+
+
+def links(pdf_file):
+    """Returns the page index each page's link leads to"""
+    reader = PdfReader(pdf_file)
+    destinations = reader.named_destinations
+    targets = []
+    for page in reader.pages:
+        for annotation in page.get("/Annots", []):
+            destination = destinations[annotation.get_object()["/Dest"]]
+            targets.append(reader.get_destination_page_number(destination))
+    return targets
+
+
+@pytest.mark.parametrize("mode", ["sequential", "tree", "stitched"])
+def test_named_destinations_are_kept(tmp_path, monkeypatch, mode):
+    pdfs = [
+        make_linked_pdf(tmp_path / f"{index}.pdf", 100 + index) for index in range(5)
+    ]
+    merged = str(tmp_path / "merged.pdf")
+
+    if mode == "stitched":
+        fragments = []
+        for index, shard in enumerate([pdfs[:2], pdfs[2:]]):
+            data_file = str(tmp_path / f"fragment.{index}")
+            fragments.append(
+                (data_file, merge_files.merge_pdf(shard, data_file, complete=False))
+            )
+        merge_files.stitch_pdf(fragments, merged, True)
+    else:
+        monkeypatch.setenv("merge_mode", mode)
+        monkeypatch.setenv("merge_fan_in", "2")
+        monkeypatch.setenv("merge_workers", "2")
+        merge_files.merge_pdf(pdfs, merged)
+
+    # Each link still leads to the second page of its own document.
+    assert links(merged) == [1, 3, 5, 7, 9]
+    # Names used by several documents are renamed apart.
+    assert len(PdfReader(merged).named_destinations) == 5
@@ -0,0 +1,208 @@
+import io
+import json
+import signal
+import types
+
+import pytest
+from botocore.exceptions import ClientError, ParamValidationError
+from PyPDF2 import PdfReader, PdfWriter
+
+import merge_files
+
+BUCKET = "bucket"
+TRIGGER_BUCKET = "trigger"
+CONTROL_FILE = "case/doc_pdf/control_files/exhibit_1.json"
+
+
+def pdf(width):
+    writer = PdfWriter()
+    writer.add_blank_page(width=width, height=200)
+    data = io.BytesIO()
+    writer.write(data)
+    return data.getvalue()
+
+
+class FakeLambda:
+    """Records the merge tasks invoked instead of running them"""
+
+    def __init__(self):
+        self.tasks = []
+        self.denied = False
+
+    def invoke(self, function_name, task_type, task):
+        if self.denied:
+            raise ClientError(
+                {"Error": {"Code": "AccessDeniedException", "Message": "denied"}},
+                "Invoke",
+            )
+        self.tasks.append((task_type, task))
+
+
+@pytest.fixture
+def merge_lambda(s3, tmp_path, monkeypatch):
+    fake = FakeLambda()
+    monkeypatch.setattr(merge_files, "invoke_merge_task", fake.invoke)
+    monkeypatch.setenv("lambda_write_path", str(tmp_path) + "/")
+    monkeypatch.setenv("merge_shard_size", "3")
+
+    def delete_shards(bucket_name, prefix):
+        for key in [key for bucket, key in s3.objects if key.startswith(prefix)]:
+            s3.delete_object(Bucket=bucket_name, Key=key)
+
+    monkeypatch.setattr(merge_files, "delete_shards", delete_shards)
+    monkeypatch.setattr(merge_files, "update_rds_entry", lambda *args: None)
+    monkeypatch.setattr(merge_files, "delete_metadata_folder", lambda *args: None)
+    return fake
+
+
+def control_file(s3, count, same):
+    files = []
+    for index in range(count):
+        source = f"case/doc_pdf/exhibit_1/{index}.pdf"
+        current = source if same else f"case/doc_pdf/exhibit_1/{index}_current.pdf"
+        s3.put_object(Body=pdf(200 + index), Bucket=BUCKET, Key=current)
+        s3.put_object(Body=pdf(100 + index), Bucket=BUCKET, Key=source)
+        files.append({"source": source, "current": current})
+    data = {"files": files, "copy_source_to_current": "false"}
+    s3.put_object(Body=json.dumps(data), Bucket=BUCKET, Key=CONTROL_FILE)
+    s3.put_object(Body="", Bucket=TRIGGER_BUCKET, Key=CONTROL_FILE)
+    return data
+
+
+def widths(s3, key):
+    reader = PdfReader(io.BytesIO(s3.objects[(BUCKET, key)]))
+    return [int(page.mediabox.width) for page in reader.pages]
+
+
+def run_sharded_merge(s3, merge_lambda, tmp_path, data):
+    assert merge_files.start_sharded_merge(
+        CONTROL_FILE, TRIGGER_BUCKET, data, s3, BUCKET, "merge"
+    )
+    shards = list(merge_lambda.tasks)
+    merge_lambda.tasks.clear()
+    # The shards finish in any order.
+    for _, task in reversed(shards):
+        manifest = merge_files.read_json(s3, BUCKET, task["manifest"])
+        merge_files.merge_shard(task, manifest, s3, BUCKET, str(tmp_path) + "/")
+    return shards
+
+
+@pytest.mark.parametrize("same", [False, True])
+def test_shards_are_reduced_once_into_the_merged_pdfs(s3, merge_lambda, tmp_path, same):
+    data = control_file(s3, 7, same)
+
+    shards = run_sharded_merge(s3, merge_lambda, tmp_path, data)
+
+    assert [task["index"] for _, task in shards] == [0, 1, 2]
+    assert [task_type for task_type, _ in merge_lambda.tasks] == ["merge_reduce"]
+    task = merge_lambda.tasks[0][1]
+    manifest = merge_files.read_json(s3, BUCKET, task["manifest"])
+    merge_files.reduce_shards(
+        manifest, s3, BUCKET, "metadata", str(tmp_path) + "/", "_dv"
+    )
+
+    assert widths(s3, "case/doc_pdf/exhibit_1/source_dv.pdf") == list(range(100, 107))
+    current = list(range(100, 107)) if same else list(range(200, 207))
+    assert widths(s3, "case/doc_pdf/exhibit_1/current_dv.pdf") == current
+    assert (TRIGGER_BUCKET, CONTROL_FILE) not in s3.objects
+    assert (BUCKET, "case/doc_pdf/processed_control_files/exhibit_1.json") in s3.objects
+    assert not [key for _, key in s3.objects if "merge_shards" in key]
+
+
+def test_merged_shards_are_not_merged_again(s3, merge_lambda, tmp_path):
+    data = control_file(s3, 4, False)
+    shards = run_sharded_merge(s3, merge_lambda, tmp_path, data)
+    uploads = s3.count("UploadFile")
+
+    # A retried shard and a late duplicate of the last one.
+    _, task = shards[0]
+    manifest = merge_files.read_json(s3, BUCKET, task["manifest"])
+    merge_files.merge_shard(task, manifest, s3, BUCKET, str(tmp_path) + "/")
+
+    assert s3.count("UploadFile") == uploads
+    assert len(merge_lambda.tasks) == 1
+
+
+def test_denied_invoke_merges_in_this_invocation(s3, merge_lambda):
+    data = control_file(s3, 7, False)
+    merge_lambda.denied = True
+
+    assert not merge_files.start_sharded_merge(
+        CONTROL_FILE, TRIGGER_BUCKET, data, s3, BUCKET, "merge"
+    )
+    assert not [key for _, key in s3.objects if "merge_shards" in key]
+
+
+class NoConditionalWrites:
+    """S3 client of a botocore release without IfNoneMatch"""
+
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def put_object(self, IfNoneMatch=None, **kwargs):
+        if IfNoneMatch is not None:
+            raise ParamValidationError(report="Unknown parameter IfNoneMatch")
+        return self.s3.put_object(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.s3, name)
+
+
+@pytest.mark.parametrize("conditional", [True, False])
+def test_reduce_is_claimed_once(s3, conditional):
+    s3_client = s3 if conditional else NoConditionalWrites(s3)
+    prefix = merge_files.get_shard_prefix(CONTROL_FILE)
+
+    assert merge_files.claim_reduce(s3_client, BUCKET, prefix)
+    assert not merge_files.claim_reduce(s3_client, BUCKET, prefix)
+
+
+@pytest.fixture
+def handler(s3, merge_lambda, tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        merge_files,
+        "init",
+        lambda: [s3, BUCKET, "metadata", str(tmp_path) + "/", "_dv"],
+    )
+    context = types.SimpleNamespace(
+        function_name="merge", get_remaining_time_in_millis=lambda: 900_000
+    )
+
+    def run(task_type, task):
+        try:
+            merge_files.merge_task_handler({task_type: task}, context)
+        finally:
+            signal.alarm(0)
+
+    return run
+
+
+def test_task_of_a_finished_merge_is_skipped(s3, merge_lambda, handler, monkeypatch):
+    data = control_file(s3, 4, False)
+    assert merge_files.start_sharded_merge(
+        CONTROL_FILE, TRIGGER_BUCKET, data, s3, BUCKET, "merge"
+    )
+    shards = list(merge_lambda.tasks)
+    merge_files.delete_shards(BUCKET, merge_files.get_shard_prefix(CONTROL_FILE))
+    unmerged = []
+    monkeypatch.setattr(
+        merge_files, "place_unmerged_control_file", lambda *args: unmerged.append(args)
+    )
+
+    handler(*shards[0])
+
+    assert merge_lambda.tasks == shards
+    assert unmerged == []
+
+
+def test_unreadable_manifest_is_retried(s3, merge_lambda, handler, monkeypatch):
+    def throttled(s3_client, bucket_name, key):
+        raise ClientError({"Error": {"Code": "SlowDown", "Message": ""}}, "GetObject")
+
+    monkeypatch.setattr(merge_files, "read_json", throttled)
+    task = {"manifest": "case/doc_pdf/merge_shards/exhibit_1/manifest.json"}
+
+    handler("merge_reduce", dict(task, attempt=1))
+    handler("merge_reduce", dict(task, attempt=3))
+
+    assert merge_lambda.tasks == [("merge_reduce", dict(task, attempt=2))]
@@ -0,0 +1,117 @@
+import os
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import main
+
+FAKE_TESSERACT = """\
+#!{python}
+import os
+import sys
+
+# tesseract <image> <output base> [-c option ...] <extension>
+if os.path.basename(sys.argv[1]) == "broken.png":
+    sys.stderr.write("Error in pixReadStream")
+    sys.exit(1)
+with open(sys.argv[2] + "." + sys.argv[-1], "w") as f:
+    f.write(os.environ.get("OMP_THREAD_LIMIT", "unset") + " " + " ".join(sys.argv[3:-1]))
+"""
+
+
+@pytest.fixture
+def cores(monkeypatch):
+    def set_cores(count):
+        monkeypatch.setattr(os, "sched_getaffinity", lambda pid: set(range(count)))
+
+    monkeypatch.delenv("ocr_workers", raising=False)
+    monkeypatch.delenv("ocr_threads_per_worker", raising=False)
+    return set_cores
+
+
+@pytest.fixture
+def tesseract(tmp_path, monkeypatch):
+    binary = tmp_path / "tesseract"
+    binary.write_text(textwrap.dedent(FAKE_TESSERACT.format(python=sys.executable)))
+    binary.chmod(0o755)
+    monkeypatch.setattr(main.pytesseract.pytesseract, "tesseract_cmd", str(binary))
+    monkeypatch.delenv("OMP_THREAD_LIMIT", raising=False)
+    monkeypatch.setenv("ocr_page_cache", "false")
+    monkeypatch.setattr(main, "page_ocr_cache", None)
+    return str(binary)
+
+
+def test_workers_fill_the_cores(cores):
+    cores(8)
+    assert main.OcrEngine().workers == 8
+    assert main.OcrEngine(threads_per_worker=2).workers == 4
+    assert main.OcrEngine(threads_per_worker=3).workers == 2
+
+
+def test_workers_and_threads_from_environment(cores, monkeypatch):
+    cores(8)
+    monkeypatch.setenv("ocr_threads_per_worker", "4")
+    engine = main.OcrEngine()
+    assert (engine.workers, engine.threads_per_worker) == (2, 4)
+
+    monkeypatch.setenv("ocr_workers", "3")
+    assert main.OcrEngine().workers == 3
+
+
+def test_at_least_one_worker(cores):
+    cores(1)
+    assert main.OcrEngine(threads_per_worker=2).workers == 1
+
+
+def test_concurrency_is_limited_to_the_workers(cores):
+    cores(8)
+    engine = main.OcrEngine(workers=2)
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def ocr():
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+
+    futures = [engine.submit(ocr, pages=2) for _ in range(6)]
+    assert engine.queue_depth == 4
+    for future in futures:
+        future.result()
+
+    assert max(peak) == 2
+    stats = engine.stats()
+    assert stats["queue_depth"] == 0
+    assert stats["pages"] == 12
+    assert stats["avg_page_seconds"] >= 0.02
+
+
+def test_thread_limit_is_only_in_the_tesseract_environment(tmp_path, tesseract):
+    engine = main.OcrEngine(workers=1, threads_per_worker=2)
+    image = tmp_path / "page.png"
+    Image.new("L", (10, 10), 255).save(image)
+
+    engine.run_tesseract(str(image), str(tmp_path / "out"), pages=1)
+
+    assert (tmp_path / "out.pdf").read_text() == "2 "
+    assert engine.image_to_pdf(str(image), config="-c textonly_pdf=1") == (
+        b"2 -c textonly_pdf=1"
+    )
+    assert "OMP_THREAD_LIMIT" not in os.environ
+
+
+def test_tesseract_failure_raises(tmp_path, tesseract):
+    engine = main.OcrEngine(workers=1)
+    image = tmp_path / "broken.png"
+    image.write_bytes(b"")
+
+    with pytest.raises(main.pytesseract.TesseractError, match="pixReadStream"):
+        engine.image_to_pdf(str(image))
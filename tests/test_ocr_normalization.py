@@ -0,0 +1,63 @@
+import pytest
+from PIL import Image, TiffImagePlugin
+
+import main
+
+PAGE_SIZE = (850, 1100)
+
+
+def save_tiff(path, pages=1, **save_options):
+    images = [Image.new("L", PAGE_SIZE, 255) for _ in range(pages)]
+    for image in images:
+        image.paste(0, (100, 100, 700, 200))
+    images[0].save(
+        path, format="TIFF", save_all=True, append_images=images[1:], **save_options
+    )
+    return path
+
+
+@pytest.mark.parametrize(
+    "save_options",
+    [
+        {},
+        {"resolution": 1, "resolution_unit": 1},
+        {"dpi": (1, 1)},
+        {"dpi": (5000, 5000)},
+    ],
+    ids=["no resolution", "unitless", "1 dpi", "5000 dpi"],
+)
+def test_missing_or_implausible_dpi_is_taken_as_target(tmp_path, save_options):
+    tiff = save_tiff(tmp_path / "page.tif", **save_options)
+    with Image.open(tiff) as image:
+        assert main.resample_for_ocr(image, 300).size == PAGE_SIZE
+
+
+def test_known_dpi_is_resampled_to_target(tmp_path):
+    tiff = save_tiff(tmp_path / "page.tif", dpi=(150, 150))
+    with Image.open(tiff) as image:
+        assert main.resample_for_ocr(image, 300).size == (1700, 2200)
+
+
+def test_resampled_page_is_capped(tmp_path, monkeypatch):
+    monkeypatch.setenv("ocr_max_megapixels", "1")
+    tiff = save_tiff(tmp_path / "page.tif", dpi=(100, 100))
+    with Image.open(tiff) as image:
+        x, y = main.resample_for_ocr(image, 300).size
+    assert x * y <= 1e6
+
+
+def test_unitless_multipage_tiff_is_normalized_at_page_size(tmp_path):
+    tiff = save_tiff(tmp_path / "scan.tif", pages=7, resolution=1, resolution_unit=1)
+    output = tmp_path / "ocr.tif"
+    with Image.open(tiff) as image, TiffImagePlugin.AppendingTiffWriter(
+        str(output), True
+    ) as tiff_writer:
+        writer = main.OcrTiffWriter(tiff_writer, None)
+        main.write_normalized_ocr_tiff(image, writer)
+
+    with Image.open(output) as normalized:
+        assert normalized.n_frames == 7
+        for frame in range(7):
+            normalized.seek(frame)
+            assert normalized.size[0] <= PAGE_SIZE[0]
+            assert normalized.size[1] <= PAGE_SIZE[1]
@@ -0,0 +1,161 @@
+import pytest
+from PIL import Image, ImageSequence
+from PyPDF2 import PdfReader, PdfWriter
+
+import main
+
+
+def tiff(path, shades):
+    """Writes a tiff of a page of every shade of gray"""
+    pages = [Image.new("RGB", (40, 60), (shade,) * 3) for shade in shades]
+    pages[0].save(path, save_all=True, append_images=pages[1:], compression="tiff_lzw")
+    return str(path)
+
+
+class FakeOcrEngine:
+    """
+    Writes a pdf of a page per tiff page, as wide as the shade of the page,
+    instead of running tesseract.
+    """
+
+    def __init__(self):
+        self.runs = []
+
+    def run_tesseract(self, input_filename, output_filename_base, pages):
+        writer = PdfWriter()
+        with Image.open(input_filename) as image:
+            shades = [
+                page.convert("L").getpixel((0, 0))
+                for page in ImageSequence.Iterator(image)
+            ]
+        assert len(shades) == pages
+        for shade in shades:
+            writer.add_blank_page(width=shade, height=100)
+        with open(output_filename_base + ".pdf", "wb") as f:
+            writer.write(f)
+        self.runs.append(shades)
+
+
+@pytest.fixture
+def ocr_engine(monkeypatch):
+    engine = FakeOcrEngine()
+    monkeypatch.setattr(main, "ocr_engine", engine)
+    monkeypatch.setenv("ocr_page_cache", "true")
+    monkeypatch.setenv("ocr_normalize", "false")
+    monkeypatch.delenv("ocr_page_cache_path", raising=False)
+    monkeypatch.delenv("ocr_page_cache_s3_prefix", raising=False)
+    monkeypatch.setattr(main, "page_ocr_cache", None)
+    return engine
+
+
+def page_widths(pdf_file_name):
+    return [int(page.mediabox.width) for page in PdfReader(str(pdf_file_name)).pages]
+
+
+def test_page_key_follows_pixels_and_settings():
+    page = Image.new("L", (10, 10), 200)
+    key = main.PageOcrCache.page_key(page, "group4")
+
+    assert main.PageOcrCache.page_key(page.copy(), "group4") == key
+    changed = page.copy()
+    changed.putpixel((3, 3), 0)
+    assert main.PageOcrCache.page_key(changed, "group4") != key
+    assert main.PageOcrCache.page_key(page, "tiff_lzw") != key
+    assert main.PageOcrCache.page_key(page.convert("1"), "group4") != key
+    assert main.PageOcrCache.page_key(page.resize((10, 11)), "group4") != key
+
+
+def test_local_cache_is_a_bounded_lru():
+    cache = main.PageOcrCache(max_local_bytes=10)
+    cache.put("a", b"aaaa")
+    cache.put("b", b"bbbb")
+    assert cache.get("a") == b"aaaa"
+    # b is the least recently used.
+    cache.put("c", b"cccc")
+
+    assert cache.get("b") is None
+    assert cache.get("c") == b"cccc"
+    assert cache.hit_rate() == {
+        "local_hits": 2,
+        "shared_hits": 0,
+        "misses": 1,
+        "hit_rate": 0.667,
+    }
+
+
+class Store:
+    def __init__(self):
+        self.objects = {}
+
+    def get_bytes(self, key):
+        return self.objects.get(key)
+
+    def put_bytes(self, key, data):
+        self.objects[key] = data
+
+
+def test_shared_store_serves_other_containers():
+    store = Store()
+    main.PageOcrCache(1 << 20, store).put("key", b"%PDF")
+    other = main.PageOcrCache(1 << 20, store)
+
+    assert other.get("key") == b"%PDF"
+    assert other.get("key") == b"%PDF"
+    assert other.hit_rate()["shared_hits"] == 1
+    assert other.hit_rate()["local_hits"] == 1
+
+
+def test_repeated_pages_are_ocred_once(tmp_path, ocr_engine):
+    input_file = tiff(tmp_path / "scan.tif", [110, 120, 110, 130])
+    pdf_file_name = tmp_path / "out" / "scan.pdf"
+
+    assert main.tiff_to_pdf(input_file, str(pdf_file_name))
+
+    assert ocr_engine.runs == [[110, 120, 130]]
+    assert page_widths(pdf_file_name) == [110, 120, 110, 130]
+
+
+def test_cached_and_new_pages_are_reassembled_in_order(tmp_path, ocr_engine):
+    main.tiff_to_pdf(tiff(tmp_path / "first.tif", [110, 120]), str(tmp_path / "a.pdf"))
+    pdf_file_name = tmp_path / "second.pdf"
+
+    assert main.tiff_to_pdf(
+        tiff(tmp_path / "second.tif", [140, 120, 150, 110]), str(pdf_file_name)
+    )
+
+    assert ocr_engine.runs[1] == [140, 150]
+    assert page_widths(pdf_file_name) == [140, 120, 150, 110]
+    assert not list(tmp_path.glob("*_ocr.*"))
+
+
+def test_fully_cached_tiff_runs_no_ocr(tmp_path, ocr_engine):
+    main.tiff_to_pdf(tiff(tmp_path / "first.tif", [110, 120]), str(tmp_path / "a.pdf"))
+
+    assert main.tiff_to_pdf(
+        tiff(tmp_path / "again.tif", [120, 110]), str(tmp_path / "again.pdf")
+    )
+
+    assert len(ocr_engine.runs) == 1
+    assert page_widths(tmp_path / "again.pdf") == [120, 110]
+
+
+def test_multi_page_tiff_is_ocred_by_one_tesseract_run(
+    tmp_path, ocr_engine, monkeypatch
+):
+    monkeypatch.setenv("ocr_page_cache", "false")
+    input_file = tiff(tmp_path / "scan.tif", [110, 120, 110, 130, 140])
+    pdf_file_name = tmp_path / "out" / "scan.pdf"
+
+    assert main.tiff_to_pdf(input_file, str(pdf_file_name))
+
+    assert ocr_engine.runs == [[110, 120, 110, 130, 140]]
+    assert page_widths(pdf_file_name) == [110, 120, 110, 130, 140]
+    assert not list(tmp_path.glob("*_ocr.*"))
+
+
+def test_unreadable_tiff_is_not_converted(tmp_path, ocr_engine):
+    input_file = tmp_path / "scan.tif"
+    input_file.write_bytes(b"II*\x00broken")
+
+    assert not main.tiff_to_pdf(str(input_file), str(tmp_path / "scan.pdf"))
+    assert ocr_engine.runs == []
@@ -0,0 +1,96 @@
+import pytest
+from conftest import blank_pdf
+
+import main
+
+BUCKET = "bucket"
+
+
+@pytest.fixture
+def write_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("lambda_write_path", str(tmp_path))
+    monkeypatch.delenv("conversion_cache_path", raising=False)
+    monkeypatch.delenv("conversion_cache_s3_prefix", raising=False)
+    monkeypatch.setattr(main, "conversion_cache", None)
+    monkeypatch.delenv("pdf_passthrough", raising=False)
+    monkeypatch.delenv("pdf_passthrough_validate", raising=False)
+    return tmp_path
+
+
+def convert(s3, write_path, name, data):
+    s3_input_file = f"case/source/{name}"
+    s3.put_object(Body=data, Bucket=BUCKET, Key=s3_input_file)
+    (write_path / "case" / "doc_pdf").mkdir(parents=True, exist_ok=True)
+    item = {
+        "s3_input": s3_input_file,
+        "efs_input": str(write_path / s3_input_file),
+        "s3_output": "case/doc_pdf/exhibit.pdf",
+        "efs_output": str(write_path / "case/doc_pdf/exhibit.pdf"),
+        "ocr": "inline",
+    }
+    flags = main.convert_items_pipelined([item], [[0]], s3, BUCKET, prefetch=1)
+    return flags, s3.objects.get((BUCKET, item["s3_output"]))
+
+
+def test_pdf_is_copied_server_side(s3, write_path, monkeypatch):
+    monkeypatch.setenv("multipart_copy_threshold_mb", "8")
+    configs = []
+    copy = s3.copy
+
+    def record_copy(CopySource, Bucket, Key, Config=None, **kwargs):
+        configs.append(Config)
+        return copy(CopySource, Bucket, Key)
+
+    monkeypatch.setattr(s3, "copy", record_copy)
+    pdf = blank_pdf()
+
+    flags, output = convert(s3, write_path, "exhibit.pdf", pdf)
+
+    assert flags == [True]
+    assert output == pdf
+    assert s3.count("DownloadFile") == 0
+    assert s3.count("UploadFile") == 0
+    assert configs[0].multipart_threshold == 8 * 1024 * 1024
+    assert configs[0].multipart_chunksize == 8 * 1024 * 1024
+
+
+def test_validation_reads_only_header_and_trailer(s3, write_path, monkeypatch):
+    monkeypatch.setenv("pdf_passthrough_validate", "true")
+    pdf = blank_pdf()
+
+    flags, output = convert(s3, write_path, "exhibit.pdf", pdf)
+
+    assert flags == [True]
+    assert output == pdf
+    assert s3.count("GetObject") == 2
+    assert s3.count("DownloadFile") == 0
+
+
+def test_invalid_pdf_falls_back_to_conversion(s3, write_path, monkeypatch):
+    monkeypatch.setenv("pdf_passthrough_validate", "true")
+    # A MIF document saved with the extension of a pdf.
+    mif = b"<MIFFile 9.00>\n<Para <String `exhibit'>>\n"
+
+    flags, output = convert(s3, write_path, "exhibit.pdf", mif)
+
+    assert flags == [True]
+    assert s3.count("DownloadFile") == 1
+    assert output.startswith(b"%PDF-")
+    assert b"%%EOF" in output[-1024:]
+
+
+def test_failed_copy_creates_unprocessed_file(s3, write_path, monkeypatch):
+    unprocessed = []
+    monkeypatch.setattr(
+        main,
+        "create_unprocessed_file",
+        lambda bucket_name, s3_input_file: unprocessed.append(s3_input_file),
+    )
+
+    assert (
+        main.copy_pdf_passthrough(
+            s3, "case/source/missing.pdf", "case/doc_pdf/missing.pdf", BUCKET
+        )
+        is False
+    )
+    assert unprocessed == ["case/source/missing.pdf"]
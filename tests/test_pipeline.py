@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+import main
+
+BUCKET = "bucket"
+
+
+@pytest.fixture
+def write_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("lambda_write_path", str(tmp_path))
+    monkeypatch.delenv("conversion_cache_path", raising=False)
+    monkeypatch.delenv("conversion_cache_s3_prefix", raising=False)
+    monkeypatch.setattr(main, "conversion_cache", None)
+    return tmp_path
+
+
+def make_items(s3, write_path, count):
+    items = []
+    for i in range(count):
+        name = f"case/source/note{i}.txt"
+        s3.put_object(Body=f"note {i}\n" * 100, Bucket=BUCKET, Key=name)
+        items.append(
+            {
+                "s3_input": name,
+                "efs_input": str(write_path / name),
+                "s3_output": f"case/doc_pdf/note{i}.pdf",
+                "efs_output": str(write_path / f"case/source/note{i}.pdf"),
+                "ocr": "inline",
+            }
+        )
+    return items
+
+
+def remaining_files(path):
+    return [
+        os.path.join(root, name) for root, _, files in os.walk(path) for name in files
+    ]
+
+
+def test_pipeline_converts_uploads_and_cleans_up(s3, write_path):
+    items = make_items(s3, write_path, 5)
+    groups = [[i] for i in range(len(items))]
+
+    flags = main.convert_items_pipelined(items, groups, s3, BUCKET, prefetch=2)
+
+    assert flags == [True] * 5
+    for item in items:
+        assert s3.objects[(BUCKET, item["s3_output"])].startswith(b"%PDF-")
+    assert remaining_files(write_path) == []
+
+
+def test_pipeline_holds_prefetch_over_disk_budget(s3, write_path, monkeypatch):
+    monkeypatch.setenv("pipeline_disk_mb", "1")
+    items = make_items(s3, write_path, 4)
+    groups = [[i] for i in range(len(items))]
+    prefetched = []
+    download_file = main.download_file
+
+    def record_download(prefix, destination_pathname, bucket, client):
+        download_file(prefix, destination_pathname, bucket, client)
+        # Pad the working folder over the budget once the first input is in.
+        with open(os.path.join(write_path, "intermediate.png"), "wb") as f:
+            f.truncate(2 * 1024 * 1024)
+        inputs = os.listdir(write_path / "case" / "source")
+        prefetched.append(len([name for name in inputs if name.endswith(".txt")]))
+
+    monkeypatch.setattr(main, "download_file", record_download)
+    flags = main.convert_items_pipelined(items, groups, s3, BUCKET, prefetch=3)
+
+    assert flags == [True] * 4
+    assert max(prefetched) == 1
+
+
+class IntermediateConverter(main.Converter):
+    name = "text"
+
+    def convert(self, job):
+        with open(job.intermediate(job.filename + "_page.png"), "wb") as f:
+            f.write(b"png")
+        os.makedirs(job.intermediate(job.filename + "_parts"))
+        with open(job.pdf_file_name, "wb") as f:
+            f.write(b"%PDF-1.4")
+        return True
+
+
+def test_convert_document_removes_intermediates(write_path, monkeypatch):
+    input_file = write_path / "doc.txt"
+    input_file.write_text("text")
+    monkeypatch.setattr(
+        main.converter_registry, "select", lambda *args: IntermediateConverter()
+    )
+
+    converted, success = main.convert_document(
+        None,
+        "case/source/doc.txt",
+        str(input_file),
+        str(write_path / "doc.pdf"),
+        "case/doc_pdf/doc.pdf",
+        BUCKET,
+        None,
+    )
+
+    assert converted and success
+    assert sorted(os.listdir(write_path)) == ["doc.pdf", "doc.txt"]
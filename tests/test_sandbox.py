@@ -0,0 +1,113 @@
+import multiprocessing
+import threading
+
+import pytest
+from PyPDF2 import PdfReader
+
+import main
+
+
+class FakeRenderer:
+    def __init__(self):
+        self.rendered = []
+
+    def render(self, input_file, output_file, options=None):
+        if "fail" in input_file:
+            raise OSError("wkhtmltopdf could not render")
+        self.rendered.append((input_file, output_file, options))
+        return True
+
+
+@pytest.fixture
+def renderer(monkeypatch):
+    renderer = FakeRenderer()
+    monkeypatch.setattr(main, "html_renderer", renderer)
+    return renderer
+
+
+@pytest.fixture
+def client():
+    services, sandbox_services = multiprocessing.Pipe()
+    send_lock = threading.Lock()
+
+    def serve():
+        while True:
+            try:
+                request = services.recv()
+            except (EOFError, OSError):
+                return
+            threading.Thread(
+                target=main.serve_sandbox_call, args=(services, send_lock, request)
+            ).start()
+
+    threading.Thread(target=serve, daemon=True).start()
+    yield main.SandboxServiceClient(sandbox_services)
+    sandbox_services.close()
+    services.close()
+
+
+def test_sandbox_calls_run_on_the_parent_services(client, renderer):
+    proxy = main.SandboxService(client, "html_renderer")
+    threads = [
+        threading.Thread(target=proxy.render, args=(f"{i}.html", f"{i}.pdf"))
+        for i in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    assert proxy.render("page.html", "page.pdf", options=["-q"])
+    for thread in threads:
+        thread.join()
+
+    assert len(renderer.rendered) == 9
+    assert ("page.html", "page.pdf", ["-q"]) in renderer.rendered
+
+
+def test_sandbox_calls_raise_the_parent_errors(client, renderer):
+    proxy = main.SandboxService(client, "html_renderer")
+    with pytest.raises(OSError, match="could not render"):
+        proxy.render("fail.html", "fail.pdf")
+
+
+def test_only_served_methods_are_called(client, renderer):
+    proxy = main.SandboxService(client, "html_renderer")
+    with pytest.raises(ValueError, match="not served"):
+        proxy.stats()
+
+
+def test_calls_fail_once_the_parent_is_gone(renderer):
+    services, sandbox_services = multiprocessing.Pipe()
+    client = main.SandboxServiceClient(sandbox_services)
+    services.close()
+    with pytest.raises(OSError):
+        main.SandboxService(client, "html_renderer").render("a.html", "a.pdf")
+
+
+def test_memory_limit_is_off_by_default(monkeypatch):
+    monkeypatch.delenv("conversion_memory_mb", raising=False)
+    monkeypatch.setenv("conversion_cpu_seconds", "120")
+    assert main.get_sandbox_limits() == (0, 120)
+
+
+def test_chunked_text_converts_in_the_sandbox(tmp_path, monkeypatch):
+    # The chunks are rendered by a process pool started in the sandbox.
+    monkeypatch.setenv("conversion_sandbox", "true")
+    monkeypatch.setenv("text_chunk_mb", "1")
+    monkeypatch.setenv("text_render_workers", "2")
+    input_file = tmp_path / "notes.txt"
+    with open(input_file, "w") as f:
+        for index in range(60000):
+            f.write(f"line {index:06} {'x' * 40}\n")
+    pdf_file_name = str(tmp_path / "notes.pdf")
+
+    converted = main.convert_document_with_limits(
+        None,
+        "case/source/notes.txt",
+        str(input_file),
+        pdf_file_name,
+        "case/doc_pdf/notes.pdf",
+        "bucket",
+        None,
+    )
+
+    assert converted == (True, True)
+    assert len(PdfReader(pdf_file_name).pages) > 1
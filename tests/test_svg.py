@@ -0,0 +1,77 @@
+import pytest
+from PyPDF2 import PdfReader
+
+import main
+
+DRAWING = """\
+<?xml version="1.0"?>
+<svg xmlns="http://www.w3.org/2000/svg" width="300" height="120">
+  <rect x="10" y="10" width="100" height="50" fill="navy"/>
+  <text x="20" y="100" font-size="16">Exhibit 4</text>
+</svg>
+"""
+
+
+class RecordingRenderer:
+    """Stands in for wkhtmltopdf, recording the files it renders"""
+
+    def __init__(self):
+        self.rendered = []
+
+    def render(self, input_file, output_file, options=None):
+        self.rendered.append(input_file)
+        with open(output_file, "w") as f:
+            f.write("%PDF-1.4")
+        return True
+
+
+@pytest.fixture
+def renderer(monkeypatch):
+    fake = RecordingRenderer()
+    monkeypatch.setattr(main, "get_html_renderer", lambda: fake)
+    return fake
+
+
+def convert_svg(tmp_path, text):
+    input_file = tmp_path / "drawing.svg"
+    input_file.write_text(text)
+    job = main.ConversionJob(
+        None,
+        None,
+        str(input_file),
+        str(tmp_path / "drawing.pdf"),
+        None,
+        None,
+        None,
+        "inline",
+    )
+    converter = main.converter_registry.select(str(input_file), "inline")
+    assert converter.name == "svg"
+    return converter.convert(job), job
+
+
+def test_svg_is_rendered_as_a_vector_page(tmp_path, renderer):
+    converted, job = convert_svg(tmp_path, DRAWING)
+
+    assert converted
+    assert renderer.rendered == []
+    pages = PdfReader(job.pdf_file_name).pages
+    assert len(pages) == 1
+    # 300 x 120 px at 96 px to 72 points per inch.
+    assert [float(pages[0].mediabox.width), float(pages[0].mediabox.height)] == [
+        225,
+        90,
+    ]
+    # Drawn with pdf operators, not as an image of the drawing.
+    assert "/XObject" not in pages[0]["/Resources"]
+    assert "Exhibit 4" in pages[0].extract_text()
+
+
+def test_malformed_svg_is_rendered_with_wkhtmltopdf(tmp_path, renderer):
+    # svglib recovers from most broken markup, but not from a missing root.
+    converted, job = convert_svg(
+        tmp_path, '<?xml version="1.0"?>\n<!-- truncated in transfer: <svg'
+    )
+
+    assert converted
+    assert renderer.rendered == [job.input_file]
@@ -0,0 +1,80 @@
+import re
+
+import pytest
+from PyPDF2 import PdfReader
+
+import main
+
+TEXT = "Café crème, naïve façade\nZürich – 5 €\n"
+
+
+def page_lines(pdf_file_name):
+    """Returns the lines drawn on every page of a pdf of StreamingPdfWriter"""
+    pages = []
+    for page in PdfReader(str(pdf_file_name)).pages:
+        content = page["/Contents"].get_object().get_data()
+        pages.append(
+            [
+                line.decode("cp1252").replace("\\(", "(").replace("\\)", ")")
+                for line in re.findall(rb"\((.*?)\) Tj", content)
+            ]
+        )
+    return pages
+
+
+@pytest.mark.parametrize("encoding", ["cp1252", "utf-16", "utf-8-sig", "utf-8"])
+def test_encoding_is_detected(tmp_path, encoding):
+    input_file = tmp_path / "notes.txt"
+    input_file.write_bytes((TEXT * 20).encode(encoding))
+    pdf_file_name = tmp_path / "notes.pdf"
+
+    with open(input_file, encoding=main.detect_text_encoding(str(input_file))) as f:
+        assert f.read() == TEXT * 20
+    assert main.text_to_pdf(str(input_file), str(pdf_file_name))
+    assert page_lines(pdf_file_name)[0][:2] == TEXT.splitlines()
+
+
+def test_chunks_keep_the_page_order(tmp_path, monkeypatch):
+    input_file = tmp_path / "log.txt"
+    lines = [f"line {index:06} " + "x" * (index % 150) for index in range(30000)]
+    input_file.write_text("\n".join(lines) + "\n")
+    whole = tmp_path / "whole.pdf"
+    chunked = tmp_path / "chunked.pdf"
+    monkeypatch.setenv("text_render_workers", "2")
+    assert main.text_to_pdf(str(input_file), str(whole))
+
+    monkeypatch.setenv("text_chunk_mb", "1")
+    assert main.text_to_pdf(str(input_file), str(chunked))
+
+    chunks = len(main.text_chunk_offsets(str(input_file), input_file.stat().st_size, 3))
+    assert chunks == 3
+    whole_pages, chunked_pages = page_lines(whole), page_lines(chunked)
+    # Every chunk starts on a new page.
+    assert len(whole_pages) <= len(chunked_pages) <= len(whole_pages) + chunks - 1
+    assert sum(chunked_pages, []) == sum(whole_pages, [])
+    starts = [page[0] for page in chunked_pages if page[0].startswith("line")]
+    assert starts == sorted(starts)
+    assert not list(tmp_path.glob("*.pages"))
+
+
+def test_mif_is_rendered_as_text(tmp_path):
+    input_file = tmp_path / "manual"
+    input_file.write_text("<MIFFile 7.00> # Generated\n<Para <String `Title'>>\n")
+    pdf_file_name = tmp_path / "manual.pdf"
+    converter = main.converter_registry.select(str(input_file), "inline")
+    job = main.ConversionJob(
+        None, None, str(input_file), str(pdf_file_name), None, None, None, "none"
+    )
+
+    assert converter.name == "mif"
+    assert converter.convert(job)
+    assert page_lines(pdf_file_name) == [
+        ["<MIFFile 7.00> # Generated", "<Para <String `Title'>>"]
+    ]
+
+
+def test_empty_text_has_one_page(tmp_path):
+    input_file = tmp_path / "empty.txt"
+    input_file.write_text("")
+    assert main.text_to_pdf(str(input_file), str(tmp_path / "empty.pdf"))
+    assert page_lines(tmp_path / "empty.pdf") == [[]]